@@ -32,31 +32,43 @@ __init__.py -- set up the add-on
 from __future__ import annotations
 
 import re
-from typing import Dict, List, Optional, Set, TYPE_CHECKING
+from typing import Dict, Iterable, List, Optional, Set, TYPE_CHECKING
 
 import anki
 import aqt
 from aqt.addcards import AddCards
 from aqt.utils import showWarning
 # pylint: disable=import-error, no-name-in-module
-from aqt.qt import QAction, QKeySequence
+from aqt.qt import QAction, QKeySequence, QMenu
 
 from .importer import ImportDialog
 from .macro_exporter import MACRO_EXPORTER_PROPERTIES
+from .prefetch import start_prefetching, stop_prefetching
 from .settings import edit_settings
 from .twnote import TwNote
+from .watcher import start_push_server, start_watching, stop_push_server, stop_watching
 
 if TYPE_CHECKING:
     from anki.models import NoteType
 
 
-def begin_sync() -> None:
-    "Launch the importer dialog."
-    dialog = ImportDialog(aqt.mw)
+def begin_sync(wiki_names: Optional[Iterable[str]] = None) -> None:
+    "Launch the importer dialog, for all wikis or only those named in /wiki_names/."
+    dialog = ImportDialog(aqt.mw, wiki_names)
     if dialog.start_import():
         dialog.exec()
 
 
+def populate_wiki_menu(menu: QMenu) -> None:
+    "Fill /menu/ with an action to sync each configured wiki on its own."
+    menu.clear()
+    conf = aqt.mw.addonManager.getConfig(__name__)
+    for wiki_name in conf['wikis']:
+        wiki_action = menu.addAction(wiki_name)
+        wiki_action.triggered.connect(  # type: ignore
+            lambda _checked=False, name=wiki_name: begin_sync([name]))
+
+
 def register_note_type_warning() -> None:
     "Remind the user not to add notes of the TiddlyRemember note type."
     def warn_if_adding_tiddlyremember(note_type_name: str) -> None:
@@ -91,10 +103,35 @@ if aqt.mw is not None:
     action.setText("Sync from &TiddlyWiki")
     action.setShortcut(QKeySequence("Shift+Y"))
     aqt.mw.form.menuTools.addAction(action)
-    action.triggered.connect(begin_sync)  # type: ignore
-
-    # Set up config dialog.
-    aqt.mw.addonManager.setConfigAction(__name__, edit_settings)
+    action.triggered.connect(lambda: begin_sync())  # type: ignore
+
+    # Set up submenu to sync a single wiki. The wikis are listed each time the
+    # menu is opened, as the configuration may have changed.
+    wiki_menu = QMenu("Sync from One TiddlyWiki", aqt.mw)
+    aqt.mw.form.menuTools.addMenu(wiki_menu)
+    wiki_menu.aboutToShow.connect(  # type: ignore
+        lambda: populate_wiki_menu(wiki_menu))
+
+    # Set up config dialog. Background jobs are restarted afterwards, as the
+    # configuration may have changed.
+    def edit_settings_and_restart() -> None:
+        edit_settings()
+        start_background_jobs()
+    aqt.mw.addonManager.setConfigAction(__name__, edit_settings_and_restart)
+
+    # Set up watching folder wikis for changes, accepting pushed tiddlers, and
+    # extracting wikis ahead of time, if enabled.
+    def start_background_jobs() -> None:
+        start_watching(aqt.mw)
+        start_push_server(aqt.mw)
+        start_prefetching(aqt.mw)
+
+    def stop_background_jobs() -> None:
+        stop_watching()
+        stop_push_server()
+        stop_prefetching()
+    aqt.gui_hooks.profile_did_open.append(start_background_jobs)
+    aqt.gui_hooks.profile_will_close.append(stop_background_jobs)
 
     # Set up reminder message when user selects the TR note type to add notes.
     register_note_type_warning()
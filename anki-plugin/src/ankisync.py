@@ -7,97 +7,443 @@ compared with all Anki notes in the collection, and the Anki collection is
 updated to match, by adding and updating notes to match those found in the
 set of TiddlyWiki notes, then deleting any notes in the Anki collection that
 use TiddlyRemember models and were not found in that set. Any changes made in
-Anki and not in TiddlyWiki will be lost at this point.
-
-The sync() method is the public interface to this module.
+Anki and not in TiddlyWiki will be lost at this point. A sync can also be
+limited to some of the user's wikis, in which case only notes from those
+wikis are candidates for deletion, or to some tiddlers of a wiki, in which
+case only the notes that came from those tiddlers are.
+
+A sync is done in two steps. First, make_plan() takes a snapshot of the
+collection and works out what needs to change (see syncplan.py); then
+apply_plan() makes those changes. The sync() method does both and is the
+simplest interface to this module. From the GUI, the plan is made first so
+that the user can be asked for permission to modify the collection's schema
+if necessary, then applied through sync_op(), which makes the whole sync a
+single undoable operation.
+
+Plans are applied in chunks of a limited number of notes. If given a
+journal (see journal.py), apply_plan() records its progress after each chunk,
+so that a sync that is interrupted can be resumed rather than started over.
 """
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Dict, Set, cast
+import hashlib
+from pathlib import Path
+import time
+from typing import (AbstractSet, Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence,
+                    Set, Tuple)
 
 import anki.consts
-from anki.notes import Note
+from anki.collection import AddNoteRequest, OpChanges
+from anki.notes import Note, NoteId
+from anki.utils import ids2str
 
 from . import trmodels
-from .twnote import TwNote
-from .util import pluralize, Twid
+from .fingerprints import Fingerprint, FingerprintStore
+from .journal import JournalState, SyncJournal
+from .oops import ExtractError
+from .snapshot import load_mods, load_snapshot
+from .syncplan import SyncPlan, TypeChange, plan_sync
+from .twnote import TwNote, canonical_field
+from .util import Twid
 
+#: Default number of notes to send to the backend in a single call when
+#: adding or updating notes.
+BATCH_SIZE = 1000
 
-def _change_note_type(col: Any, tw_note: TwNote, anki_note: Note) -> Note:
-    """
-    If the ID is now a cloze note rather than a question note or vice versa,
-    change the note type in Anki prior to trying to complete the sync.
-    Return the updated note.
+#: Called with (changes made so far, total changes) as the sync progresses.
+ProgressCallback = Callable[[int, int], None]
+
+#: Name of the undo step covering all the changes made by sync_op().
+UNDO_NAME = "Sync from TiddlyWiki"
+
+
+class _Progress:
+    "Running count of the changes made to the collection, reported to a callback."
+    def __init__(self, callback: Optional[ProgressCallback], total: int) -> None:
+        self.callback = callback
+        self.total = total
+        self.done = 0
+
+    def advance(self, count: int) -> None:
+        self.done += count
+        if self.callback is not None:
+            self.callback(self.done, self.total)
+
+
+def _new_to_old(old_to_new: Dict[int, Optional[int]], new_count: int) -> List[int]:
     """
-    old_model_name = anki_note.model()['name']  # type: ignore
-    old_model_definition = trmodels.by_name(old_model_name)
-    assert old_model_definition is not None, \
-        f"A note of a type TiddlyRemember does not support ('{old_model_name}') " \
-        f"was found. TiddlyRemember does not know how to fix this note. " \
-        f"This is probably TiddlyRemember's fault -- please consider reporting " \
-        f"this error. "
+    Convert a mapping from field or template indices of an old note type to
+    those of a new one, as produced by trmodels, into the form Anki expects:
+    for each index in the new note type, the index in the old one whose
+    content it takes, or -1 if none.
 
-    fmap = old_model_definition.field_remap(tw_note.model)
-    cmap = old_model_definition.card_remap(tw_note.model)
-    new_model = col.models.by_name(tw_note.model.name)
-    col.models.change(anki_note.note_type(), [anki_note.id], new_model, fmap, cmap)
+    >>> _new_to_old({0: 1, 1: None, 2: 0}, 3)
+    [2, 0, -1]
+    """
+    new_to_old = {new: old for old, new in old_to_new.items() if new is not None}
+    return [new_to_old.get(i, -1) for i in range(new_count)]
 
-    return col.get_note(col.find_notes(f"nid:{anki_note.id}")[0])
 
+def _change_note_types(col: Any, type_changes: Sequence[TypeChange]) -> None:
+    """
+    If IDs are now cloze notes rather than question notes or vice versa,
+    change the note types in Anki prior to trying to complete the sync.
 
-def _set_initial_scheduling(tw_note: TwNote, anki_note: Note, col: Any):
+    Each TypeChange covers all notes converted between the same two note types,
+    so the mappings are worked out once and each distinct conversion is a single
+    (schema-modifying) operation on the collection. The caller is responsible
+    for getting the user's permission to modify the schema.
+    """
+    for change in type_changes:
+        old_definition = trmodels.by_name(change.old_model)
+        assert old_definition is not None, \
+            f"A note of a type TiddlyRemember does not support ('{change.old_model}') " \
+            f"was found. TiddlyRemember does not know how to fix this note. " \
+            f"This is probably TiddlyRemember's fault -- please consider reporting " \
+            f"this error. "
+        new_definition = trmodels.by_name(change.new_model)
+        assert new_definition is not None
+
+        old_model = col.models.by_name(change.old_model)
+        new_model = col.models.by_name(change.new_model)
+        request = col.models.change_notetype_info(
+            old_notetype_id=old_model['id'], new_notetype_id=new_model['id']).input
+        request.note_ids.extend(change.nids)
+        del request.new_fields[:]
+        request.new_fields.extend(_new_to_old(
+            old_definition.field_remap(new_definition), len(new_model['flds'])))
+        del request.new_templates[:]
+        if not request.is_cloze:
+            request.new_templates.extend(_new_to_old(
+                old_definition.card_remap(new_definition), len(new_model['tmpls'])))
+        col.models.change_notetype_of_notes(request)
+
+
+def _set_initial_scheduling(added: Sequence[Tuple[TwNote, Note]], col: Any) -> None:
     """
-    When a note is added, apply any starting scheduling information supplied by
-    the TiddlyWiki note. Subsequent syncs will keep Anki's scheduling information,
+    When notes are added, apply any starting scheduling information supplied by
+    the TiddlyWiki notes. Subsequent syncs will keep Anki's scheduling information,
     unless the note is deleted and then synced back again.
 
     Currently, the same scheduling must be applied to all cards of a note.
+    The cards of all notes sharing a schedule are updated with a single
+    statement, without loading them.
+    """
+    # Due date appears to be a number of days with epoch when the scheduler is
+    # initialized for the collection, so we translate the due date by
+    # figuring the number of days it differs from today and adding it to
+    # today's Anki number.
+    today = datetime.now().date()
+    by_schedule: Dict[Tuple[int, int, int, int], List[NoteId]] = {}
+    for tw_note, anki_note in added:
+        schedule = tw_note.schedule
+        if schedule is not None:
+            due = col.sched.today + (schedule.due - today).days
+            key = (schedule.ivl, schedule.ease, schedule.lapses, due)
+            by_schedule.setdefault(key, []).append(anki_note.id)
+
+    # If scheduling is given, the cards go straight to the review queue,
+    # rather than starting in the new queue.
+    mod, usn = int(time.time()), col.usn()
+    for (ivl, factor, lapses, due), nids in by_schedule.items():
+        col.db.execute(
+            "update cards set type=?, queue=?, ivl=?, factor=?, lapses=?, due=?, "
+            "mod=?, usn=? where nid in " + ids2str(nids),
+            anki.consts.CARD_TYPE_REV, anki.consts.QUEUE_TYPE_REV,
+            ivl, factor, lapses, due, mod, usn)
+
+
+def _add_media(tw_notes: Iterable[TwNote], col: Any) -> None:
+    """
+    Sync any media used on the notes into Anki, writing each file at most once.
+
+    Media is only read when it's written (see media.py), so a file or URL
+    that could be read when the notes were extracted may have gone since;
+    that raises an ExtractError.
+    """
+    for medium in set(m for tw_note in tw_notes for m in tw_note.media):
+        try:
+            medium.write_to_anki(col)
+        except (OSError, ValueError) as e:
+            raise ExtractError(
+                f"The media file '{medium.url}' could not be retrieved to copy it "
+                f"into Anki: {e}. Please check that it's still available, "
+                f"then sync again.") from e
+
+
+def _deck_id(deck_name: str, col: Any, deck_ids: Dict[str, int]) -> int:
+    """
+    Return the ID of the deck called /deck_name/, creating the deck if it
+    doesn't exist yet. IDs are remembered in /deck_ids/ so that each deck
+    is only looked up once per sync.
+    """
+    if deck_name not in deck_ids:
+        # Confusingly, col.decks.id returns the ID of an existing deck,
+        # and creates it if it doesn't exist.
+        deck_ids[deck_name] = col.decks.id(deck_name)
+    return deck_ids[deck_name]
+
+
+def _add_notes(tw_notes: Sequence[TwNote], col: Any, default_deck: str,
+               deck_ids: Dict[str, int], batch_size: int,
+               progress: _Progress) -> Dict[Twid, NoteId]:
+    """
+    Create Anki notes for TiddlyWiki notes that aren't in the collection yet.
+
+    Note types and decks are looked up once per distinct value, and notes are
+    sent to the backend /batch_size/ at a time.
+
+    :return: The IDs of the new Anki notes, by TiddlyRemember ID.
+    """
+    models: Dict[str, Any] = {}
+    nids: Dict[Twid, NoteId] = {}
+    for start in range(0, len(tw_notes), batch_size):
+        batch = tw_notes[start:start+batch_size]
+        added: List[Tuple[TwNote, Note]] = []
+        requests: List[AddNoteRequest] = []
+        for tw_note in batch:
+            model_name = tw_note.model.name
+            if model_name not in models:
+                models[model_name] = col.models.by_name(model_name)
+            n = Note(col, models[model_name])
+            tw_note.update_fields(n)
+
+            did = _deck_id(tw_note.target_deck or default_deck, col, deck_ids)
+            requests.append(AddNoteRequest(n, did))
+            added.append((tw_note, n))
+
+        col.add_notes(requests)
+        nids.update((tw_note.id_, n.id) for tw_note, n in added)
+        _set_initial_scheduling(added, col)
+        progress.advance(len(batch))
+    return nids
+
+
+def _update_notes(changed: Sequence[Tuple[TwNote, NoteId]], col: Any,
+                  batch_size: int, progress: _Progress) -> None:
+    """
+    Write the current content of TiddlyWiki notes to the existing Anki notes
+    they correspond to, sending the notes to the backend /batch_size/ at a time.
+    """
+    for start in range(0, len(changed), batch_size):
+        batch = changed[start:start+batch_size]
+        anki_notes = []
+        for tw_note, nid in batch:
+            anki_note = col.get_note(nid)
+            tw_note.update_fields(anki_note)
+            anki_notes.append(anki_note)
+
+        col.update_notes(anki_notes)
+        progress.advance(len(batch))
+
+
+def _save_fingerprints(store: FingerprintStore, nids: Dict[Twid, NoteId],
+                       tw_notes: Dict[Twid, TwNote], col: Any) -> None:
+    """
+    Record the content of the synced notes for the next sync to compare against.
+
+    Modification times only have a resolution of one second, so a change made
+    in Anki during the second the sync finishes would go unnoticed. Notes
+    modified that recently are therefore left out, to be compared field by
+    field next time.
+
+    Fingerprints of notes that weren't part of this sync (because it was
+    limited to some wikis) are kept; they're still checked against the
+    notes' modification times before being used.
+    """
+    mods = load_mods(col)
+    now = int(time.time())
+    synced = set(nids.values())
+    fingerprints = {nid: fingerprint for nid, fingerprint in store.load().items()
+                    if nid in mods and nid not in synced}
+    fingerprints.update(
+        (nid, Fingerprint(twid, mods[nid], tw_notes[twid].digest,
+                          canonical_field(tw_notes[twid].wiki.name)))
+        for twid, nid in nids.items()
+        if nid in mods and mods[nid] < now)
+    store.save(fingerprints)
+
+
+def _misplaced_cards(targets: Dict[NoteId, str], col: Any,
+                     deck_ids: Dict[str, int]) -> Dict[int, List[int]]:
     """
-    if tw_note.schedule is not None:
-        for cid in col.find_cards(f"nid:{anki_note.id}"):
-            c = col.get_card(cid)
+    Given notes already in Anki's database and the names of the decks they
+    belong in, find any of their cards that aren't in the right deck.
+    All cards of a note must go to the same deck for the time being.
+    The cards of all the notes are examined with a single query.
 
-            # If scheduling is given, the card goes straight to the review queue,
-            # rather than starting in the new queue.
-            c.queue = anki.consts.QUEUE_TYPE_REV
-            c.type = anki.consts.CARD_TYPE_REV
-            c.ivl = tw_note.schedule.ivl
-            c.factor = tw_note.schedule.ease
-            c.lapses = tw_note.schedule.lapses
-            # Due date appears to be a number of days with epoch when the scheduler is
-            # initialized for the collection, so we translate the due date by
-            # figuring the number of days it differs from today and adding it to
-            # today's Anki number.
-            days_from_today = (tw_note.schedule.due - datetime.now().date()).days
-            c.due = col.sched.today + days_from_today
+    :return: The IDs of the cards to move, by the ID of their destination deck.
+    """
+    if not targets:
+        return {}
+
+    target_dids: Dict[NoteId, int] = {}
+    for nid, deck_name in targets.items():
+        target_dids[nid] = _deck_id(deck_name, col, deck_ids)
 
-            col.update_card(c)
+    moves: Dict[int, List[int]] = {}
+    for cid, nid, did in col.db.all("select id, nid, did from cards where nid in "
+                                    + ids2str(targets)):
+        new_did = target_dids[nid]
+        if did != new_did:
+            moves.setdefault(new_did, []).append(cid)
+    return moves
 
 
-def _add_media(tw_note: TwNote, col: Any) -> None:
-    "Sync any media used on the note into Anki."
-    for medium in tw_note.media:
-        medium.write_to_anki(col)
+def _move_cards(moves: Dict[int, List[int]], col: Any, progress: _Progress) -> None:
+    "Move cards into their decks, with one call per destination deck."
+    for new_did, cids in sorted(moves.items()):
+        col.set_deck(cids, new_did)
+        progress.advance(len(cids))
 
 
-def _update_deck(tw_note: TwNote, anki_note: Note, col: Any, default_deck: str) -> None:
+def _notes_key(tw_notes: Iterable[TwNote], default_deck: str,
+               wikis: Optional[AbstractSet[str]],
+               removable: Optional[AbstractSet[Twid]] = None) -> str:
+    """
+    Summarize everything about a set of TiddlyWiki notes that a plan depends on,
+    so that an interrupted sync is only resumed if the notes haven't changed.
+    """
+    key = hashlib.sha256(default_deck.encode('utf-8'))
+    if wikis is not None:
+        key.update("\x1d".join(sorted(wikis)).encode('utf-8'))
+    if removable is not None:
+        key.update(("\x1c" + "\x1d".join(sorted(removable))).encode('utf-8'))
+    for twid, digest, deck in sorted((n.id_, n.digest, n.target_deck or '')
+                                     for n in tw_notes):
+        key.update(f"\x1e{twid}\x1f{digest}\x1f{deck}".encode('utf-8'))
+    return key.hexdigest()
+
+
+def _chunks(plan: SyncPlan, batch_size: int, skip: int) -> Iterator[Tuple[str, Sequence[Any]]]:
     """
-    Given a note already in Anki's database, move its cards into an
-    appropriate deck if they aren't already there. All cards must go to the
-    same deck for the time being.
+    Divide the changes in a plan into the chunks in which they're made, as
+    (kind of change, changes) pairs, leaving out the first /skip/ changes.
+    Each change of note type is a chunk by itself; notes are added, updated,
+    and removed /batch_size/ at a time.
+    """
+    stages = (('retype', plan.type_changes, 1),
+              ('add', plan.adds, batch_size),
+              ('edit', plan.edits, batch_size),
+              ('remove', plan.removes, batch_size))
+    for kind, changes, size in stages:
+        start = min(skip, len(changes))
+        skip -= start
+        for i in range(start, len(changes), size):
+            yield kind, changes[i:i+size]
+
+
+def make_plan(tw_notes: Iterable[TwNote], col: Any, default_deck: str,
+              fingerprint_path: Optional[Path] = None,
+              journal_path: Optional[Path] = None,
+              wikis: Optional[AbstractSet[str]] = None,
+              removable: Optional[AbstractSet[Twid]] = None) -> SyncPlan:
+    """
+    Work out what a sync of /tw_notes/ will change in the collection,
+    without changing anything. Arguments are as for sync().
 
-    The note must be flushed to Anki's database for this to work correctly.
+    If the journal shows that a sync of the same notes was interrupted and
+    the collection hasn't been changed since, that sync's plan is returned.
+    """
+    if journal_path is not None:
+        tw_notes = list(tw_notes)
+        state = SyncJournal(journal_path).pending(
+            _notes_key(tw_notes, default_deck, wikis, removable), col.mod)
+        if state is not None:
+            return state.plan
+
+    # Anki notes are only loaded in full if we can't tell they're unchanged.
+    store = FingerprintStore(fingerprint_path) if fingerprint_path else None
+    snapshot = load_snapshot(col, store.load() if store else None)
+    return plan_sync(tw_notes, snapshot, default_deck, wikis, removable)
+
+
+def apply_plan(plan: SyncPlan, tw_notes: Iterable[TwNote], col: Any,
+               default_deck: str, batch_size: int = BATCH_SIZE,
+               callback: Optional[ProgressCallback] = None,
+               fingerprint_path: Optional[Path] = None,
+               journal_path: Optional[Path] = None,
+               wikis: Optional[AbstractSet[str]] = None,
+               removable: Optional[AbstractSet[Twid]] = None) -> None:
     """
-    # Confusingly, col.decks.id returns the ID of an existing deck, and
-    # creates it if it doesn't exist. This happens to be exactly what we want.
-    deck_name = tw_note.target_deck or default_deck
-    new_did = col.decks.id(deck_name)
-    for card in anki_note.cards():
-        if card.did != new_did:
-            card.did = new_did
-            col.update_card(card)
+    Make the changes in a plan produced by make_plan() from the same notes.
+    Arguments are as for sync().
+    """
+    extracted: Dict[Twid, TwNote] = {n.id_: n for n in tw_notes}
 
+    # Media is written before anything else, so that if a file can't be
+    # retrieved, the sync stops without having changed the collection.
+    _add_media([extracted[twid] for twid in plan.adds]
+               + [extracted[ref.twid] for ref in plan.edits], col)
 
-def sync(tw_notes: Set[TwNote], col: Any, default_deck: str) -> str:
+    # Make sure the note types exist and haven't been modified in a way
+    # that could prevent the sync from working properly.
+    trmodels.ensure_note_types(col)
+    trmodels.verify_note_types(col)
+
+    journal = SyncJournal(journal_path) if journal_path is not None else None
+    if journal is not None:
+        state = journal.begin(
+            plan, _notes_key(extracted.values(), default_deck, wikis, removable), col.mod)
+    else:
+        state = JournalState(plan, 0, {})
+
+    progress = _Progress(callback, len(plan.adds) + len(plan.edits) + len(plan.removes))
+    skipped = max(0, state.done - len(plan.type_changes))
+    if skipped:
+        progress.advance(skipped)
+
+    # Fields can only be updated once notes have the right note type,
+    # so type changes come first.
+    deck_ids: Dict[str, int] = {}
+    added: Dict[Twid, NoteId] = dict(state.added)
+    done = state.done
+    for kind, chunk in _chunks(plan, batch_size, state.done):
+        new_nids: Dict[Twid, NoteId] = {}
+        if kind == 'retype':
+            _change_note_types(col, chunk)
+        elif kind == 'add':
+            new_nids = _add_notes([extracted[twid] for twid in chunk],
+                                  col, default_deck, deck_ids, batch_size, progress)
+            added.update(new_nids)
+        elif kind == 'edit':
+            _update_notes([(extracted[ref.twid], ref.nid) for ref in chunk],
+                          col, batch_size, progress)
+        else:
+            col.remove_notes(list(chunk))
+            progress.advance(len(chunk))
+
+        done += len(chunk)
+        if journal is not None:
+            journal.record(done, new_nids, col.mod)
+
+    # Updating a note can generate new cards (e.g., after a change of note
+    # type), so the cards of edited notes are checked along with those the
+    # plan found in the wrong deck. This is harmless to repeat, so it isn't
+    # journaled.
+    deck_targets: Dict[NoteId, str] = {
+        nid: move.deck for move in plan.deck_moves for nid in move.nids}
+    deck_targets.update((ref.nid, extracted[ref.twid].target_deck or default_deck)
+                        for ref in plan.edits)
+    moves = _misplaced_cards(deck_targets, col, deck_ids)
+    progress.total += sum(len(cids) for cids in moves.values())
+    _move_cards(moves, col, progress)
+
+    if fingerprint_path is not None:
+        synced = {ref.twid: ref.nid for ref in plan.edits + plan.unchanged}
+        synced.update(added)
+        _save_fingerprints(FingerprintStore(fingerprint_path), synced, extracted, col)
+    if journal is not None:
+        journal.clear()
+
+
+def sync(tw_notes: Set[TwNote], col: Any, default_deck: str,
+         batch_size: int = BATCH_SIZE,
+         callback: Optional[ProgressCallback] = None,
+         fingerprint_path: Optional[Path] = None,
+         journal_path: Optional[Path] = None,
+         wikis: Optional[AbstractSet[str]] = None,
+         removable: Optional[AbstractSet[Twid]] = None) -> str:
     """
     Compare TiddlyWiki notes with the notes currently in our Anki collection
     and add, edit, and remove notes as needed to get Anki in sync with the
@@ -105,6 +451,25 @@ def sync(tw_notes: Set[TwNote], col: Any, default_deck: str) -> str:
 
     :param twnotes: Set of TwNotes extracted from a TiddlyWiki.
     :param col: The Anki collection object.
+    :param default_deck: Deck to put notes in that don't specify one.
+    :param batch_size: Maximum number of notes to add or update in one call
+                       to the collection.
+    :param callback: If provided, called after each batch of changes with
+                     the number of notes added, updated, and removed and
+                     cards moved so far, and the total number that will be.
+    :param fingerprint_path: If provided, a file in which to remember the
+                             content of the synced notes, so that the next
+                             sync doesn't need to read unchanged notes.
+    :param journal_path: If provided, a file in which to record the progress
+                         of the sync, so that if it's interrupted, the next
+                         sync of the same notes can carry on where it left off.
+    :param wikis: If provided, the names of the wikis /tw_notes/ were
+                  extracted from, when they aren't all of the user's wikis.
+                  Only notes from these wikis are then removed from Anki.
+    :param removable: If provided, the IDs of the only notes that may be
+                      removed from Anki, when /tw_notes/ were extracted from
+                      just the tiddlers that changed (see
+                      twimport.find_changed_notes()).
     :return: A log string to pass back to the user, describing the results.
 
     .. warning::
@@ -122,58 +487,26 @@ def sync(tw_notes: Set[TwNote], col: Any, default_deck: str) -> str:
     Be aware that deleting a note from TiddlyWiki will permanently delete
     it from Anki.
     """
-    # Make sure the note types exist and haven't been modified in a way
-    # that could prevent the sync from working properly.
-    trmodels.ensure_note_types(col)
-    trmodels.verify_note_types(col)
+    plan = make_plan(tw_notes, col, default_deck, fingerprint_path, journal_path, wikis,
+                     removable)
+    apply_plan(plan, tw_notes, col, default_deck, batch_size, callback,
+               fingerprint_path, journal_path, wikis, removable)
+    return plan.summary()
 
-    # Retrieve Anki notes and TiddlyWiki notes and identify what adds, edits,
-    # and removes are needed to update the Anki collection.
-    extracted_notes: Set[TwNote] = tw_notes
-    extracted_twids: Set[Twid] = set(n.id_ for n in extracted_notes)
-    extracted_notes_map: Dict[Twid, TwNote] = {n.id_: n for n in extracted_notes}
-
-    model_search = ' or '.join(f'note:"{i.name}"' for i in trmodels.all_note_types())
-    anki_notes: Set[Note] = set(col.get_note(nid)
-                                for nid in col.find_notes(model_search))
-    id_field = trmodels.ID_FIELD_NAME
-    anki_twids: Set[Twid] = set(cast(Twid, n[id_field]) for n in anki_notes)
-    anki_notes_map: Dict[Twid, Note] = {cast(Twid, n[id_field]): n for n in anki_notes}
-
-    adds = extracted_twids.difference(anki_twids)
-    edits = extracted_twids.intersection(anki_twids)
-    removes = anki_twids.difference(extracted_twids)
-
-    userlog = []
-
-    # Make the changes to the collection.
-    for note_id in adds:
-        tw_note = extracted_notes_map[note_id]
-        n = Note(col, col.models.by_name(tw_note.model.name))
-        tw_note.update_fields(n)
-        deck = col.decks.id(tw_note.target_deck or default_deck)
-        col.add_note(n, deck)
-        _set_initial_scheduling(tw_note, n, col)
-        _add_media(tw_note, col)
-
-    userlog.append(f"Added {len(adds)} {pluralize('note', len(adds))}.")
-
-    edit_count = 0
-    for note_id in edits:
-        anki_note = anki_notes_map[note_id]
-        tw_note = extracted_notes_map[note_id]
-        if not tw_note.model_equal(anki_note):
-            new_note = _change_note_type(col, tw_note, anki_note)
-            anki_note = anki_notes_map[note_id] = new_note
-        if not tw_note.fields_equal(anki_note):
-            tw_note.update_fields(anki_note)
-            col.update_note(anki_note)
-            _add_media(tw_note, col)
-            edit_count += 1
-        _update_deck(tw_note, anki_note, col, default_deck)
-    userlog.append(f"Updated {edit_count} {pluralize('note', edit_count)}.")
 
-    col.remove_notes([anki_notes_map[twid].id for twid in removes])
-    userlog.append(f"Removed {len(removes)} {pluralize('note', len(removes))}.")
+@dataclass
+class SyncResult:
+    "The outcome of sync_op(), in the form Anki's CollectionOp expects."
+    changes: OpChanges
+    log: str
 
-    return '\n'.join(userlog)
+
+def sync_op(plan: SyncPlan, tw_notes: Set[TwNote], col: Any, default_deck: str,
+            **kwargs: Any) -> SyncResult:
+    """
+    Apply a plan as a single operation on the collection, which the user can
+    undo in one step. Other arguments are as for apply_plan().
+    """
+    undo_entry = col.add_custom_undo_entry(UNDO_NAME)
+    apply_plan(plan, tw_notes, col, default_deck, **kwargs)
+    return SyncResult(col.merge_undo_entries(undo_entry), plan.summary())
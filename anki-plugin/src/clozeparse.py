@@ -6,57 +6,39 @@ To change the argument of the remembercz TiddlyWiki macro into suitable
 text for the Text field of an Anki cloze note, simply call this function
 on that argument.
 """
-from collections import Counter
+from functools import lru_cache
 import itertools
 import re
-from typing import Iterable, List, Optional, Sequence
+from typing import Iterator, List, Optional, Set, Tuple
 
+#: An occlusion: a part of the text in {single braces}. Braces escaped with
+#: a backslash don't count, and occlusions don't span lines.
+_OCCLUSION = re.compile(r'(?<!\\){(.*?)(?<!\\)}')
 
-class Occlusion:
-    """
-    Representation of an occlusion -- a part within a remembercz TiddlyWiki note
-    that is in {single braces} and needs to become an Anki occlusion.
+#: The start of an occlusion that gives its cloze number explicitly.
+_EXPLICIT_INDEX = re.compile(r'c([1-9][0-9]*)::')
+
+#: A brace escaped with a backslash.
+_ESCAPED_BRACE = re.compile(r'\\([{}])')
+
+
+def _unescape(text: str) -> str:
+    "Remove the backslashes from escaped braces."
+    return _ESCAPED_BRACE.sub(r'\1', text) if '\\' in text else text
 
-    Constructed from a placeholder index (this will be used to substitute the
-    occlusion back into the text of the note once parsing is done) and raw_text
-    (the part that was between the {braces} in the original user-entered text).
+
+def _unused_numbers(used: Set[int]) -> Iterator[int]:
     """
-    def __init__(self, placeholder_index: int, raw_text: str) -> None:
-        self.placeholder_index = placeholder_index
-        self.raw_text = raw_text
-        self.text: Optional[str] = None
-        self.anki_index: Optional[int] = None
-        self._parse_text()
-
-    @property
-    def placeholder(self) -> str:
-        "A Python format-string placeholder for this occlusion."
-        return "©<%i>©" % self.placeholder_index  # pylint: disable=consider-using-f-string
-
-    @property
-    def anki_occlusion(self) -> str:
-        """
-        This occlusion, in the form that Anki understands.
-
-        The caller must ensure that it has filled in self.anki_index if this
-        Occlusion was originally constructed from an implicitly numbered
-        occlusion (one that looks like {this}, rather than an {{c1::explicit
-        occlusion}}).
-        """
-        assert self.anki_index is not None, \
-            "Tried to render occlusion before filling in missing index!"
-        return "{{c%i::%s}}" % (self.anki_index, self.text)  # pylint: disable=consider-using-f-string
-
-    def _parse_text(self) -> None:
-        "Fill text and maybe anki_index field from raw_text."
-        m = re.match(r'^c(?P<index>[1-9][0-9]*)::(?P<text>.*)', self.raw_text)
-        if m:
-            self.anki_index = int(m.group('index'))
-            self.text = m.group('text')
-        else:
-            self.text = self.raw_text
+    Return natural numbers not present in /used/, starting from 1. First any
+    gaps below the largest number used are filled, then we count upwards to
+    infinity.
+    """
+    top = max(used, default=0)
+    yield from (i for i in range(1, top) if i not in used)
+    yield from itertools.count(top + 1)
 
 
+@lru_cache(maxsize=4096)
 def ankify_clozes(text: str) -> str:
     r"""
     Given some text in TiddlyRemember simplified cloze format, convert it to
@@ -116,45 +98,41 @@ def ankify_clozes(text: str) -> str:
         'This is the {{c3::first}} cloze.'
 
         (That one's weird but totally acceptable to Anki.)
+
+    The text is converted in a single pass, and the results for recently
+    converted texts are remembered, since transclusion makes the same cloze
+    notes turn up in many tiddlers.
     """
-    def next_occlusion_number(seq: Sequence[int]) -> Iterable[int]:
-        """
-        Return natural numbers not yet present in the sequence,
-        starting from 1. First any gaps in the sequence are filled,
-        then we count upwards to infinity.
-        """
-        if not seq:
-            return itertools.count(1, 1)
+    if '{' not in text:
+        return _unescape(text)
+
+    # Find the occlusions, with their explicit cloze numbers where they have
+    # them. Escaped braces only need unescaping once the Anki text is built,
+    # as the backslash before an escaped brace is never at the edge of an
+    # occlusion.
+    matches = list(_OCCLUSION.finditer(text))
+    if not matches:
+        return _unescape(text)
+    occlusions: List[Tuple[Optional[int], str]] = []
+    for match in matches:
+        content = match.group(1)
+        explicit = _EXPLICIT_INDEX.match(content)
+        if explicit:
+            occlusions.append((int(explicit.group(1)), content[explicit.end():]))
         else:
-            c = Counter(seq)  # create dict of elements to number of occurrences
-            return itertools.chain(
-                (i for i in range(1, max(seq)) if c[i] == 0),
-                itertools.count(max(seq)+1, 1))
-
-    # Parse out the occlusions and put in clean Python-style placeholders.
-    occlusions: List[Occlusion] = []
-    def mark_occlusion(match):
-        "Save the contents of an occlusion section, then substitute in a placeholder."
-        o = Occlusion(len(occlusions), match.group(1))
-        occlusions.append(o)
-        return o.placeholder
-    placeholder_text = re.sub(r'(?<!\\){(.*?)(?<!\\)}', mark_occlusion, text)
-
-    # Fill in cloze numbers for occlusions that used the implicit syntax.
-    deferred_mappings = [o for o in occlusions
-                         if o.anki_index is None]
-    used_occlusion_numbers = [o.anki_index for o in occlusions
-                              if o.anki_index is not None]
-    for index, occlusion in zip(next_occlusion_number(used_occlusion_numbers),
-                                deferred_mappings):
-        occlusion.anki_index = index
-
-    # Replace placeholders with the cleansed, explicified, Anki-format occlusions.
-    occ_lookup = {o.placeholder_index: o for o in occlusions}
-    def replace_placeholder(match):
-        return occ_lookup[int(match.group(1))].anki_occlusion
-    cloze_text = re.sub(r'©<([0-9]+)>©', replace_placeholder, placeholder_text)
-    return re.sub(r'\\([{}])', r'\1', cloze_text)
+            occlusions.append((None, content))
+
+    # Occlusions that used the implicit syntax get the first unused numbers.
+    numbers = _unused_numbers({i for i, _ in occlusions if i is not None})
+    result = []
+    pos = 0
+    for match, (index, occluded) in zip(matches, occlusions):
+        if index is None:
+            index = next(numbers)
+        result.extend((text[pos:match.start()], "{{c", str(index), "::", occluded, "}}"))
+        pos = match.end()
+    result.append(text[pos:])
+    return _unescape(''.join(result))
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -0,0 +1,72 @@
+"""
+fingerprints.py - remember what TiddlyRemember last wrote to each Anki note
+
+Deciding whether an Anki note needs to be updated normally means loading its
+fields and comparing each of them to the TiddlyWiki note. Instead, after each
+sync we store a digest of the content of every TiddlyRemember note (see
+TwNote.digest) together with the note's modification time. On the next sync,
+a note whose modification time hasn't changed still contains exactly what we
+wrote, so comparing the stored digest with that of the TiddlyWiki note tells
+us whether it needs an update, without loading its fields at all.
+
+The fingerprints are kept in a small SQLite database outside the collection.
+It's only ever a cache: if it is missing, out of date, or unreadable, notes
+are simply compared field by field as usual.
+"""
+from contextlib import closing
+from pathlib import Path
+import sqlite3
+from typing import Dict, NamedTuple
+
+# anki.collection must be imported before anki.notes to avoid a circular import.
+import anki.collection  # pylint: disable=unused-import
+from anki.notes import NoteId
+
+from .util import Twid
+
+
+class Fingerprint(NamedTuple):
+    "What we know about the content of an Anki note as of the last sync."
+    twid: Twid   #: The TiddlyRemember ID of the note.
+    mod: int     #: The note's modification time right after the sync.
+    digest: str  #: The TwNote.digest of the content written to the note.
+    wiki: str    #: The name of the wiki the note came from.
+
+
+class FingerprintStore:
+    """
+    The fingerprints of the TiddlyRemember notes in one collection.
+
+    :param path: The SQLite database to keep the fingerprints in.
+                 It's created when first saved.
+    """
+    VERSION = 2
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def load(self) -> Dict[NoteId, Fingerprint]:
+        "Return the fingerprints saved by the last sync, by note ID."
+        if not self.path.exists():
+            return {}
+        try:
+            with closing(sqlite3.connect(str(self.path))) as db:
+                if db.execute("pragma user_version").fetchone()[0] != self.VERSION:
+                    return {}
+                return {NoteId(nid): Fingerprint(Twid(twid), mod, digest, wiki)
+                        for nid, twid, mod, digest, wiki
+                        in db.execute("select nid, twid, mod, digest, wiki "
+                                      "from fingerprints")}
+        except sqlite3.Error:
+            return {}
+
+    def save(self, fingerprints: Dict[NoteId, Fingerprint]) -> None:
+        "Replace the stored fingerprints with /fingerprints/."
+        with closing(sqlite3.connect(str(self.path))) as db, db:
+            db.execute("drop table if exists fingerprints")
+            db.execute("create table fingerprints (nid integer primary key, "
+                       "twid text not null, mod integer not null, "
+                       "digest text not null, wiki text not null)")
+            db.executemany("insert into fingerprints values (?, ?, ?, ?, ?)",
+                           ((nid, *fp) for nid, fp in fingerprints.items()))
+            db.execute(f"pragma user_version = {self.VERSION}")
@@ -0,0 +1,231 @@
+"""
+folderwatch.py - notice which tiddlers of a folder wiki have changed
+
+A folder wiki keeps its tiddlers in files under its tiddlers/ folder, mostly
+one .tid file per tiddler, with the title in the file's header. To sync
+edits as they're made (see watcher.py), we take a snapshot of the size and
+modification time of every file there, together with the titles of the
+tiddlers each holds, and compare it with a fresh one whenever something may
+have changed. The titles are only read again from files that have changed,
+so that a new snapshot costs little more than listing the folder.
+
+On Linux, the Inotify class tells us when something may have changed;
+elsewhere, the snapshot is simply taken again every few seconds.
+"""
+import ctypes
+import ctypes.util
+import os
+from pathlib import Path
+import re
+import struct
+import sys
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+#: Files TiddlyWiki never loads as tiddlers (see $tw.boot.excludeRegExp),
+#: apart from .meta files, which hold the fields of the file beside them.
+_EXCLUDED_FILE = re.compile(
+    r'^\.DS_Store$|^\..*\.swp$|^\._.*$|^\.git$|^\.hg$|^\.lock-wscript$'
+    r'|^\.svn$|^\.wafpickle-.*$|^CVS$|^npm-debug\.log$')
+
+
+class TiddlerFile(NamedTuple):
+    "What we know about one file in the tiddlers folder of a wiki."
+    mtime_ns: int
+    size: int
+    #: Titles of the tiddlers the file holds, or None if we can't tell.
+    titles: Optional[Tuple[str, ...]]
+
+
+#: Files in a tiddlers folder by their path relative to it.
+FolderSnapshot = Dict[str, TiddlerFile]
+
+
+def tiddlers_folder(wiki_path: str) -> Path:
+    "Return the folder holding the tiddlers of the folder wiki at /wiki_path/."
+    return Path(wiki_path) / "tiddlers"
+
+
+def _header_title(path: Path) -> Optional[str]:
+    "Return the title field in the header of a .tid or .meta file, if it has one."
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(65536).split(b'\n\n', 1)[0].decode('utf-8')
+    except (OSError, UnicodeDecodeError):
+        return None
+    for line in header.replace('\r', '').split('\n'):
+        name, sep, value = line.partition(':')
+        if sep and name.strip() == 'title':
+            return value.strip()
+    return None
+
+
+def read_titles(path: Path) -> Optional[Tuple[str, ...]]:
+    """
+    Return the titles of the tiddlers stored in the file /path/, or None if
+    they can't be told without loading it the way TiddlyWiki does, as for
+    JSON files and files without a title field.
+    """
+    if path.suffix in ('.tid', '.meta'):
+        title = _header_title(path)
+    else:
+        meta = path.with_name(path.name + '.meta')
+        title = _header_title(meta) if meta.exists() else None
+    return None if title is None else (title,)
+
+
+def scan(folder: Path, previous: Optional[FolderSnapshot] = None) -> FolderSnapshot:
+    """
+    Take a snapshot of the files in a tiddlers folder. Titles are taken from
+    /previous/ for files whose size and modification time haven't changed.
+    """
+    previous = previous or {}
+    snapshot: FolderSnapshot = {}
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames[:] = [d for d in dirnames if not _EXCLUDED_FILE.match(d)]
+        for name in filenames:
+            if _EXCLUDED_FILE.match(name):
+                continue
+            path = Path(dirpath, name)
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            key = path.relative_to(folder).as_posix()
+            before = previous.get(key)
+            if before is not None and (before.mtime_ns, before.size) == (st.st_mtime_ns,
+                                                                         st.st_size):
+                snapshot[key] = before
+            else:
+                snapshot[key] = TiddlerFile(st.st_mtime_ns, st.st_size, read_titles(path))
+    return snapshot
+
+
+def changed_titles(old: FolderSnapshot, new: FolderSnapshot) -> Optional[Set[str]]:
+    """
+    Return the titles of the tiddlers added, changed or deleted between two
+    snapshots of a tiddlers folder, or None if a file we can't read the
+    titles of has changed.
+
+    >>> old = {'A.tid': TiddlerFile(1, 10, ('A',)), 'B.tid': TiddlerFile(1, 10, ('B',))}
+    >>> sorted(changed_titles(old, {'A.tid': TiddlerFile(2, 12, ('A',)),
+    ...                             'C.tid': TiddlerFile(2, 10, ('C',))}))
+    ['A', 'B', 'C']
+    >>> changed_titles(old, dict(old))
+    set()
+    >>> print(changed_titles(old, {**old, 'x.json': TiddlerFile(2, 10, None)}))
+    None
+    """
+    changed: Set[str] = set()
+    for name in old.keys() | new.keys():
+        before, after = old.get(name), new.get(name)
+        if before == after:
+            continue
+        for entry in (before, after):
+            if entry is None:
+                continue
+            if entry.titles is None:
+                return None
+            changed.update(entry.titles)
+    return changed
+
+
+# Constants from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    Watch a folder and the folders within it for changes to their files with
+    Linux's inotify. Only the fact that something changed is reported, so
+    the events need not be examined beyond finding new folders to watch.
+
+    :raises OSError: If inotify isn't available, or the folder can't be watched.
+    """
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+            | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    def __init__(self, folder: Path) -> None:
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._folders: Dict[int, str] = {}
+        try:
+            for dirpath, dirnames, _ in os.walk(folder):
+                dirnames[:] = [d for d in dirnames if not _EXCLUDED_FILE.match(d)]
+                self._watch(dirpath)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch(self, folder: str) -> None:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), folder)
+        self._folders[wd] = folder
+
+    def fileno(self) -> int:
+        "The file descriptor that becomes readable when something has changed."
+        return self.fd
+
+    def read(self) -> bool:
+        """
+        Read the events waiting, starting to watch any folders created in
+        those being watched. Return True if any files may have changed.
+        """
+        events: List[Tuple[int, int, bytes]] = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset+length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, name))
+
+        changed = False
+        for wd, mask, name in events:
+            if mask & IN_IGNORED:
+                self._folders.pop(wd, None)
+                continue
+            changed = True
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in self._folders:
+                new_folder = os.path.join(self._folders[wd], os.fsdecode(name))
+                try:
+                    for dirpath, _, _ in os.walk(new_folder):
+                        self._watch(dirpath)
+                except OSError:
+                    pass
+        return changed
+
+    def close(self) -> None:
+        "Stop watching."
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
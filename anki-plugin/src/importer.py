@@ -9,23 +9,29 @@ The import process has three broad stages:
    filter is rendered through the TiddlyRemember template to HTML and parsed by
    TiddlyRemember note type classes. These classes output zero or more TiddlyRemember
    notes for each tiddler, and these notes are gathered together into a set.
+   If the wiki hasn't changed since it was last extracted, perhaps ahead of
+   time while Anki was idle (see prefetch.py), the notes found then are
+   used instead, so this stage is over almost at once.
 3. **Syncing**: The TiddlyRemember notes are compared to the notes in the user's Anki
    collection, and notes in the user's Anki collection are added, updated, or deleted
    to match the set of TiddlyRemember notes.
 
 Extraction is carried out by the `:meth:extract()` method of :class:`ImportDialog()`,
 which relies primarily on `:meth:twimport.find_notes()`,
-while syncing is carried out in the `:meth:join_thread()` method
-of :class:`ImportDialog()`, which relies primarily on :meth:`ankisync.sync()`.
+while syncing is carried out in the `:meth:sync()` method
+of :class:`ImportDialog()`, which plans the changes with :meth:`ankisync.make_plan()`
+and then applies them in the background through :meth:`ankisync.sync_op()`.
 """
 from __future__ import annotations
 
 import re
-from typing import Dict, List, Optional, Set
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
+from aqt.errors import show_exception
+from aqt.operations import CollectionOp, QueryOp
 from aqt.utils import askUser, showText, showWarning, tooltip
 # pylint: disable=import-error, no-name-in-module
-from aqt.qt import QDialog, QThread, pyqtSignal
+from aqt.qt import QDialog, QObject, QThread, pyqtSignal
 
 from aqt.qt import qtmajor
 if qtmajor > 5:
@@ -37,9 +43,10 @@ else:
 from . import ankisync
 from .oops import ConfigurationError, RenderingError, TiddlerParsingError
 from .parsing_error import ParsingErrorDialog
+from .syncplan import SyncPlan
 from . import twimport
 from .twnote import TwNote
-from .util import pluralize
+from .util import cache_path, pluralize, user_files_dir
 
 
 class ImportThread(QThread):
@@ -48,11 +55,13 @@ class ImportThread(QThread):
     """
     progress_update = pyqtSignal(int, int)
 
-    def __init__(self, conf: dict, wiki_name: str, wiki_conf: Dict[str, str]) -> None:
-        super().__init__()
+    def __init__(self, conf: dict, wiki_name: str, wiki_conf: Dict[str, str],
+                 parent: Optional[QObject] = None, low_priority: bool = False) -> None:
+        super().__init__(parent)
         self.conf = conf
         self.wiki_name = wiki_name
         self.wiki_conf = wiki_conf
+        self.low_priority = low_priority
         self.notes: Optional[Set[TwNote]] = None
         self.exception: Optional[Exception] = None
         self.warnings: List[str] = []
@@ -69,6 +78,8 @@ class ImportThread(QThread):
                 password=self.wiki_conf.get('password', ''),
                 callback=self.progress_update.emit,
                 warnings=self.warnings,
+                cache_dir=str(user_files_dir()),
+                low_priority=self.low_priority,
             )
             for n in self.notes:
                 wiki_url = self.wiki_conf.get('permalink', '')
@@ -83,19 +94,35 @@ class ImportDialog(QDialog):
     Dialog implementing asynchronous extraction from TiddlyWiki,
     followed by synchronization with an Anki collection.
     """
-    def __init__(self, mw) -> None:
+    def __init__(self, mw, wiki_names: Optional[Iterable[str]] = None) -> None:
+        """
+        :param wiki_names: If provided, only extract and sync notes from the
+                           configured wikis with these names.
+        """
         QDialog.__init__(self)
         self.form = import_dialog.Ui_Dialog()
         self.form.setupUi(self)
         self.conf = mw.addonManager.getConfig(__name__)
         self.mw = mw
 
-        self.extract_thread: Optional[ImportThread] = None
         self.notes: Set[TwNote] = set()
         self.warnings: List[str] = []
-        self.wikis = list(self.conf['wikis'].items())
+        self.scope: Optional[Set[str]] = None if wiki_names is None else set(wiki_names)
+        self.wikis = [(name, wiki_conf) for name, wiki_conf in self.conf['wikis'].items()
+                      if self.scope is None or name in self.scope]
         self.form.wikiProgressBar.setMaximum(len(self.wikis))
 
+        #: Wikis still waiting to be extracted, taken from the end.
+        self.pending = list(self.wikis)
+        #: Threads currently extracting wikis, by wiki name.
+        self.threads: Dict[str, ImportThread] = {}
+        #: Notes and warnings from the wikis that have been extracted, by wiki name.
+        self.results: Dict[str, Tuple[Set[TwNote], List[str]]] = {}
+        #: Tiddlers processed and total tiddlers for each wiki being extracted,
+        #: or None if it's still being rendered.
+        self.wiki_progress: Dict[str, Optional[Tuple[int, int]]] = {}
+        self.aborted = False
+
     def start_import(self) -> bool:
         """
         Check to make sure import is configured correctly and begin
@@ -104,7 +131,8 @@ class ImportDialog(QDialog):
         """
         # Catch scenario where user tries to sync without configuring and provide
         # a helpful error message.
-        if len(self.wikis) == 1 and not self.wikis[0][1]['path'].strip():
+        if (not self.wikis
+                or (len(self.wikis) == 1 and not self.wikis[0][1]['path'].strip())):
             showWarning("You don't appear to have set up any wikis to sync with. "
                         "To do so, choose Tools > Add-ons, select TiddlyRemember, "
                         "and click the Config button.")
@@ -113,34 +141,66 @@ class ImportDialog(QDialog):
         self.extract()
         return True
 
-    def extract_progress(self, at: int, end: int) -> None:
+    def extract_progress(self, wiki_name: str, at: int, end: int) -> None:
         "Progress callback function for export/parse triggered by progress signal."
+        self.wiki_progress[wiki_name] = (at, end)
+        self.show_extract_progress()
+
+    def show_extract_progress(self) -> None:
+        """
+        Describe the progress of each wiki being extracted in the dialog's text,
+        and show the combined progress of those that have been rendered.
+        """
+        lines = []
+        for wiki_name, progress in sorted(self.wiki_progress.items()):
+            if progress is None:
+                lines.append(f"Exporting tiddlers from {wiki_name}...")
+            else:
+                at, end = progress
+                lines.append(f"Extracting notes from {wiki_name}...{at}/{end}")
+        self.form.text.setText('\n'.join(lines))
+
+        rendered = [p for p in self.wiki_progress.values() if p is not None]
+        if not rendered:
+            self.form.progressBar.setMaximum(0)
+            return
+        at = sum(p[0] for p in rendered)
+        end = sum(p[1] for p in rendered)
         self.form.progressBar.setMaximum(100)
-        self.form.text.setText(f"Extracting notes from tiddlers...{at}/{end}")
         if end == 0:
             # Obviously this will be done *real* soon...but don't want an exception!
             self.form.progressBar.setValue(100)
         else:
-            self.form.progressBar.setValue(at * 100 / end)
+            self.form.progressBar.setValue(at * 100 // end)
 
     def extract(self) -> None:
         """
-        Extract questions from a TiddlyWiki using Node. When done, proceed to
-        sync with Anki.
+        Extract questions from TiddlyWikis using Node, starting as many
+        extractions at once as the 'extractConcurrency' option allows.
+        As each finishes, the next is started. When all are done,
+        proceed to sync with Anki.
         """
-        wiki_name, wiki_conf = self.wikis.pop()
-
-        self.form.text.setText(f"Exporting tiddlers from {wiki_name}...")
-        self.form.progressBar.setMaximum(0)
-
-        self.extract_thread = ImportThread(self.conf, wiki_name, wiki_conf)
-        self.extract_thread.finished.connect(self.join_thread)  # type: ignore
-        self.extract_thread.progress_update.connect(self.extract_progress)
-        self.extract_thread.start()
-
-    def handle_thread_exception(self) -> bool:
+        limit = max(1, int(self.conf['extractConcurrency']))
+        while self.pending and len(self.threads) < limit:
+            wiki_name, wiki_conf = self.pending.pop()
+            # The thread is owned by the main window, so that it's not destroyed
+            # while still running if the dialog is closed because another wiki
+            # failed.
+            thread = ImportThread(self.conf, wiki_name, wiki_conf, parent=self.mw)
+            thread.finished.connect(  # type: ignore
+                lambda thread=thread: self.join_thread(thread))
+            thread.finished.connect(thread.deleteLater)  # type: ignore
+            thread.progress_update.connect(
+                lambda at, end, wiki_name=wiki_name:
+                self.extract_progress(wiki_name, at, end))
+            self.threads[wiki_name] = thread
+            self.wiki_progress[wiki_name] = None
+            thread.start()
+        self.show_extract_progress()
+
+    def handle_thread_exception(self, thread: ImportThread) -> bool:
         """
-        Try to handle exceptions that took place during the thread's execution,
+        Try to handle exceptions that took place during a thread's execution,
         if any.
 
         Three possible results:
@@ -150,15 +210,12 @@ class ImportDialog(QDialog):
             - There was an exception we didn't know how to handle:
               the exception is reraised.
         """
-        assert self.extract_thread is not None, \
-            "Tried to handle exceptions on a nonexistent thread!"
-
-        exc = self.extract_thread.exception
+        exc = thread.exception
         if exc:
-            self.reject()
+            self.abort()
 
             if isinstance(exc, ConfigurationError):
-                showWarning(str(self.extract_thread.exception))
+                showWarning(str(thread.exception))
             elif isinstance(exc, RenderingError) and 'ENAMETOOLONG' in str(exc):
                 msg = ("It looks like your wiki may contain a tiddler with an "
                        "extremely long name, which cannot be synced due to "
@@ -184,63 +241,129 @@ class ImportDialog(QDialog):
             return True
         return False
 
-    def join_thread(self) -> None:
+    def abort(self) -> None:
+        """
+        Close the dialog without syncing. Extractions still running are left
+        to finish in the background, and their results are ignored.
+        """
+        self.aborted = True
+        self.pending.clear()
+        self.reject()
+
+    def join_thread(self, thread: ImportThread) -> None:
         """
         Gather up the results of a completed extract thread, and start the next one
         if appropriate.
         """
-        assert self.extract_thread is not None, "Tried to join a nonexistent thread!"
+        del self.threads[thread.wiki_name]
+        del self.wiki_progress[thread.wiki_name]
+        if self.aborted:
+            return None
 
-        if self.handle_thread_exception():
+        if self.handle_thread_exception(thread):
             return None
 
-        if not self.extract_thread.notes:
+        if not thread.notes:
             # This is probably a mistake or misconfiguration. To avoid deleting
             # all the user's existing notes to "sync" the collection, abort now.
             showWarning(
-                f"No notes were found in the wiki {self.extract_thread.wiki_name}. "
+                f"No notes were found in the wiki {thread.wiki_name}. "
                 f"Please check your add-on configuration. "
                 f"Your collection has not been updated.")
-            self.reject()
+            self.abort()
             return None
 
-        # This is a set union, with object equality defined by the ID. Any
-        # notes with an ID matching one already used in a previous wiki will be
-        # discarded here.
-        self.notes.update(self.extract_thread.notes)
-        self.warnings.extend(self.extract_thread.warnings)
-
-        self.form.wikiProgressBar.setValue(self.form.wikiProgressBar.value() + 1)
-        if self.wikis:
+        self.results[thread.wiki_name] = (thread.notes, thread.warnings)
+        self.form.wikiProgressBar.setValue(len(self.results))
+        if self.pending or self.threads:
             # If there are any more wikis, handle the next one.
-            # Eventually, parallelizing this might be nice
-            # (might also not improve performance).
             return self.extract()
+
+        # When all are completed, gather the results in the same order
+        # regardless of which wiki finished first. This is a set union, with
+        # object equality defined by the ID. Any notes with an ID matching one
+        # already used in a wiki later in the configuration will be discarded here.
+        for wiki_name, _ in reversed(self.wikis):
+            notes, warnings = self.results[wiki_name]
+            self.notes.update(notes)
+            self.warnings.extend(warnings)
+        # The per-wiki sets are no longer needed, and can be large.
+        self.results.clear()
+
+        if self.warnings:
+            showText(
+                f"*** {len(self.warnings)} "
+                f"{pluralize('warning', len(self.warnings))}: ***\n"
+                + '\n'.join(self.warnings)
+            )
+        if (not self.warnings) or askUser("Continue syncing?"):
+            return self.sync()
         else:
-            # When all are completed...
-            if self.warnings:
-                showText(
-                    f"*** {len(self.warnings)} "
-                    f"{pluralize('warning', len(self.warnings))}: ***\n"
-                    + '\n'.join(self.warnings)
-                )
-            if (not self.warnings) or askUser("Continue syncing?"):
-                return self.sync()
-            else:
-                self.accept()
-                self.mw.reset()
-                return tooltip("Sync canceled.")
+            self.accept()
+            self.mw.reset()
+            return tooltip("Sync canceled.")
+
+    def sync_progress(self, done: int, total: int) -> None:
+        "Progress callback for the sync, which runs on a background thread."
+        def update() -> None:
+            self.form.progressBar.setMaximum(total)
+            self.form.progressBar.setValue(done)
+            self.form.text.setText(
+                f"Applying note changes to your collection...{done}/{total}")
+        self.mw.taskman.run_on_main(update)
 
     def sync(self) -> None:
         """
         Compare the notes gathered by the various wiki threads with the notes
         currently in our Anki collection and add, edit, and remove notes as needed
         to get Anki in sync with the TiddlyWiki notes.
+
+        The changes are made in the background, as a single operation that
+        can be undone in one step. If note types need to be changed, which
+        forces a full sync with AnkiWeb, the user is asked to confirm first.
+        If a previous sync was interrupted, it's resumed where it left off.
+        If only some wikis were extracted, only notes from those wikis are
+        removed from the collection.
         """
         self.form.progressBar.setMaximum(0)
-        self.form.text.setText("Applying note changes to your collection...")
-        userlog = ankisync.sync(self.notes, self.mw.col, self.conf['defaultDeck'])
-
+        self.form.text.setText("Comparing notes with your collection...")
+        fingerprint_path = cache_path(user_files_dir(), 'fingerprints',
+                                      self.mw.col.path, 'sqlite')
+        journal_path = cache_path(user_files_dir(), 'journal',
+                                  self.mw.col.path, 'sqlite')
+
+        def apply(plan: SyncPlan) -> None:
+            if plan.type_changes and not self.mw.confirm_schema_modification():
+                self.accept()
+                tooltip("Sync canceled.")
+                return
+
+            self.form.text.setText("Applying note changes to your collection...")
+            CollectionOp(
+                parent=self,
+                op=lambda col: ankisync.sync_op(
+                    plan, self.notes, col, self.conf['defaultDeck'],
+                    batch_size=self.conf['syncBatchSize'],
+                    callback=self.sync_progress,
+                    fingerprint_path=fingerprint_path,
+                    journal_path=journal_path,
+                    wikis=self.scope)
+            ).success(self.sync_done).failure(self.sync_failed).run_in_background()
+
+        QueryOp(
+            parent=self,
+            op=lambda col: ankisync.make_plan(
+                self.notes, col, self.conf['defaultDeck'], fingerprint_path,
+                journal_path, self.scope),
+            success=apply,
+        ).failure(self.sync_failed).run_in_background()
+
+    def sync_done(self, result: ankisync.SyncResult) -> None:
+        "Close the dialog and report the results once the sync has completed."
         self.accept()
-        self.mw.reset()
-        tooltip(userlog)
+        tooltip(result.log)
+
+    def sync_failed(self, exc: Exception) -> None:
+        "Close the dialog and report an error that occurred during the sync."
+        self.reject()
+        show_exception(parent=self.mw, exception=exc)
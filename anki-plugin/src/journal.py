@@ -0,0 +1,123 @@
+"""
+journal.py - keep track of how far through a sync we've got
+
+A large sync is applied to the collection in chunks (see ankisync.apply_plan()),
+each of which is saved by Anki as soon as it's done. After each chunk, we note
+in a journal how many of the plan's changes have been made and the collection's
+modification time at that point. If the sync is interrupted -- Anki is closed
+or crashes -- the next sync of the same notes picks the plan up from the
+journal and carries on where the last complete chunk left off, instead of
+comparing every note again and starting over.
+
+The journal is only trusted if nothing has changed since it was written: the
+TiddlyWiki notes must be identical (compared with a key computed from their
+digests) and the collection must not have been modified since the last chunk
+was recorded. Otherwise it's discarded and the sync is planned from scratch,
+which is always safe, since changes already made are simply found to be
+unnecessary. Like fingerprints.py, the journal is kept in a small SQLite
+database outside the collection and is deleted once the sync completes.
+"""
+from contextlib import closing
+from pathlib import Path
+import sqlite3
+from typing import Dict, NamedTuple, Optional
+
+# anki.collection must be imported before anki.notes to avoid a circular import.
+import anki.collection  # pylint: disable=unused-import
+from anki.notes import NoteId
+
+from .syncplan import SyncPlan
+from .util import Twid
+
+
+class JournalState(NamedTuple):
+    "An interrupted sync, as recorded in the journal."
+    plan: SyncPlan             #: The plan being applied.
+    done: int                  #: Number of the plan's changes already made.
+    added: Dict[Twid, NoteId]  #: Anki notes created by the changes made so far.
+
+
+class SyncJournal:
+    """
+    The progress of the sync currently being applied to one collection.
+
+    :param path: The SQLite database to keep the journal in.
+                 It's created when a sync begins and deleted when it completes.
+    """
+    VERSION = 1
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def pending(self, key: str, col_mod: int) -> Optional[JournalState]:
+        """
+        Return the state of an interrupted sync that can be resumed, or None.
+
+        :param key:     Identifies the TiddlyWiki notes being synced.
+        :param col_mod: The collection's current modification time.
+        """
+        if not self.path.exists():
+            return None
+        try:
+            with closing(sqlite3.connect(str(self.path))) as db:
+                if db.execute("pragma user_version").fetchone()[0] != self.VERSION:
+                    return None
+                row = db.execute("select key, plan, done, mod from journal").fetchone()
+                if row is None or row[0] != key or row[3] != col_mod:
+                    return None
+                added = {Twid(twid): NoteId(nid)
+                         for twid, nid in db.execute("select twid, nid from added")}
+                return JournalState(SyncPlan.from_json(row[1]), row[2], added)
+        except (sqlite3.Error, ValueError, KeyError):
+            return None
+
+    def interrupted(self, col_mod: int) -> bool:
+        """
+        Return True if a sync of any notes was interrupted and could still
+        be resumed, because the collection hasn't been modified since.
+        """
+        if not self.path.exists():
+            return False
+        try:
+            with closing(sqlite3.connect(str(self.path))) as db:
+                if db.execute("pragma user_version").fetchone()[0] != self.VERSION:
+                    return False
+                row = db.execute("select mod from journal").fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None and row[0] == col_mod
+
+    def begin(self, plan: SyncPlan, key: str, col_mod: int) -> JournalState:
+        """
+        Start applying /plan/. If the journal shows that the same plan was
+        interrupted and it can be resumed, return how far it got; otherwise,
+        start a new journal and return a state with nothing done yet.
+        """
+        state = self.pending(key, col_mod)
+        if state is not None and state.plan == plan:
+            return state
+
+        with closing(sqlite3.connect(str(self.path))) as db, db:
+            db.execute("drop table if exists journal")
+            db.execute("drop table if exists added")
+            db.execute("create table journal (key text not null, plan text not null, "
+                       "done integer not null, mod integer not null)")
+            db.execute("create table added (twid text primary key, nid integer not null)")
+            db.execute("insert into journal values (?, ?, 0, ?)",
+                       (key, plan.to_json(), col_mod))
+            db.execute(f"pragma user_version = {self.VERSION}")
+        return JournalState(plan, 0, {})
+
+    def record(self, done: int, added: Dict[Twid, NoteId], col_mod: int) -> None:
+        """
+        Record that the first /done/ changes in the plan have been made,
+        leaving the collection with the modification time /col_mod/.
+        /added/ holds any notes created by the latest chunk.
+        """
+        with closing(sqlite3.connect(str(self.path))) as db, db:
+            db.executemany("insert or replace into added values (?, ?)", added.items())
+            db.execute("update journal set done = ?, mod = ?", (done, col_mod))
+
+    def clear(self) -> None:
+        "Forget the sync, once it has been completed."
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,388 @@
+"""
+media.py - media files referenced by TiddlyWiki notes
+
+Media referenced from a note's fields (images, audio) is renamed according to
+a hash of its content when it's brought into Anki. Working out that hash is
+the only thing extraction really needs to do with a medium, since it determines
+the filename written into the note's fields; the content itself is only
+needed if the note ends up being written to the collection and Anki doesn't
+already have the file. TwMedia therefore reads its content lazily, and a
+MediaCache remembers the hashes of media we've seen before so that unchanged
+media doesn't have to be read at all.
+
+Media embedded in the wiki itself (images pasted into tiddlers, or image
+tiddlers in general) arrives as data: URIs, which are decoded and hashed
+directly rather than being passed through urlopen(). So that notes (and the
+caches holding them) don't carry those URIs around, which can be megabytes
+long, a MediaCache with a file decodes each into a file beside it, which the
+medium then refers to instead.
+"""
+import binascii
+import hashlib
+import json
+import mimetypes
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from urllib.error import HTTPError
+from urllib.parse import unquote_to_bytes, urlparse
+from urllib.request import Request, url2pathname, urlopen
+
+from anki.collection import Collection
+
+
+#: (modification time in ns, size) of a local file, or None if not a local file
+Validator = Optional[Tuple[int, int]]
+
+#: The ETag and Last-Modified headers returned with remote media, if any.
+RemoteValidators = Dict[str, str]
+
+#: Number of characters of a data: URI to decode at a time.
+DATA_URI_CHUNK_SIZE = 1 << 18
+
+#: Bytes binascii.a2b_base64() skips over, which we remove before splitting into chunks.
+_NON_BASE64_BYTES = bytes(
+    set(range(256))
+    - set(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="))
+
+
+def _split_data_uri(source: str) -> Tuple[str, bool, str]:
+    """
+    Split a data: URI into its media type, whether it's base64-encoded,
+    and its (still encoded) payload.
+
+    >>> _split_data_uri("data:image/png;base64,iVBO")
+    ('image/png', True, 'iVBO')
+
+    >>> _split_data_uri("data:,Hello%2C%20World")
+    ('text/plain', False, 'Hello%2C%20World')
+    """
+    header, payload = source[5:].split(',', 1)
+    is_base64 = header.endswith(';base64')
+    if is_base64:
+        header = header[:-7]
+    # Determine the type the same way mimetypes.guess_type() does for data: URIs.
+    mime_type = header.split(';', 1)[0]
+    if '=' in mime_type or '/' not in mime_type:
+        mime_type = 'text/plain'
+    return mime_type, is_base64, payload
+
+
+def _iter_data_uri(source: str) -> Iterator[bytes]:
+    """
+    Decode the content of a data: URI, yielding it a chunk at a time so that
+    large embedded files never need to be held in memory in full just to hash them.
+
+    Raises ValueError if the URI is malformed, just like urlopen() would.
+    """
+    _, is_base64, payload = _split_data_uri(source)
+    if not is_base64 or '%' in payload:
+        # Percent-encoding is rare enough that it's not worth streaming.
+        content = unquote_to_bytes(payload)
+        yield binascii.a2b_base64(content) if is_base64 else content
+        return
+
+    try:
+        payload.encode('ascii')
+    except UnicodeEncodeError as e:
+        raise ValueError("Invalid characters in base64 data: URI") from e
+
+    carry = b""
+    for start in range(0, len(payload), DATA_URI_CHUNK_SIZE):
+        encoded = carry + (payload[start:start+DATA_URI_CHUNK_SIZE]
+                           .encode('ascii')
+                           .translate(None, _NON_BASE64_BYTES))
+        usable = len(encoded) - len(encoded) % 4
+        carry = encoded[usable:]
+        if usable:
+            yield binascii.a2b_base64(encoded[:usable])
+    if carry:
+        yield binascii.a2b_base64(carry)
+
+
+def hash_data_uri(source: str) -> str:
+    "Return the SHA-256 hex digest of the content of a data: URI."
+    h = hashlib.sha256()
+    for chunk in _iter_data_uri(source):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def data_uri_extension(source: str, warnings: List[str]) -> str:
+    """
+    Return the filename extension to use in Anki for the content of a data: URI,
+    based on the media type the URI declares.
+    """
+    mime_type, _, _ = _split_data_uri(source)
+    extension = mimetypes.guess_extension(mime_type)
+    if extension is None:
+        warnings.append(f"Unknown media type '{mime_type}' for embedded media: "
+                        f"using extension 'xxx'. The media may not render "
+                        f"correctly in Anki.")
+        extension = ".xxx"
+    return extension
+
+
+def media_extension(url: str, warnings: List[str]) -> str:
+    """
+    Guess the filename extension to use in Anki for the media at /url/.
+    Adds a warning and falls back to '.xxx' if the type can't be determined.
+    """
+    mime_type, _ = mimetypes.guess_type(url)
+    extension = mimetypes.guess_extension(mime_type or "")
+    if extension is None:
+        warnings.append(f"Unknown media type for URL '{url}': using extension "
+                        f"'xxx'. The media may not render correctly in Anki.")
+        extension = ".xxx"
+    return extension
+
+
+def read_source(source: str) -> bytes:
+    """
+    Retrieve the content of the media at the resolved URL /source/.
+    Raises the same exceptions as urlopen().
+    """
+    if source.startswith('data:'):
+        return b"".join(_iter_data_uri(source))
+    with urlopen(source) as response:
+        return response.read()
+
+
+def read_if_modified(source: str, validators: RemoteValidators
+                     ) -> Optional[Tuple[bytes, RemoteValidators]]:
+    """
+    Retrieve the content of the remote media at /source/, with the
+    validators the server returned for it, unless /validators/, returned by
+    an earlier call, are given and the server says the media hasn't changed
+    since then, in which case return None.
+    Raises the same exceptions as urlopen().
+    """
+    headers = {}
+    if 'ETag' in validators:
+        headers['If-None-Match'] = validators['ETag']
+    if 'Last-Modified' in validators:
+        headers['If-Modified-Since'] = validators['Last-Modified']
+    try:
+        with urlopen(Request(source, headers=headers)) as response:
+            return response.read(), {name: response.headers[name]
+                                     for name in ('ETag', 'Last-Modified')
+                                     if name in response.headers}
+    except HTTPError as e:
+        if headers and e.code == 304:
+            return None
+        raise
+
+
+def local_path(source: str) -> Optional[Path]:
+    "If the resolved URL /source/ points to a file on this computer, return its path."
+    parsed = urlparse(source)
+    if parsed.scheme != 'file':
+        return None
+    return Path(url2pathname(parsed.path))
+
+
+def validator_for(source: str) -> Validator:
+    """
+    Return a cheap fingerprint of the media at /source/ that changes whenever its
+    content does, for local files, or None if there's nothing to check.
+    """
+    path = local_path(source)
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class TwMedia:
+    """
+    One media file being imported into Anki from TiddlyWiki.
+
+    :param url:       The src of the media as it appears in the tiddler.
+    :param source:    The resolved URL from which the content can be read.
+    :param hash_:     SHA-256 hex digest of the content.
+    :param extension: Filename extension to use in Anki, including the dot.
+    :param data:      The content, if it has been read already. If not, it will
+                      be read from /source/ the first time it's needed.
+    """
+    def __init__(self, url: str, source: str, hash_: str, extension: str,
+                 data: Optional[bytes] = None) -> None:
+        self.url = url
+        self.source = source
+        self.hash = hash_
+        self.extension = extension
+        self.filename = "tr-" + self.hash + self.extension
+        self._data = data
+
+    @classmethod
+    def from_data(cls, data: bytes, url: str, source: str,
+                  warnings: List[str]) -> 'TwMedia':
+        "Create a TwMedia from content that has already been retrieved."
+        return cls(url, source, hashlib.sha256(data).hexdigest(),
+                   media_extension(url, warnings), data)
+
+    def __eq__(self, other) -> bool:
+        return self.hash == other.hash
+
+    def __hash__(self) -> int:
+        return hash(self.hash)
+
+    def __repr__(self) -> str:
+        src = self.url if len(self.url) <= 80 else self.url[:77] + '...'
+        return f"TwMedia(extension={self.extension}, src={src}, hash={self.hash})"
+
+    @property
+    def data(self) -> bytes:
+        "The content of the file, retrieved on first access if necessary."
+        if self._data is None:
+            self._data = read_source(self.source)
+        return self._data
+
+    def write_to_anki(self, col: Collection) -> None:
+        """
+        Save the file to Anki's media folder if it isn't already there.
+
+        Since our filenames are based on a hash of their content, we can try to
+        add media as many times as we want while updating without risk of ending
+        up with duplicates.  (If the user added the media directly to Anki
+        themselves, then we might end up with one duplicate, but there's nothing
+        we can do about that unless we want to read through the entire media
+        directory and hash every file.) It also means that if the file is
+        already there, we never need to read its content.
+        """
+        if not col.media.have(self.filename):
+            col.media.write_data(desired_fname=self.filename, data=self.data)
+
+
+class MediaCache:
+    """
+    Mapping from media sources to the hashes of their content, so that media
+    used by several notes is only retrieved once per extraction and media that
+    hasn't changed since the last extraction isn't retrieved at all.
+
+    Local files are revalidated by their modification time and size. Remote
+    URLs are revalidated with a conditional request, using the ETag and
+    Last-Modified headers the server last returned; if it returned neither,
+    the media is retrieved again.
+
+    data: URIs are hashed again each time they're parsed, though only once
+    per extraction (an image transcluded into many tiddlers is decoded and
+    hashed once). If the cache has a file, the content is decoded into the
+    folder /inline_dir/ beside it, and the medium's source is that file
+    rather than the URI; files no longer used are deleted when it's saved.
+
+    :param path: JSON file to load previous results from and save them to.
+                 If None, the cache lasts only as long as this object.
+    """
+    VERSION = 1
+
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self.path = path
+        self.inline_dir = path.with_suffix('').absolute() if path is not None else None
+        self._entries: Dict[str, Tuple[Union[Validator, RemoteValidators], str]] = {}
+        self._seen: Dict[str, TwMedia] = {}
+        if path is not None:
+            self._load()
+
+    def _load(self) -> None:
+        assert self.path is not None
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                stored: Dict[str, Any] = json.load(f)
+        except (OSError, ValueError):
+            return
+        if stored.get('version') != self.VERSION:
+            return
+        for source, (validator, hash_) in stored['entries'].items():
+            if isinstance(validator, list):
+                validator = tuple(validator)
+            self._entries[source] = (validator or None, hash_)
+
+    def save(self) -> None:
+        """
+        Write the entries used since this cache was loaded to its file, if any.
+        Entries for media that is no longer referenced are dropped, along
+        with the files embedded media was decoded into.
+        """
+        if self.path is None:
+            return
+        entries = {source: self._entries[source]
+                   for source in self._seen
+                   if source in self._entries}
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.VERSION, 'entries': entries}, f)
+        os.replace(tmp_path, self.path)
+
+        if self.inline_dir is not None and self.inline_dir.is_dir():
+            used = {local_path(source) for source in self._seen}
+            for inline_file in self.inline_dir.iterdir():
+                if inline_file not in used:
+                    inline_file.unlink()
+
+    def _embedded(self, source: str, warnings: List[str]) -> TwMedia:
+        """
+        Return a TwMedia for the content of the data: URI /source/, decoding
+        it into /inline_dir/ if there is one. Its url is a short stand-in
+        for the URI, giving the media type and hash.
+        """
+        hash_ = hash_data_uri(source)
+        extension = data_uri_extension(source, warnings)
+        mime_type, _, _ = _split_data_uri(source)
+        url = f"data:{mime_type};sha256,{hash_}"
+        if self.inline_dir is None:
+            return TwMedia(url, source, hash_, extension)
+
+        path = self.inline_dir / f"{hash_}{extension}"
+        if not path.exists():
+            self.inline_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(path.name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                for chunk in _iter_data_uri(source):
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        file_source = path.as_uri()
+        medium = TwMedia(url, file_source, hash_, extension)
+        self._entries[file_source] = (validator_for(file_source), hash_)
+        self._seen[file_source] = medium
+        return medium
+
+    def get(self, url: str, source: str, warnings: List[str]) -> TwMedia:
+        """
+        Return a TwMedia for the media with src /url/, resolved to /source/,
+        retrieving its content only if we don't know its hash yet.
+
+        Raises the same exceptions as urlopen() if the media must be retrieved.
+        """
+        medium = self._seen.get(source)
+        if medium is not None:
+            return medium
+
+        if source.startswith('data:'):
+            medium = self._embedded(source, warnings)
+            self._seen[source] = medium
+            return medium
+
+        cached = self._entries.get(source)
+        if local_path(source) is None:
+            previous = cached[0] if cached is not None and isinstance(cached[0], dict) else {}
+            retrieved = read_if_modified(source, previous)
+            if retrieved is None:
+                assert cached is not None
+                medium = TwMedia(url, source, cached[1], media_extension(url, warnings))
+            else:
+                data, validators = retrieved
+                medium = TwMedia.from_data(data, url, source, warnings)
+                self._entries[source] = (validators, medium.hash)
+        else:
+            validator = validator_for(source)
+            if cached is not None and cached[0] == validator:
+                medium = TwMedia(url, source, cached[1], media_extension(url, warnings))
+            else:
+                medium = TwMedia.from_data(read_source(source), url, source, warnings)
+                self._entries[source] = (validator, medium.hash)
+
+        self._seen[source] = medium
+        return medium
@@ -45,3 +45,13 @@ class AnkiStateError(TrError):
     Error that occurs when note types or other objects in Anki have been
     manually modified in a way that makes them incompatible with TiddlyRemember.
     """
+
+
+class PushError(TrError):
+    """
+    Error that occurs when tiddlers pushed by a running TiddlyWiki can't be
+    synced. It's reported back to the wiki with the HTTP status /status/.
+    """
+    def __init__(self, message: str, status: int = 400) -> None:
+        super().__init__(message)
+        self.status = status
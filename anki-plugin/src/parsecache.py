@@ -0,0 +1,212 @@
+"""
+parsecache.py - remember the notes found in each rendered tiddler
+
+Parsing the rendered HTML of every tiddler with BeautifulSoup is the most
+expensive part of extracting notes after rendering itself, yet on most syncs
+nearly all tiddlers render exactly as they did last time. For each tiddler,
+we therefore store a SHA-256 digest of its rendered HTML together with the
+notes parsed from it (see TwNote.to_dict()) and any warnings that came up.
+If a tiddler renders to the same bytes next time, its notes are rebuilt from
+the cache without parsing anything.
+
+The cache also records which tiddlers each note ID was found or skipped in,
+so that when only some tiddlers have changed (see watcher.py), we can tell
+which notes came from them and whether any other tiddler still holds them.
+
+Entries are also keyed by the version of the parser, so that upgrading the
+add-on doesn't reuse results an older version produced. Entries for tiddlers
+that are no longer rendered are dropped each time the cache is saved. There
+is one cache per wiki, and it's only ever a cache: if it's missing, out of
+date, or unreadable, tiddlers are simply parsed as usual.
+"""
+import json
+from pathlib import Path
+import sqlite3
+from typing import Any, Collection, Dict, List, NamedTuple, Optional, Set
+
+from .util import PLUGIN_VERSION, Twid
+
+#: Increase whenever a change to the parsing code (twnote.py, clozeparse.py)
+#: would find different notes in the same HTML.
+PARSER_VERSION = 1
+
+
+class ParsedTiddler(NamedTuple):
+    "The results of parsing one rendered tiddler."
+    notes: List[Dict[str, Any]]  #: TwNote.to_dict() of each note found.
+    skipped: List[Twid]          #: IDs of notes skipped as already seen elsewhere.
+    warnings: List[str]          #: Warnings that came up while parsing.
+
+
+class ParseCache:
+    """
+    The results of parsing the rendered tiddlers of one wiki.
+
+    :param path: The SQLite database to keep the results in. If None,
+                 nothing is cached.
+    :param wiki_location: Where the wiki is read from. Relative media paths
+                 are resolved against it, so the cache is discarded if it
+                 changes.
+    """
+    VERSION = 2
+
+    def __init__(self, path: Optional[Path], wiki_location: str) -> None:
+        self.db: Optional[sqlite3.Connection] = None
+        self.parser = f"{PLUGIN_VERSION}/{PARSER_VERSION}"
+        self._rendered: Set[str] = set()
+        self._new: Dict[str, Any] = {}
+        self._forgotten: Set[str] = set()
+        if path is not None:
+            try:
+                self.db = self._open(path, wiki_location)
+            except sqlite3.Error:
+                self.db = None
+
+    def _open(self, path: Path, wiki_location: str) -> sqlite3.Connection:
+        db = sqlite3.connect(str(path))
+        version = db.execute("pragma user_version").fetchone()[0]
+        location = None
+        if version == self.VERSION:
+            location = db.execute("select wiki from meta").fetchone()
+        if location != (wiki_location,):
+            with db:
+                db.execute("drop table if exists meta")
+                db.execute("drop table if exists tiddlers")
+                db.execute("drop table if exists notes")
+                db.execute("create table meta (wiki text not null)")
+                db.execute("insert into meta values (?)", (wiki_location,))
+                db.execute("create table tiddlers (title text primary key, "
+                           "digest text not null, parser text not null, "
+                           "entry text not null)")
+                db.execute("create table notes (twid text not null, "
+                           "title text not null)")
+                db.execute("create index notes_twid on notes (twid)")
+                db.execute("create index notes_title on notes (title)")
+                db.execute(f"pragma user_version = {self.VERSION}")
+        return db
+
+    def get(self, title: str, digest: str) -> Optional[ParsedTiddler]:
+        """
+        Return the results of parsing the tiddler /title/ last time, if its
+        rendered HTML had the SHA-256 digest /digest/, or None.
+        """
+        self._rendered.add(title)
+        if self.db is None:
+            return None
+        try:
+            row = self.db.execute(
+                "select entry from tiddlers where title = ? and digest = ? and parser = ?",
+                (title, digest, self.parser)).fetchone()
+            if row is None:
+                return None
+            return ParsedTiddler(*json.loads(row[0]))
+        except (sqlite3.Error, ValueError, TypeError):
+            return None
+
+    def put(self, title: str, digest: str, parsed: ParsedTiddler) -> None:
+        "Remember the results of parsing a tiddler, to be written by save()."
+        self._rendered.add(title)
+        if self.db is not None:
+            self._new[title] = (digest, json.dumps(parsed))
+
+    def forget(self, titles: Collection[str]) -> None:
+        "Drop the results for tiddlers that no longer exist, when save() is next called."
+        for title in titles:
+            self._new.pop(title, None)
+        self._forgotten.update(titles)
+
+    def save(self, prune: bool = True) -> None:
+        """
+        Write the results remembered with put() and, if /prune/, forget the
+        tiddlers that weren't looked up since the cache was opened. Only
+        pass False when just some of the wiki's tiddlers were rendered.
+        """
+        if self.db is None:
+            return
+        with self.db:
+            if prune:
+                self._delete_titles(self._rendered, keep=True)
+            else:
+                self._delete_titles(self._forgotten, keep=False)
+            self.db.executemany(
+                "insert or replace into tiddlers values (?, ?, ?, ?)",
+                ((title, digest, self.parser, entry)
+                 for title, (digest, entry) in self._new.items()))
+            self.db.executemany("delete from notes where title = ?",
+                                ((title,) for title in self._new))
+            self.db.executemany(
+                "insert into notes values (?, ?)",
+                ((twid, title)
+                 for title, (_, entry) in self._new.items()
+                 for twid in _twids(entry)))
+        self._new.clear()
+        self._forgotten.clear()
+
+    def _delete_titles(self, titles: Collection[str], keep: bool) -> None:
+        "Delete the results for the tiddlers /titles/, or for all others if /keep/."
+        assert self.db is not None
+        self.db.execute("create temp table if not exists chosen (title text primary key)")
+        self.db.execute("delete from chosen")
+        self.db.executemany("insert into chosen values (?)", ((title,) for title in titles))
+        condition = "not in" if keep else "in"
+        for table in ('tiddlers', 'notes'):
+            self.db.execute(f"delete from {table} "
+                            f"where title {condition} (select title from chosen)")
+
+    def _twids_where(self, column: str, values: Collection[str]) -> Set[Twid]:
+        "Return the note IDs in the rows of the notes table with /column/ in /values/."
+        assert self.db is not None
+        found: Set[Twid] = set()
+        values = list(values)
+        for i in range(0, len(values), 500):
+            batch = values[i:i+500]
+            found.update(Twid(twid) for twid, in self.db.execute(
+                f"select distinct twid from notes where {column} in "
+                f"({', '.join('?' * len(batch))})", batch))
+        return found
+
+    def notes_in(self, titles: Collection[str]) -> Set[Twid]:
+        """
+        Return the IDs of the notes found or skipped in the tiddlers /titles/
+        when they were last saved.
+        """
+        if self.db is None:
+            return set()
+        try:
+            return self._twids_where('title', titles)
+        except sqlite3.Error:
+            return set()
+
+    def still_found(self, twids: Collection[Twid]) -> Set[Twid]:
+        """
+        Return those of /twids/ that some tiddler saved in the cache holds.
+        If that can't be told, they're all assumed to be.
+        """
+        if self.db is None:
+            return set(twids)
+        try:
+            return self._twids_where('twid', twids)
+        except sqlite3.Error:
+            return set(twids)
+
+    @property
+    def empty(self) -> bool:
+        "Whether there are no results saved for any tiddler."
+        if self.db is None:
+            return True
+        try:
+            return self.db.execute("select 1 from tiddlers limit 1").fetchone() is None
+        except sqlite3.Error:
+            return True
+
+    def close(self) -> None:
+        "Close the database, discarding anything not yet saved."
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def _twids(entry: str) -> Set[Twid]:
+    "Return the IDs of the notes found or skipped in a serialized ParsedTiddler."
+    parsed = ParsedTiddler(*json.loads(entry))
+    return {Twid(n['id']) for n in parsed.notes} | set(parsed.skipped)
@@ -0,0 +1,105 @@
+"""
+prefetch.py - extract wikis ahead of time, so that syncs can start at once
+
+Extracting notes is by far the slowest part of a sync, and normally all of
+it happens after the user asks to sync. If the 'prefetchMinutes' option is
+set, every so many minutes while the user isn't reviewing, each configured
+wiki is extracted in the background, one at a time, with TiddlyWiki running
+at idle priority so that Anki stays responsive.
+
+Nothing is kept here: find_notes() stores what it extracts in the wiki cache
+(see wikicache.py), so a wiki that hasn't changed since costs only a
+fingerprint, and when the user next syncs, the import dialog finds the notes
+there and goes straight on to syncing. If the wiki has changed again in the
+meantime, it's simply extracted as usual; if the user syncs while a wiki is
+being extracted ahead of time, the sync waits for that extraction and then
+uses its result.
+
+Errors are ignored, to be reported by the next sync the user starts.
+"""
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Tuple
+
+# pylint: disable=import-error, no-name-in-module
+from aqt.qt import QObject, QTimer
+
+from .importer import ImportThread
+
+
+class Prefetcher(QObject):
+    """
+    Extract each configured wiki every /minutes/ minutes, whenever Anki is idle.
+    """
+    def __init__(self, mw, minutes: float) -> None:
+        super().__init__(mw)
+        self.mw = mw
+        self.conf: dict = {}
+        #: Wikis still waiting to be extracted in this round, taken from the end.
+        self.pending: List[Tuple[str, Dict[str, str]]] = []
+        self.thread: Optional[ImportThread] = None
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.start_round)  # type: ignore
+        self.timer.start(int(minutes * 60 * 1000))
+
+    def idle(self) -> bool:
+        "Whether Anki is idle enough to extract a wiki."
+        return self.mw.col is not None and self.mw.state != 'review'
+
+    def start_round(self) -> None:
+        "Start extracting each wiki, unless the last round is still going."
+        if self.pending or self.thread is not None or not self.idle():
+            return
+        self.conf = self.mw.addonManager.getConfig(__name__)
+        self.pending = [(name, wiki_conf) for name, wiki_conf in self.conf['wikis'].items()
+                        if wiki_conf['path'].strip()]
+        self.extract_next()
+
+    def extract_next(self) -> None:
+        "Extract the next wiki of the round, waiting if Anki has become busy."
+        if not self.pending:
+            return
+        if not self.idle():
+            self.pending.clear()
+            return
+        wiki_name, wiki_conf = self.pending.pop()
+        self.thread = ImportThread(self.conf, wiki_name, wiki_conf, parent=self.mw,
+                                   low_priority=True)
+        self.thread.finished.connect(self.join_thread)  # type: ignore
+        self.thread.finished.connect(self.thread.deleteLater)  # type: ignore
+        self.thread.start()
+
+    def join_thread(self) -> None:
+        "Drop the notes extracted, which are kept in the cache, and go on."
+        self.thread = None
+        self.extract_next()
+
+    def close(self) -> None:
+        "Stop extracting wikis. An extraction under way still finishes."
+        self.timer.stop()
+        self.pending.clear()
+        self.deleteLater()
+
+
+_prefetcher: Optional[Prefetcher] = None
+
+
+def start_prefetching(mw) -> None:
+    """
+    Extract wikis ahead of time, if the user has asked for that,
+    replacing any prefetcher already running.
+    """
+    global _prefetcher  # pylint: disable=global-statement
+    stop_prefetching()
+    minutes = float(mw.addonManager.getConfig(__name__).get('prefetchMinutes', 0))
+    if minutes > 0:
+        _prefetcher = Prefetcher(mw, minutes)
+
+
+def stop_prefetching() -> None:
+    "Stop extracting wikis ahead of time."
+    global _prefetcher  # pylint: disable=global-statement
+    if _prefetcher is not None:
+        _prefetcher.close()
+        _prefetcher = None
@@ -0,0 +1,282 @@
+"""
+pushserver.py - accept tiddlers pushed by a running TiddlyWiki
+
+When editing a folder wiki in the browser against `tiddlywiki --listen`,
+the TiddlyRemember plugin can send each tiddler to Anki as soon as it's
+saved, already rendered through the TiddlyRememberParseable template (see
+$:/plugins/sobjornstad/TiddlyRemember/startup/push.js), so that its notes
+can be synced without running TiddlyWiki at all. This module is the
+receiving end: a small HTTP server listening on localhost, which hands each
+push to a handler (see watcher.py) and reports the outcome back.
+
+Requests must be made to the server's URL, whose path holds a token the
+server is started with (see PushServer.url); the user pastes that URL into
+the plugin's configuration, so that only wikis they've set up can push.
+
+Only tiddlers selected by the wiki's 'contentFilter' may be pushed, just as
+only they are rendered by a full sync, so the plugin first asks for it with a
+GET request to ``?wiki=<name of the wiki in the add-on's configuration>``,
+answered with ``{"filter": "<filter>"}``. A push is then a POST request with
+a JSON body of the form::
+
+    {"wiki": "<name of the wiki>",
+     "filter": "<the filter the tiddlers were selected with>",
+     "tiddlers": [{"title": "<title>", "html": "<rendered tiddler>"}, ...],
+     "deleted": ["<title of a tiddler deleted or no longer selected>", ...]}
+
+and is answered with ``{"result": "<what changed>"}``, or with
+``{"error": "<message>"}`` and an error status. A push selected with any
+filter but the wiki's current one is refused, so that the plugin asks again.
+
+Any web page can make the browser send requests to localhost, so requests
+from a page (which carry an Origin header) are only accepted if the page
+itself was served from this computer, and the Host header must name this
+computer too, so that a page can't get around that by DNS rebinding.
+"""
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from .oops import PushError
+
+#: Names of this computer that we accept in the Host and Origin headers.
+LOCAL_HOSTS = {'localhost', '127.0.0.1', '::1'}
+
+#: Largest push we'll read, in bytes.
+MAX_PUSH_SIZE = 64 * 1024 * 1024
+
+
+class Push(NamedTuple):
+    "Tiddlers pushed by a running TiddlyWiki."
+    wiki: str                #: Name of the wiki they belong to.
+    filter: str              #: The filter the tiddlers were selected with.
+    tiddlers: Dict[str, str]  #: Rendered HTML of each tiddler added or edited, by title.
+    deleted: List[str]       #: Titles of the tiddlers deleted or no longer selected.
+
+
+#: Syncs a push and returns a description of the changes made, or raises PushError.
+PushHandler = Callable[[Push], str]
+
+#: Returns the content filter of the wiki of the given name, or raises PushError.
+FilterLookup = Callable[[str], str]
+
+
+def _is_local(host: Optional[str]) -> bool:
+    """
+    Return True if /host/, a hostname with an optional port, names this computer.
+
+    >>> _is_local('127.0.0.1:8739'), _is_local('[::1]:8739'), _is_local('localhost')
+    (True, True, True)
+    >>> _is_local('attacker.example:8739'), _is_local(None)
+    (False, False)
+    """
+    if not host:
+        return False
+    try:
+        return urlsplit(f"//{host}").hostname in LOCAL_HOSTS
+    except ValueError:
+        return False
+
+
+def server_url(port: int, token: str) -> str:
+    """
+    Return the URL of a server listening on /port/ with the token /token/.
+
+    >>> server_url(8739, 'abc')
+    'http://127.0.0.1:8739/abc/'
+    """
+    return f"http://127.0.0.1:{port}/{token}/"
+
+
+def parse_push(body: bytes) -> Push:
+    """
+    Read a push from the body of a request.
+
+    >>> parse_push(b'{"wiki": "W", "filter": "[!is[system]]", '
+    ...            b'"tiddlers": [{"title": "T", "html": "<p>"}]}')
+    Push(wiki='W', filter='[!is[system]]', tiddlers={'T': '<p>'}, deleted=[])
+    >>> try:
+    ...     parse_push(b'{"wiki": "W", "tiddlers": []}')
+    ... except PushError as e:
+    ...     print(e.status, e)
+    400 A push must give the name of a wiki, its filter, and a list of tiddlers.
+    """
+    try:
+        data = json.loads(body.decode('utf-8'))
+        wiki, filter_ = data['wiki'], data['filter']
+        tiddlers, deleted = data['tiddlers'], data.get('deleted', [])
+        if not isinstance(tiddlers, list) or not isinstance(deleted, list):
+            raise TypeError
+        rendered = {t['title']: t['html'] for t in tiddlers}
+        if not all(isinstance(v, str) for v in [wiki, filter_, *rendered,
+                                                *rendered.values(), *deleted]):
+            raise TypeError
+    except (ValueError, KeyError, TypeError) as e:
+        raise PushError("A push must give the name of a wiki, its filter, "
+                        "and a list of tiddlers.") from e
+    return Push(wiki, filter_, rendered, deleted)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    "Answers requests to a PushServer."
+    server: '_Server'
+
+    def _allowed_origin(self) -> Optional[str]:
+        """
+        Return the Origin header if the request comes from a page served from
+        this computer, '' if it doesn't come from a page, or None if it should
+        be refused.
+        """
+        if not _is_local(self.headers.get('Host')):
+            return None
+        origin = self.headers.get('Origin')
+        if origin is None:
+            return ''
+        try:
+            return origin if urlsplit(origin).hostname in LOCAL_HOSTS else None
+        except ValueError:
+            return None
+
+    def _has_token(self) -> bool:
+        "Return True if the request was made to the server's URL, token and all."
+        try:
+            path = urlsplit(self.path).path
+        except ValueError:
+            return False
+        return hmac.compare_digest(path.strip('/').encode('utf-8'),
+                                   self.server.token.encode('utf-8'))
+
+    def _refused(self) -> Optional[str]:
+        """
+        Answer the request with an error and return None if it should be
+        refused, or return what _allowed_origin() does if not.
+        """
+        origin = self._allowed_origin()
+        if origin is None:
+            self._respond(403, '', {'error': "Pushes are only accepted from this computer."})
+        elif not self._has_token():
+            self._respond(403, origin, {'error': "Pushes must be sent to the push URL shown "
+                                                 "in the TiddlyRemember settings."})
+            origin = None
+        return origin
+
+    def _respond(self, status: int, origin: str, body: Optional[Dict[str, Any]] = None) -> None:
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        if origin:
+            self.send_header('Access-Control-Allow-Origin', origin)
+            self.send_header('Access-Control-Allow-Methods', 'GET, POST')
+            self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+            self.send_header('Vary', 'Origin')
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_OPTIONS(self) -> None:  # pylint: disable=invalid-name
+        "Answer a browser asking whether it may push, before it does."
+        origin = self._allowed_origin()
+        if origin is None or not self._has_token():
+            self._respond(403, '')
+        else:
+            self._respond(204, origin)
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        "Tell the wiki given by the 'wiki' parameter which tiddlers it may push."
+        origin = self._refused()
+        if origin is None:
+            return
+        wiki = parse_qs(urlsplit(self.path).query).get('wiki')
+        if not wiki:
+            self._respond(400, origin, {'error': "The name of a wiki must be given."})
+            return
+        try:
+            filter_ = self.server.filter_for(wiki[0])
+        except PushError as e:
+            self._respond(e.status, origin, {'error': str(e)})
+        else:
+            self._respond(200, origin, {'filter': filter_})
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        "Sync a push."
+        origin = self._refused()
+        if origin is None:
+            return
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self._respond(411, origin, {'error': "The length of the push must be given."})
+            return
+        if length < 0:
+            self._respond(400, origin, {'error': "The length of the push can't be negative."})
+            return
+        if length > MAX_PUSH_SIZE:
+            self._respond(413, origin, {'error': "The push is too large."})
+            return
+
+        try:
+            push = parse_push(self.rfile.read(length))
+            if push.filter != self.server.filter_for(push.wiki):
+                raise PushError(f"The filter of the wiki '{push.wiki}' has changed, "
+                                f"so the tiddlers must be chosen again.", 409)
+            result = self.server.handler(push)
+        except PushError as e:
+            self._respond(e.status, origin, {'error': str(e)})
+        except Exception as e:  # pylint: disable=broad-except
+            self._respond(500, origin, {'error': f"{type(e).__name__}: {e}"})
+        else:
+            self._respond(200, origin, {'result': result})
+
+    def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+        "Don't log requests to stderr."
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Any, handler: PushHandler, filter_for: FilterLookup,
+                 token: str) -> None:
+        super().__init__(address, _RequestHandler)
+        self.handler = handler
+        self.filter_for = filter_for
+        self.token = token
+
+
+class PushServer:
+    """
+    Listen for pushes on localhost, on a thread of its own.
+
+    :param handler:    Called with each push, on a thread of its own, and
+                       expected to return once it has been synced.
+    :param filter_for: Called with the name of a wiki to find the filter
+                       selecting the tiddlers that may be pushed to it.
+    :param port:       The port to listen on, or 0 to choose any free port.
+    :param token:      A secret that requests must give as the path of the URL,
+                       such as one from secrets.token_urlsafe().
+    :raises OSError: If the port can't be listened on.
+    """
+    def __init__(self, handler: PushHandler, filter_for: FilterLookup, port: int,
+                 token: str) -> None:
+        self._server = _Server(('127.0.0.1', port), handler, filter_for, token)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="TiddlyRemember push server", daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        "The port being listened on."
+        return self._server.server_address[1]
+
+    @property
+    def url(self) -> str:
+        "The URL pushes must be sent to."
+        return server_url(self.port, self._server.token)
+
+    def close(self) -> None:
+        "Stop listening. Pushes being synced are left to finish."
+        self._server.shutdown()
+        self._server.server_close()
@@ -13,8 +13,8 @@ from typing import Any, List
 
 # pylint: disable=no-name-in-module
 import aqt
-from aqt.qt import (Qt, QApplication, QComboBox, QCursor, QDesktopServices, QDialog,
-                    QFileDialog, QUrl)
+from aqt.qt import (Qt, QApplication, QCheckBox, QComboBox, QCursor, QDesktopServices,
+                    QDialog, QFileDialog, QSpinBox, QUrl)
 from aqt.utils import showWarning, showInfo, showCritical, askUser
 
 from aqt.qt import qtmajor
@@ -25,6 +25,7 @@ else:
 
 # pylint: disable=wrong-import-position
 from .util import DEFAULT_FILTER, nowin_startupinfo, uniquify_name
+from .watcher import push_url
 
 
 class SettingsDialog(QDialog):
@@ -55,6 +56,8 @@ class SettingsDialog(QDialog):
         self.form.wikiList.currentRowChanged.connect(self.wiki_changed)
         self.form.wikiName.textEdited.connect(self.wiki_name_changed)
         self.form.wikiName.editingFinished.connect(self.prevent_duplicate_name)
+        self.form.watchFolderWikis_.toggled.connect(self.form.watchDebounceSeconds_.setEnabled)
+        self.form.pushPort_.valueChanged.connect(self.push_port_changed)
 
         self.current_wiki_index = 0
         # Unfortunately you cannot specify a list with elements of fixed type, like
@@ -86,9 +89,15 @@ class SettingsDialog(QDialog):
 
         for name, value in self.conf.items():
             control = getattr(self.form, name + '_', None)
-            if control is not None:
+            if isinstance(control, QCheckBox):
+                control.setChecked(bool(value))
+            elif isinstance(control, QSpinBox):
+                control.setValue(int(value))
+            elif control is not None:
                 control.setText(value)
                 control.setCursorPosition(0)
+        self.form.watchDebounceSeconds_.setEnabled(self.form.watchFolderWikis_.isChecked())
+        self.push_port_changed(self.form.pushPort_.value())
 
         if did := self.mw.col.decks.id_for_name(self.conf['defaultDeck']):
             self.deckChooser.selected_deck_id = did
@@ -99,7 +108,11 @@ class SettingsDialog(QDialog):
         "Dump the values in the dialog to the add-on's config as stored by Anki."
         for name in list(self.conf.keys()):
             control = getattr(self.form, name + '_', None)
-            if control is not None:
+            if isinstance(control, QCheckBox):
+                self.conf[name] = control.isChecked()
+            elif isinstance(control, QSpinBox):
+                self.conf[name] = control.value()
+            elif control is not None:
                 self.conf[name] = control.text()
         self.conf['defaultDeck'] = self.deckChooser.selected_deck_name()
 
@@ -282,6 +295,11 @@ class SettingsDialog(QDialog):
             showInfo(f"Successfully called TiddlyWiki {proc.stdout.decode().strip()}! "
                      f"You're all set.")
 
+    def push_port_changed(self, new_port: int) -> None:
+        "Show the URL to paste into wikis that will push to the new port."
+        self.form.pushUrl.setText(push_url(new_port) if new_port else "")
+        self.form.pushUrl.setCursorPosition(0)
+
     def type_changed(self, new_text: str) -> None:
         "Adjust the interface appropriately for selection of path or URL."
         if new_text == 'URL':
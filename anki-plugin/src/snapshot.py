@@ -0,0 +1,189 @@
+"""
+snapshot.py - read-only view of the TiddlyRemember notes in an Anki collection
+
+Loading every TiddlyRemember note in the collection through col.get_note()
+costs one round trip to the backend per note, which adds up quickly in large
+collections. Instead, we read the raw rows of all notes using TiddlyRemember
+note types in a single query and index them by their TiddlyRemember ID.
+Full Note objects are only created (with col.get_note()) for the notes we
+actually need to change.
+
+If fingerprints from the previous sync are available (see fingerprints.py),
+the fields of notes that haven't been modified since then aren't read at all.
+
+The snapshot also records which decks the cards of each note are in, so that
+a sync can be planned without further reference to the collection
+(see syncplan.py).
+"""
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Type
+
+from anki.collection import Collection
+from anki.notes import NoteId
+
+from . import trmodels
+from .fingerprints import Fingerprint
+from .util import Twid
+
+
+class NoteRow:
+    """
+    One TiddlyRemember note as stored in the Anki collection.
+
+    Supports the subset of the read interface of anki.notes.Note that TwNotes
+    use to compare themselves to Anki notes -- indexing by field name,
+    /tags/, /id/, and note_type() -- so either can be passed where a note is
+    only being examined.
+
+    If the note is unchanged since the last sync, its content may be described
+    by /digest/ instead, in which case /fields/ and /tags/ are None and the
+    TiddlyRemember ID and wiki name must be given.
+    """
+    __slots__ = ('id', 'mid', 'model', 'mod', 'fields', 'tags', 'twid', 'wiki', 'digest')
+
+    def __init__(self, id_: NoteId, mid: int, model: Type[trmodels.ModelData],
+                 mod: int, fields: Optional[List[str]], tags: Optional[List[str]],
+                 twid: Optional[Twid] = None, digest: Optional[str] = None,
+                 wiki: Optional[str] = None) -> None:
+        self.id = id_
+        self.mid = mid
+        self.model = model
+        self.mod = mod
+        self.fields = fields
+        self.tags = tags
+        #: The TiddlyRemember ID of this note.
+        self.twid: Twid = twid if twid is not None else Twid(self[trmodels.ID_FIELD_NAME])
+        #: The name of the wiki this note came from.
+        self.wiki: str = wiki if wiki is not None else self[trmodels.WIKI_FIELD_NAME]
+        #: The TwNote.digest of the note's content, if known without reading its fields.
+        self.digest = digest
+
+    def __getitem__(self, field_name: str) -> str:
+        assert self.fields is not None, "Fields of this note were not loaded."
+        return self.fields[self.model.field_index_by_name(field_name)]
+
+    def __repr__(self) -> str:
+        return f"NoteRow(id={self.id!r}, model={self.model.name!r}, twid={self.twid!r})"
+
+    def note_type(self) -> Dict[str, Any]:
+        "Minimal stand-in for Note.note_type(), providing the name and ID only."
+        return {'name': self.model.name, 'id': self.mid}
+
+
+def _model_ids(col: Collection) -> Dict[int, Type[trmodels.ModelData]]:
+    "Map the IDs of the TiddlyRemember note types in the collection to their definitions."
+    mids = {}
+    for model in trmodels.all_note_types():
+        mid = col.models.id_for_name(model.name)
+        if mid is not None:
+            mids[mid] = model
+    return mids
+
+
+def _mid_clause(models: Dict[int, Type[trmodels.ModelData]]) -> str:
+    "SQL condition selecting notes of the given note types."
+    return "mid in (" + ",".join(str(mid) for mid in models) + ")"
+
+
+def load_card_decks(col: Collection) -> Dict[NoteId, Set[str]]:
+    "Return the names of the decks the cards of each TiddlyRemember note are in."
+    models = _model_ids(col)
+    if not models:
+        return {}
+    deck_names = {d.id: d.name for d in col.decks.all_names_and_ids()}
+    card_decks: Dict[NoteId, Set[str]] = {}
+    for nid, did in col.db.all("select nid, did from cards where nid in "
+                               "(select id from notes where " + _mid_clause(models) + ")"):
+        card_decks.setdefault(NoteId(nid), set()).add(deck_names.get(did, ""))
+    return card_decks
+
+
+def load_rows(col: Collection, nids: Optional[Sequence[NoteId]] = None) -> List[NoteRow]:
+    """
+    Load the TiddlyRemember notes in the collection with one query.
+
+    :param col:  The Anki collection object.
+    :param nids: If provided, only load the notes with these IDs.
+    :return: A list of NoteRows, in no particular order.
+    """
+    models = _model_ids(col)
+    if not models:
+        return []
+
+    query = "select id, mid, mod, flds, tags from notes where " + _mid_clause(models)
+    if nids is not None:
+        if not nids:
+            return []
+        query += " and id in (" + ",".join(str(int(nid)) for nid in nids) + ")"
+
+    return [NoteRow(NoteId(nid), mid, models[mid], mod, flds.split("\x1f"), tags.split())
+            for nid, mid, mod, flds, tags in col.db.all(query)]
+
+
+def load_mods(col: Collection) -> Dict[NoteId, int]:
+    "Return the modification times of the TiddlyRemember notes in the collection."
+    models = _model_ids(col)
+    if not models:
+        return {}
+    return {NoteId(nid): mod for nid, mod in col.db.all(
+        "select id, mod from notes where " + _mid_clause(models))}
+
+
+class CollectionSnapshot:
+    """
+    The TiddlyRemember notes in an Anki collection at the time of loading,
+    indexed by their TiddlyRemember ID, and the decks their cards are in.
+    """
+    def __init__(self, rows: Iterable[NoteRow],
+                 card_decks: Optional[Dict[NoteId, Set[str]]] = None) -> None:
+        self.by_twid: Dict[Twid, NoteRow] = {row.twid: row for row in rows}
+        self.card_decks: Dict[NoteId, Set[str]] = card_decks or {}
+
+    def __len__(self) -> int:
+        return len(self.by_twid)
+
+    def __contains__(self, twid: Twid) -> bool:
+        return twid in self.by_twid
+
+    def __getitem__(self, twid: Twid) -> NoteRow:
+        return self.by_twid[twid]
+
+    def twids(self) -> Iterable[Twid]:
+        "The TiddlyRemember IDs of all notes in the snapshot."
+        return self.by_twid.keys()
+
+    def decks_of(self, nid: NoteId) -> Set[str]:
+        "The names of the decks the cards of a note are in."
+        return self.card_decks.get(nid, set())
+
+
+def load_snapshot(col: Collection,
+                  fingerprints: Optional[Dict[NoteId, Fingerprint]] = None
+                  ) -> CollectionSnapshot:
+    """
+    Load a snapshot of all TiddlyRemember notes in the collection.
+
+    :param col:          The Anki collection object.
+    :param fingerprints: Fingerprints saved by the previous sync, if any.
+                         Notes whose modification time still matches their
+                         fingerprint are described by its digest rather than
+                         by their fields, which are then never read.
+    """
+    if not fingerprints:
+        return CollectionSnapshot(load_rows(col), load_card_decks(col))
+
+    models = _model_ids(col)
+    if not models:
+        return CollectionSnapshot(())
+
+    rows: List[NoteRow] = []
+    stale: List[NoteId] = []
+    for nid, mid, mod in col.db.all("select id, mid, mod from notes where "
+                                    + _mid_clause(models)):
+        fingerprint = fingerprints.get(nid)
+        if fingerprint is not None and fingerprint.mod == mod:
+            rows.append(NoteRow(NoteId(nid), mid, models[mid], mod, None, None,
+                                fingerprint.twid, fingerprint.digest, fingerprint.wiki))
+        else:
+            stale.append(NoteId(nid))
+    rows.extend(load_rows(col, stale))
+    return CollectionSnapshot(rows, load_card_decks(col))
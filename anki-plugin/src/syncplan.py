@@ -0,0 +1,171 @@
+"""
+syncplan.py - work out what a sync needs to change, without changing anything
+
+Planning a sync compares the TiddlyWiki notes with a snapshot of the Anki
+collection (see snapshot.py) and produces a SyncPlan listing every change
+needed to bring the collection in line with the wiki. Planning doesn't touch
+the collection, so it can be done in the background, shown to the user before
+anything happens, or timed on its own. The plan is then carried out by
+ankisync.apply_plan().
+
+Plans refer to TiddlyWiki notes by their TiddlyRemember ID and to Anki notes
+by their note ID, and can be converted to and from JSON.
+"""
+from dataclasses import asdict, dataclass
+import json
+from typing import AbstractSet, Dict, Iterable, List, Optional, Tuple
+
+# anki.collection must be imported before anki.notes to avoid a circular import.
+import anki.collection  # pylint: disable=unused-import
+from anki.notes import NoteId
+
+from .snapshot import CollectionSnapshot, NoteRow
+from .twnote import TwNote, canonical_field
+from .util import pluralize, Twid
+
+
+@dataclass(frozen=True)
+class NoteRef:
+    "A TiddlyWiki note and the existing Anki note it corresponds to."
+    twid: Twid
+    nid: NoteId
+
+
+@dataclass(frozen=True)
+class TypeChange:
+    "Existing notes to convert from one TiddlyRemember note type to another."
+    old_model: str
+    new_model: str
+    nids: Tuple[NoteId, ...]
+
+
+@dataclass(frozen=True)
+class DeckMove:
+    "Existing notes with cards that need to be moved into the deck /deck/."
+    deck: str
+    nids: Tuple[NoteId, ...]
+
+
+@dataclass(frozen=True)
+class SyncPlan:
+    """
+    The changes needed to make an Anki collection match a set of TiddlyWiki notes.
+
+    Notes listed under /type_changes/ are always listed under /edits/ too,
+    since their fields have to be rewritten after changing their type. Changes
+    to tags are edits as well, since tags are stored with the note.
+    """
+    adds: Tuple[Twid, ...]                #: Notes to create.
+    edits: Tuple[NoteRef, ...]            #: Notes whose fields or tags need rewriting.
+    type_changes: Tuple[TypeChange, ...]  #: Notes needing a different note type.
+    deck_moves: Tuple[DeckMove, ...]      #: Notes with cards in the wrong deck.
+    removes: Tuple[NoteId, ...]           #: Notes no longer in the wiki.
+    unchanged: Tuple[NoteRef, ...]        #: Notes that are already up to date.
+    media: Tuple[str, ...]                #: Filenames of media used by added or edited notes.
+
+    def summary(self) -> str:
+        "Describe the plan to the user, one line per kind of change."
+        return '\n'.join((
+            f"Added {len(self.adds)} {pluralize('note', len(self.adds))}.",
+            f"Updated {len(self.edits)} {pluralize('note', len(self.edits))}.",
+            f"Removed {len(self.removes)} {pluralize('note', len(self.removes))}.",
+        ))
+
+    def to_json(self) -> str:
+        "Serialize the plan to a JSON string."
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, data: str) -> 'SyncPlan':
+        "Recreate a plan serialized with to_json()."
+        d = json.loads(data)
+        return cls(
+            adds=tuple(Twid(i) for i in d['adds']),
+            edits=tuple(NoteRef(Twid(i['twid']), NoteId(i['nid'])) for i in d['edits']),
+            type_changes=tuple(
+                TypeChange(i['old_model'], i['new_model'],
+                           tuple(NoteId(nid) for nid in i['nids']))
+                for i in d['type_changes']),
+            deck_moves=tuple(DeckMove(i['deck'], tuple(NoteId(nid) for nid in i['nids']))
+                             for i in d['deck_moves']),
+            removes=tuple(NoteId(i) for i in d['removes']),
+            unchanged=tuple(NoteRef(Twid(i['twid']), NoteId(i['nid']))
+                            for i in d['unchanged']),
+            media=tuple(d['media']),
+        )
+
+
+def needs_update(tw_note: TwNote, row: NoteRow) -> bool:
+    """
+    Return True if the content of an existing Anki note of the right note type
+    differs from /tw_note/.
+    """
+    if row.digest is not None:
+        return row.digest != tw_note.digest
+    return not tw_note.fields_equal(row)
+
+
+def plan_sync(tw_notes: Iterable[TwNote], snapshot: CollectionSnapshot,
+              default_deck: str, wikis: Optional[AbstractSet[str]] = None,
+              removable: Optional[AbstractSet[Twid]] = None) -> SyncPlan:
+    """
+    Compare TiddlyWiki notes with a snapshot of the TiddlyRemember notes in
+    an Anki collection and work out what needs to change.
+
+    :param tw_notes: TwNotes extracted from one or more TiddlyWikis.
+    :param snapshot: The TiddlyRemember notes currently in the collection.
+    :param default_deck: Deck for notes that don't specify one.
+    :param wikis: If provided, /tw_notes/ come only from the wikis with these
+                  names, and only Anki notes from these wikis are removed if
+                  they're not among /tw_notes/. Otherwise, /tw_notes/ are
+                  taken to be all the user's notes.
+    :param removable: If provided, only Anki notes with these IDs are removed,
+                  for a sync of the notes in just some tiddlers of a wiki.
+    :return: The changes to make, in a deterministic order.
+    """
+    extracted: Dict[Twid, TwNote] = {n.id_: n for n in tw_notes}
+    anki_twids = set(snapshot.twids())
+
+    edits: List[NoteRef] = []
+    unchanged: List[NoteRef] = []
+    type_changes: Dict[Tuple[str, str], List[NoteId]] = {}
+    deck_moves: Dict[str, List[NoteId]] = {}
+    for twid in sorted(anki_twids.intersection(extracted)):
+        tw_note = extracted[twid]
+        row = snapshot[twid]
+        if not tw_note.model_equal(row):
+            type_changes.setdefault((row.model.name, tw_note.model.name), []).append(row.id)
+            edits.append(NoteRef(twid, row.id))
+        elif needs_update(tw_note, row):
+            edits.append(NoteRef(twid, row.id))
+        else:
+            unchanged.append(NoteRef(twid, row.id))
+
+        # Deck names aren't case-sensitive in Anki.
+        deck = tw_note.target_deck or default_deck
+        if any(name.casefold() != deck.casefold() for name in snapshot.decks_of(row.id)):
+            deck_moves.setdefault(deck, []).append(row.id)
+
+    adds = sorted(set(extracted).difference(anki_twids))
+    removed = anki_twids.difference(extracted)
+    if wikis is not None:
+        # Wiki names are compared as Anki stores them in the Wiki field.
+        in_scope = {canonical_field(name) for name in wikis}
+        removed = {twid for twid in removed if snapshot[twid].wiki in in_scope}
+    if removable is not None:
+        removed.intersection_update(removable)
+    media = {medium.filename
+             for twid in adds + [ref.twid for ref in edits]
+             for medium in extracted[twid].media}
+
+    return SyncPlan(
+        adds=tuple(adds),
+        edits=tuple(edits),
+        type_changes=tuple(TypeChange(old, new, tuple(nids))
+                           for (old, new), nids in sorted(type_changes.items())),
+        deck_moves=tuple(DeckMove(deck, tuple(nids))
+                         for deck, nids in sorted(deck_moves.items())),
+        removes=tuple(sorted(snapshot[twid].id for twid in removed)),
+        unchanged=tuple(unchanged),
+        media=tuple(sorted(media)),
+    )
@@ -40,6 +40,10 @@ from .oops import AnkiStateError
 # and is defined here to prevent them from getting out of sync.
 ID_FIELD_NAME = 'ID'
 
+# Field holding the name of the wiki each note came from, used to limit a sync
+# to some of the user's wikis. Likewise the same on all note types.
+WIKI_FIELD_NAME = 'Wiki'
+
 
 class TemplateData(ABC):
     """
@@ -225,7 +229,8 @@ class TiddlyRememberQuestionAnswer(ModelData):
         """
 
     name = "TiddlyRemember Q&A v1"
-    fields = ("Question", "Answer", ID_FIELD_NAME, "Wiki", "Reference", "Permalink")
+    fields = ("Question", "Answer", ID_FIELD_NAME, WIKI_FIELD_NAME, "Reference",
+              "Permalink")
     templates = (TiddlyRememberQuestionAnswerTemplate,)
     styling = """
         .card {
@@ -298,7 +303,8 @@ class TiddlyRememberPair(ModelData):
         back_name = "First"
 
     name = "TiddlyRemember Pair v1"
-    fields = ("First", "Second", ID_FIELD_NAME, "Wiki", "Reference", "Permalink")
+    fields = ("First", "Second", ID_FIELD_NAME, WIKI_FIELD_NAME, "Reference",
+              "Permalink")
     templates = (TiddlyRememberPairForwardTemplate,
                  TiddlyRememberPairReverseTemplate)
     styling = """
@@ -346,7 +352,7 @@ class TiddlyRememberCloze(ModelData):
         """
 
     name = "TiddlyRemember Cloze v1"
-    fields = ("Text", ID_FIELD_NAME, "Wiki", "Reference", "Permalink")
+    fields = ("Text", ID_FIELD_NAME, WIKI_FIELD_NAME, "Reference", "Permalink")
     templates = (TiddlyRememberClozeTemplate,)
     styling = """
         .card {
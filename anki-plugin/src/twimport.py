@@ -2,42 +2,147 @@
 twimport.py - obtain and render TiddlyWikis and create TiddlyWiki note objects from them
 
 This module's public interface is find_notes(), which, given information
-about a wiki, returns a set of TwNotes that it found in this wiki.
+about a wiki, returns a set of TwNotes that it found in this wiki;
+iter_notes(), which yields them as they're found; and find_changed_notes()
+and find_pushed_notes(), which extract only some tiddlers of a folder wiki
+after they've been edited.
 """
+from contextlib import closing
+import hashlib
+import json
 import os
 from pathlib import Path
+import shutil
 import subprocess
 from tempfile import TemporaryDirectory
-from typing import Callable, List, Optional, Set, Sequence
+import threading
+from typing import (Callable, Collection, Dict, Iterable, Iterator, List, NamedTuple, Optional,
+                    Set, Sequence)
 import urllib
 
 from bs4 import BeautifulSoup
 import requests
 
-from .oops import RenderingError, ConfigurationError, ScheduleParsingError, TiddlerParsingError
-from .twnote import TwNote, ensure_version
-from .util import nowin_startupinfo
+from .media import MediaCache
+from .oops import (ExtractError, RenderingError, ConfigurationError, ScheduleParsingError,
+                   TiddlerParsingError)
+from .parsecache import PARSER_VERSION, ParseCache, ParsedTiddler
+from .twnote import TwNote, ensure_version, read_note_id, sharing_tags
+from .util import (cache_path, low_priority_creationflags, lower_priority, nowin_startupinfo,
+                   PLUGIN_VERSION, Twid)
 from .wiki import Wiki, WikiType
+from .wikicache import CachedExtraction, WikiCache
 
 RENDERED_FILE_EXTENSION = "html"
 
+#: Temporary tiddler listing the tiddlers to render when only some are,
+#: whose text is the filter they must also match.
+CHANGED_TIDDLERS = "$:/temp/TiddlyRemember/ChangedTiddlers"
+
+
+#: Held while a wiki is being extracted, so that two extractions of the same
+#: wiki, such as one started ahead of time (see prefetch.py) and one the user
+#: asked for, don't write its caches at once. The second waits, then usually
+#: finds the wiki in the wiki cache.
+_wiki_locks: Dict[str, threading.Lock] = {}
+_wiki_locks_lock = threading.Lock()
+
+
+def _wiki_lock(wiki_name: str) -> threading.Lock:
+    "Return the lock held while the wiki /wiki_name/ is being extracted."
+    with _wiki_locks_lock:
+        return _wiki_locks.setdefault(wiki_name, threading.Lock())
+
+
+class TiddlerChanges(NamedTuple):
+    "What find_changed_notes() found in the tiddlers that have changed."
+    notes: Set[TwNote]  #: Notes now found in those tiddlers.
+    removable: Set[Twid]  #: Notes no longer found in those tiddlers or any other.
+
 
 def _download_wiki(url: str, target_location: str,
-                   requests_session: Optional[requests.Session] = None) -> None:
+                   requests_session: Optional[requests.Session] = None,
+                   validators: Optional[Dict[str, str]] = None) -> Optional[Dict[str, str]]:
     """
     Download a wiki from a URL to the path target_location.
+
+    If /validators/, the ETag and Last-Modified headers returned by this
+    function for an earlier download, are provided and the server says the
+    wiki hasn't changed since then, nothing is written and None is returned.
+    Otherwise, return the validators of this download.
     """
     if requests_session is None:
         requests_session = requests.session()
 
-    r = requests_session.get(url)
+    headers = {}
+    if validators:
+        if 'ETag' in validators:
+            headers['If-None-Match'] = validators['ETag']
+        if 'Last-Modified' in validators:
+            headers['If-Modified-Since'] = validators['Last-Modified']
+
+    r = requests_session.get(url, headers=headers)
+    if headers and r.status_code == 304:
+        return None
     r.raise_for_status()
     with open(target_location, 'wb') as f:
         f.write(r.text.encode(r.encoding))
+    return {name: r.headers[name] for name in ('ETag', 'Last-Modified')
+            if name in r.headers}
+
+
+def _extraction_key(tw_binary: str, wiki_path: str, wiki_type: str,
+                    filter_: str) -> str:
+    """
+    Return a digest of everything apart from the content of a wiki that
+    affects what is extracted from it, for the wiki cache.
+    """
+    binary = shutil.which(tw_binary) or tw_binary
+    try:
+        st = os.stat(binary)
+        binary_version = [st.st_mtime_ns, st.st_size]
+    except OSError:
+        binary_version = None
+    payload = [PLUGIN_VERSION, PARSER_VERSION, wiki_type, wiki_path, filter_,
+               binary, binary_version]
+    return hashlib.sha256(json.dumps(payload).encode('utf-8')).hexdigest()
+
+
+def _file_digest(path: str) -> Optional[str]:
+    "Return the SHA-256 digest of a file's content, or None if it isn't a file."
+    if not os.path.isfile(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _folder_digest(path: str) -> Optional[str]:
+    """
+    Return a digest of the name, size and modification time of every file in
+    a folder wiki, which changes whenever a tiddler does, or None if it isn't
+    a folder.
+    """
+    if not os.path.isdir(path):
+        return None
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            file_path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            entry = f"{os.path.relpath(file_path, path)}\0{st.st_mtime_ns}\0{st.st_size}\n"
+            h.update(entry.encode('utf-8', 'surrogateescape'))
+    return h.hexdigest()
 
 
 def _folderify_wiki(tw_binary: str, wiki_path: str, output_directory: str,
-                    password: str = "") -> None:
+                    password: str = "", low_priority: bool = False) -> None:
     """
     Convert a single-file wiki into a folder wiki so we can continue working with it.
 
@@ -45,6 +150,7 @@ def _folderify_wiki(tw_binary: str, wiki_path: str, output_directory: str,
     :param wiki_path:        Path of the wiki file to convert to a folder.
     :param output_directory: Directory to place the folder wiki in.
     :param password:         Password with which to decrypt the wiki, if one is needed.
+    :param low_priority:     Run TiddlyWiki at idle priority.
     """
     if not os.path.exists(wiki_path):
         raise ConfigurationError(
@@ -59,18 +165,25 @@ def _folderify_wiki(tw_binary: str, wiki_path: str, output_directory: str,
     if password:
         cmd.extend(("--password", password))
     cmd.extend(("--load", wiki_path, "--savewikifolder", output_directory))
-    _invoke_tw_command(cmd, None, "folderify wiki")
+    _invoke_tw_command(cmd, None, "folderify wiki", low_priority)
 
 
 def _invoke_tw_command(cmd: Sequence[str], wiki_path: Optional[str],
-                       description: str) -> None:
+                       description: str, low_priority: bool = False) -> None:
     """
     Call the TiddlyWiki node command with the provided arguments and handle errors.
+    If /low_priority/, it runs at idle priority, so as not to slow Anki down.
     """
     try:
-        proc = subprocess.run(cmd, cwd=wiki_path, stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT, check=True,
-                              startupinfo=nowin_startupinfo())
+        with subprocess.Popen(cmd, cwd=wiki_path, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, startupinfo=nowin_startupinfo(),
+                              creationflags=low_priority_creationflags() if low_priority else 0
+                              ) as process:
+            if low_priority:
+                lower_priority(process.pid)
+            stdout, _ = process.communicate()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stdout)
     except FileNotFoundError as e:
         raise ConfigurationError(
             f"The TiddlyWiki executable at '{cmd[0]}' was not found. Please set the "
@@ -93,40 +206,140 @@ def _notes_from_paths(
     paths: Sequence[Path],
     wiki: Wiki,
     callback: Optional[Callable[[int, int], None]],
-    warnings: List[str]) -> Set[TwNote]:
+    warnings: List[str],
+    media_cache: Optional[MediaCache] = None,
+    parse_cache: Optional[ParseCache] = None) -> Set[TwNote]:
     """
     Given an iterable of paths, compile the notes found in all those tiddlers.
+    See _iter_notes_from_paths() for the parameters.
+    """
+    notes: Set[TwNote] = set()
+    for found in _iter_notes_from_paths(paths, wiki, callback, warnings,
+                                        media_cache, parse_cache):
+        notes.update(found)
+    return notes
+
+
+def _iter_notes_from_paths(
+    paths: Sequence[Path],
+    wiki: Wiki,
+    callback: Optional[Callable[[int, int], None]],
+    warnings: List[str],
+    media_cache: Optional[MediaCache] = None,
+    parse_cache: Optional[ParseCache] = None,
+    discard: bool = False) -> Iterator[Set[TwNote]]:
+    """
+    Given an iterable of paths, yield the notes found in each of those
+    tiddlers in turn, as soon as it has been parsed.
 
     :param paths: The paths of the tiddlers to generate notes for.
     :param wiki:  Details on the wiki these notes come from.
     :param callback: Optional callable passing back progress. See :func:`find_notes`.
     :param warnings: List to add warnings of any non-critical conditions to.
-    :return: A set of all the notes found in the tiddler files passed.
+    :param media_cache: Cache to look up media referenced by the notes in.
+    :param parse_cache: Cache of the notes found in each tiddler last time,
+                        used for tiddlers whose rendered HTML hasn't changed.
+    :param discard: Delete each file once it has been read.
+    :return: An iterator over a (possibly empty) set of notes for each
+             tiddler file passed.
+
+    Where the same note appears in several tiddlers through transclusion, only
+    its first appearance is processed. Tiddlers are processed in order of
+    their filenames, so unless the note gives a reference, the same tiddler is
+    used as its reference on every sync.
     """
-    notes = set()
+    seen: Set[Twid] = set()
+    paths = sorted(paths)
+    if parse_cache is not None and media_cache is None:
+        media_cache = MediaCache(None)
     for index, tiddler in enumerate(paths, 0):
         with open(tiddler, 'rb') as f:
-            tid_text = f.read().decode()
-        tid_name = urllib.parse.unquote(
-            tiddler.name[:tiddler.name.find(f".{RENDERED_FILE_EXTENSION}")])
-        try:
-            notes.update(_notes_from_tiddler(tid_text, wiki, tid_name, warnings))
-        except ScheduleParsingError:
-            raise
-        except Exception as e:
-            tiddler_name = '.'.join(tiddler.name.rsplit('.', 1)[:-1])
-            raise TiddlerParsingError(tiddler_name) from e
+            tid_bytes = f.read()
+        if discard:
+            tiddler.unlink()
+        tid_name = _rendered_title(tiddler)
+
+        cached = None
+        if parse_cache is not None:
+            digest = hashlib.sha256(tid_bytes).hexdigest()
+            parsed = parse_cache.get(tid_name, digest)
+            if parsed is not None:
+                cached = _notes_from_cache(parsed, wiki, seen, media_cache)
+
+        if cached is not None:
+            found = cached
+            warnings.extend(parsed.warnings)
+        else:
+            tiddler_warnings: List[str] = []
+            skipped: List[Twid] = []
+            try:
+                found = _notes_from_tiddler(tid_bytes.decode(), wiki, tid_name,
+                                            tiddler_warnings, media_cache, seen,
+                                            skipped)
+            except ScheduleParsingError:
+                raise
+            except Exception as e:
+                tiddler_name = '.'.join(tiddler.name.rsplit('.', 1)[:-1])
+                raise TiddlerParsingError(tiddler_name) from e
+            warnings.extend(tiddler_warnings)
+            if parse_cache is not None:
+                parse_cache.put(tid_name, digest, ParsedTiddler(
+                    [n.to_dict() for n in sorted(found, key=lambda n: n.id_)],
+                    skipped, tiddler_warnings))
 
         if callback is not None and not index % 50:
             callback(index+1, len(paths))
+        yield found
 
     if callback is not None:
         callback(len(paths), len(paths))
+
+
+def _notes_from_cache(parsed: ParsedTiddler, wiki: Wiki, seen: Set[Twid],
+                      media_cache: MediaCache) -> Optional[Set[TwNote]]:
+    """
+    Recreate the notes a tiddler was found to contain last time, as long as
+    parsing it again would give the same notes, and add their IDs to /seen/.
+
+    Return None, leaving /seen/ alone, if the tiddler needs parsing again:
+    because one of its notes has now been found in an earlier tiddler or one
+    it skipped hasn't, or because a local media file it uses has changed.
+    """
+    if any(id_ in seen for id_ in (n['id'] for n in parsed.notes)) \
+            or not seen.issuperset(parsed.skipped):
+        return None
+
+    notes = _rebuild_notes(parsed.notes, wiki, media_cache)
+    if notes is not None:
+        seen.update(n.id_ for n in notes)
+    return notes
+
+
+def _rebuild_notes(dicts: Iterable[Dict], wiki: Wiki,
+                   media_cache: MediaCache) -> Optional[Set[TwNote]]:
+    """
+    Recreate cached notes saved with TwNote.to_dict(), or return None if
+    they can't be, or if a local media file they use has changed since.
+    """
+    try:
+        notes = {TwNote.from_dict(n, wiki) for n in dicts}
+        for note in notes:
+            for medium in note.media:
+                if medium.source.startswith('data:'):
+                    continue
+                current = media_cache.get(medium.url, medium.source, [])
+                if current.filename != medium.filename:
+                    return None
+    except Exception:  # pylint: disable=broad-except
+        return None
     return notes
 
 
 def _notes_from_tiddler(tiddler: str, wiki: Wiki, tiddler_name: str,
-                        warnings: List[str]) -> Set[TwNote]:
+                        warnings: List[str],
+                        media_cache: Optional[MediaCache] = None,
+                        seen: Optional[Set[Twid]] = None,
+                        skipped: Optional[List[Twid]] = None) -> Set[TwNote]:
     """
     Given the text of a tiddler, parse the contents and return a set
     containing all the TwNotes found within that tiddler.
@@ -135,15 +348,33 @@ def _notes_from_tiddler(tiddler: str, wiki: Wiki, tiddler_name: str,
     :param wiki:         The wiki this tiddler comes from, for traceability purposes.
     :param tiddler_name: The name of the tiddler itself, for traceability purposes.
     :param warnings:     A list to add warnings of any non-critical issues to.
+    :param media_cache:  Cache to look up media referenced by the notes in.
+    :param seen:         IDs of notes already found in other tiddlers, which
+                         are skipped. IDs of the notes found are added.
+    :param skipped:      If provided, a list to add the IDs of the notes
+                         skipped because they were in /seen/ to.
     :return: A (possibly empty) set of all the notes found in this tiddler.
     """
     soup = BeautifulSoup(tiddler, 'html.parser')
     ensure_version(soup)
-    return TwNote.notes_from_soup(soup, wiki, tiddler_name, warnings)
+    notes = TwNote.notes_from_soup(soup, wiki, tiddler_name, warnings, media_cache, seen,
+                                   source=tiddler)
+    if skipped is not None:
+        found = {n.id_ for n in notes}
+        skipped.extend(sorted({read_note_id(rid)
+                               for rid in soup.find_all("div", class_="rid")}
+                              - found))
+    return notes
+
+
+def _rendered_title(path: Path) -> str:
+    "Return the title of the tiddler rendered to the file /path/."
+    return urllib.parse.unquote(path.name[:path.name.find(f".{RENDERED_FILE_EXTENSION}")])
 
 
 def _render_wiki(tw_binary: str, wiki_path: str, output_directory: str,
-                 filter_: str) -> None:
+                 filter_: str, titles: Optional[Collection[str]] = None,
+                 low_priority: bool = False) -> None:
     """
     Request that TiddlyWiki render the specified tiddlers as HTML to a
     location where we can inspect them for notes.
@@ -153,6 +384,10 @@ def _render_wiki(tw_binary: str, wiki_path: str, output_directory: str,
     :param output_directory: Directory to render html files into.
     :param filter_: TiddlyWiki filter describing which tiddlers we want
                     to search for notes.
+    :param titles: If provided, only those of these tiddlers that exist and
+                   match /filter_/ are rendered. None of the titles may
+                   contain ']]' or a line break.
+    :param low_priority: Run TiddlyWiki at idle priority.
 
     Raises:
         ConfigurationError - if something is wrong with the TR configuration
@@ -169,18 +404,30 @@ def _render_wiki(tw_binary: str, wiki_path: str, output_directory: str,
             f"The wiki folder '{wiki_path}' is a file. If you meant to "
             f"use a single-file wiki, set the 'type' parameter to 'file'.")
 
-    cmd = [
-        tw_binary,
-        "--verbose",
-        "--output",
-        output_directory,
-        "--render",
-        filter_,
-        f"[encodeuricomponent[]addsuffix[.{RENDERED_FILE_EXTENSION}]]",
-        "text/html",
-        "$:/plugins/sobjornstad/TiddlyRemember/templates/TiddlyRememberParseable"
-    ]
-    _invoke_tw_command(cmd, wiki_path, "render wiki")
+    with TemporaryDirectory() as tmpdir:
+        cmd = [tw_binary, "--verbose"]
+        if titles is not None:
+            # The titles and the filter are loaded into a temporary tiddler
+            # rather than written into the filter, where they would need
+            # escaping that TiddlyWiki doesn't provide.
+            changed_file = os.path.join(tmpdir, "changed.json")
+            with open(changed_file, 'w', encoding='utf-8') as f:
+                json.dump([{'title': CHANGED_TIDDLERS,
+                            'list': ' '.join(f"[[{title}]]" for title in sorted(titles)),
+                            'text': filter_}], f)
+            cmd.extend(("--load", changed_file))
+            filter_ = (f"[list[{CHANGED_TIDDLERS}]!is[missing]] "
+                       f"+[subfilter{{{CHANGED_TIDDLERS}}}]")
+        cmd.extend((
+            "--output",
+            output_directory,
+            "--render",
+            filter_,
+            f"[encodeuricomponent[]addsuffix[.{RENDERED_FILE_EXTENSION}]]",
+            "text/html",
+            "$:/plugins/sobjornstad/TiddlyRemember/templates/TiddlyRememberParseable"
+        ))
+        _invoke_tw_command(cmd, wiki_path, "render wiki", low_priority)
 
 
 # pylint: disable=too-many-arguments, too-many-locals
@@ -189,7 +436,9 @@ def find_notes(
     password: str = "",
     requests_session: Optional[requests.Session] = None,
     callback: Optional[Callable[[int, int], None]] = None,
-    warnings: Optional[List[str]] = None) -> Set[TwNote]:
+    warnings: Optional[List[str]] = None,
+    cache_dir: Optional[str] = None,
+    low_priority: bool = False) -> Set[TwNote]:
     """
     Return a tuple of TwNotes parsed out of a TiddlyWiki.
 
@@ -213,38 +462,125 @@ def find_notes(
                       tiddler 1, once the wiki has been rendered.
     :param warnings:  Optional list which will have lines appended to it for any
                       non-critical issues that arise during the sync.
+    :param cache_dir: Optional directory in which to keep information that can
+                      speed up later extractions of the same wiki, such as the
+                      hashes of media files that have already been retrieved
+                      and the notes found in tiddlers that haven't changed.
+                      If the wiki hasn't changed at all since the last
+                      extraction, the notes found then are returned without
+                      rendering it (see wikicache.py).
+    :param low_priority: Run TiddlyWiki at idle priority, when extracting
+                      the wiki ahead of time (see prefetch.py).
+
+    Be aware that transclusions can result in the same rendered HTML for
+    a given invocation of <<remember*>> appearing in multiple tiddlers.
+    Only one TwNote is returned for each ID, taken from the first tiddler
+    it appears in (see _iter_notes_from_paths()).
+    """
+    return set(iter_notes(tw_binary, wiki_path, wiki_type, wiki_name, filter_, password,
+                          requests_session, callback, warnings, cache_dir, low_priority))
+
 
-    Be aware that more than one TwNote can be returned for a given invocation
-    of <<remember*>> in TiddlyWiki. This is because transclusions can result
-    in the same rendered HTML appearing in multiple places.
+def iter_notes(
+    tw_binary: str, wiki_path: str, wiki_type: str, wiki_name: str, filter_: str,
+    password: str = "",
+    requests_session: Optional[requests.Session] = None,
+    callback: Optional[Callable[[int, int], None]] = None,
+    warnings: Optional[List[str]] = None,
+    cache_dir: Optional[str] = None,
+    low_priority: bool = False) -> Iterator[TwNote]:
+    """
+    Yield the TwNotes that find_notes() would return, each as soon as the
+    tiddler it's in has been parsed, so that the caller can start work on
+    them while the rest of the wiki is. The parameters are as for find_notes().
+
+    Each rendered tiddler is deleted once it has been read. The caches are
+    only saved once the last note has been yielded, and the wiki's lock is
+    held from the first note until then, so an iterator shouldn't be left
+    unfinished for long; closing it gives up the extraction.
     """
+    with _wiki_lock(wiki_name), sharing_tags():
+        yield from _iter_notes(tw_binary, wiki_path, wiki_type, wiki_name, filter_, password,
+                               requests_session, callback, warnings, cache_dir, low_priority)
+
+
+def _iter_notes(
+    tw_binary: str, wiki_path: str, wiki_type: str, wiki_name: str, filter_: str,
+    password: str, requests_session: Optional[requests.Session],
+    callback: Optional[Callable[[int, int], None]], warnings: Optional[List[str]],
+    cache_dir: Optional[str], low_priority: bool) -> Iterator[TwNote]:
+    "Extract notes from a wiki, as iter_notes() does, once the wiki's lock is held."
     if warnings is None:
         warnings = []
+    first_warning = len(warnings)
+
+    media_cache = MediaCache(
+        cache_path(Path(cache_dir), 'media', wiki_name, 'json')
+        if cache_dir is not None else None)
+    wiki_cache = WikiCache(
+        cache_path(Path(cache_dir), 'wiki', wiki_name, 'json.gz')
+        if cache_dir is not None else None,
+        _extraction_key(tw_binary, wiki_path, wiki_type, filter_))
 
     with TemporaryDirectory() as tmpdir:
         try:
+            wiki_file: Optional[str] = None
+            downloaded_file = os.path.join(tmpdir, 'wiki.html')
+            validators: Optional[Dict[str, str]] = None
+            content: Optional[str] = None
             if wiki_type == 'file':
+                wiki_file = wiki_path
                 wiki_folder = os.path.join(tmpdir, 'wikifolder')
-                _folderify_wiki(tw_binary, wiki_path, wiki_folder, password)
                 wiki = Wiki(wiki_name, Path(wiki_path), Path(wiki_folder),
                             WikiType.FILE)
+                if wiki_cache.enabled:
+                    content = _file_digest(wiki_path)
 
             elif wiki_type == 'folder':
                 wiki_folder = wiki_path
                 wiki = Wiki(wiki_name, Path(wiki_path), Path(wiki_path),
                             WikiType.FOLDER)
+                if wiki_cache.enabled:
+                    content = _folder_digest(wiki_path)
 
             elif wiki_type == 'url':
-                downloaded_file = os.path.join(tmpdir, 'wiki.html')
-                _download_wiki(url=wiki_path, target_location=downloaded_file,
-                               requests_session=requests_session)
+                wiki_file = downloaded_file
+                validators = _download_wiki(url=wiki_path, target_location=downloaded_file,
+                                            requests_session=requests_session,
+                                            validators=wiki_cache.validators)
                 wiki_folder = os.path.join(tmpdir, 'wikifolder')
-                _folderify_wiki(tw_binary, downloaded_file, wiki_folder, password)
                 wiki = Wiki(wiki_name, wiki_path, Path(wiki_folder), WikiType.URL)
+                if validators is None:
+                    # Not modified since the last download.
+                    content = wiki_cache.content
+                elif wiki_cache.enabled:
+                    content = _file_digest(downloaded_file)
 
             else:
                 raise Exception(f"Invalid wiki type '{wiki_type}' -- must be "
                                 f"'file', 'folder', or 'url'.")
+
+            # If the wiki hasn't changed since the last extraction,
+            # there's no need to render it again.
+            cached = wiki_cache.get(content)
+            if cached is not None:
+                notes = _rebuild_notes(cached.notes, wiki, media_cache)
+                if notes is not None:
+                    warnings.extend(cached.warnings)
+                    if callback is not None:
+                        callback(cached.tiddlers, cached.tiddlers)
+                    media_cache.save()
+                    yield from notes
+                    return
+            if wiki_type == 'url' and validators is None:
+                # We need the wiki after all, say because a media file changed.
+                validators = _download_wiki(url=wiki_path,
+                                            target_location=downloaded_file,
+                                            requests_session=requests_session)
+                content = _file_digest(downloaded_file)
+
+            if wiki_file is not None:
+                _folderify_wiki(tw_binary, wiki_file, wiki_folder, password, low_priority)
         except ConfigurationError as e:
             # Add a little more context so it's clear where to look for the problem.
             raise ConfigurationError(
@@ -252,12 +588,163 @@ def find_notes(
                 f"'{wiki_name}': {str(e)}"
             ) from e
 
+        parse_cache = ParseCache(
+            cache_path(Path(cache_dir), 'parse', wiki_name, 'sqlite')
+            if cache_dir is not None else None,
+            str(wiki.source_path))
+
         render_location = os.path.join(tmpdir, 'render')
-        _render_wiki(tw_binary, wiki_folder, render_location, filter_)
-        notes = _notes_from_paths(
-            list(Path(render_location).glob(f"*.{RENDERED_FILE_EXTENSION}")),
-            wiki,
-            callback,
-            warnings)
+        _render_wiki(tw_binary, wiki_folder, render_location, filter_,
+                     low_priority=low_priority)
+        paths = list(Path(render_location).glob(f"*.{RENDERED_FILE_EXTENSION}"))
+        # Only what the wiki cache needs is kept of the notes once yielded.
+        extracted: List[Dict] = []
+        with closing(parse_cache):
+            for found in _iter_notes_from_paths(paths, wiki, callback, warnings,
+                                                media_cache, parse_cache, discard=True):
+                if wiki_cache.enabled:
+                    extracted.extend(n.to_dict() for n in found)
+                yield from found
+            parse_cache.save()
+        media_cache.save()
+
+    wiki_cache.put(content, CachedExtraction(
+        sorted(extracted, key=lambda n: n['id']),
+        warnings[first_warning:], len(paths)), validators)
+
+
+def find_changed_notes(
+    tw_binary: str, wiki_path: str, wiki_name: str, filter_: str,
+    titles: Collection[str], cache_dir: str,
+    warnings: Optional[List[str]] = None) -> Optional[TiddlerChanges]:
+    """
+    Extract notes from only some tiddlers of a folder wiki, which have been
+    added, edited, or deleted since it was last extracted by find_notes().
 
-    return notes
+    :param tw_binary: Path to the TiddlyWiki node executable.
+    :param wiki_path: Path of the wiki folder.
+    :param wiki_name: The name/ID the user has provided for the wiki.
+    :param filter_:   TiddlyWiki filter describing which tiddlers
+                      to search for notes.
+    :param titles:    Titles of the tiddlers that have changed, including
+                      any that no longer exist.
+    :param cache_dir: The directory find_notes() was given as /cache_dir/.
+                      The parse cache kept there tells which notes came from
+                      the tiddlers before they changed.
+    :param warnings:  Optional list which will have lines appended to it for any
+                      non-critical issues that arise during the extraction.
+    :return: The notes now found in the tiddlers, and the IDs of the notes
+             that were found in them before and aren't now found in them or
+             in any other tiddler, which can be removed from Anki. None if
+             the wiki has to be extracted in full instead, because it
+             hasn't been with this cache yet or a title can't be passed to
+             TiddlyWiki.
+
+    A note transcluded from one of the tiddlers into a tiddler that hasn't
+    changed may take its reference from a different tiddler than it would
+    in a full extraction, until the next one.
+    """
+    if warnings is None:
+        warnings = []
+    if any(']]' in title or '\n' in title for title in titles):
+        return None
+
+    return _scoped_changes(
+        wiki_name, wiki_path, titles, cache_dir, warnings,
+        lambda output_directory: _render_wiki(tw_binary, wiki_path, output_directory,
+                                              filter_, titles))
+
+
+def find_pushed_notes(
+    wiki_path: str, wiki_name: str, tiddlers: Dict[str, str],
+    deleted: Collection[str], cache_dir: str,
+    warnings: Optional[List[str]] = None) -> Optional[TiddlerChanges]:
+    """
+    Extract notes from tiddlers of a folder wiki that a running TiddlyWiki
+    has rendered itself and pushed to us (see pushserver.py), as
+    find_changed_notes() does for tiddlers that we render.
+
+    :param wiki_path: Path of the wiki folder.
+    :param wiki_name: The name/ID the user has provided for the wiki.
+    :param tiddlers:  The HTML of each tiddler added or edited, by title,
+                      rendered through the TiddlyRememberParseable template.
+    :param deleted:   Titles of the tiddlers that have been deleted, or are no
+                      longer selected by the wiki's content filter.
+    :param cache_dir: The directory find_notes() was given as /cache_dir/.
+    :param warnings:  Optional list which will have lines appended to it for any
+                      non-critical issues that arise during the extraction.
+    :return: As for find_changed_notes().
+    :raises ExtractError: If a tiddler uses a local media file from outside
+                          the wiki folder.
+    """
+    if warnings is None:
+        warnings = []
+    for title, html in tiddlers.items():
+        _check_pushed_media(wiki_path, title, html)
+
+    def write_rendered(output_directory: str) -> None:
+        os.makedirs(output_directory)
+        for title, html in tiddlers.items():
+            name = urllib.parse.quote(title, safe="-_.!~*'()")
+            Path(output_directory, f"{name}.{RENDERED_FILE_EXTENSION}").write_text(
+                html, encoding='utf-8')
+
+    return _scoped_changes(wiki_name, wiki_path, set(tiddlers).union(deleted),
+                           cache_dir, warnings, write_rendered)
+
+
+def _check_pushed_media(wiki_path: str, title: str, html: str) -> None:
+    """
+    Raise an ExtractError if a pushed tiddler uses a local media file from
+    outside the wiki folder, by an absolute file:// URL or a path leading out
+    of it. Anything on this computer could otherwise be copied into Anki by
+    whoever can push.
+    """
+    root = Path(wiki_path).resolve()
+    for elem in BeautifulSoup(html, 'html.parser').find_all(("img", "audio")):
+        src = elem.attrs.get('src')
+        if src is None or src.startswith('data:'):
+            continue
+        if '://' in src:
+            outside = urllib.parse.urlsplit(src).scheme.lower() == 'file'
+        else:
+            path = (root / src).resolve()
+            outside = path != root and root not in path.parents
+        if outside:
+            raise ExtractError(
+                f"The tiddler '{title}' uses the media file '{src}', which is outside "
+                f"the wiki folder, so it can't be pushed. Please sync from the Tools "
+                f"menu instead.")
+
+
+def _scoped_changes(wiki_name: str, wiki_path: str, titles: Collection[str],
+                    cache_dir: str, warnings: List[str],
+                    render: Callable[[str], None]) -> Optional[TiddlerChanges]:
+    """
+    Find the notes in the tiddlers /titles/ of a folder wiki, once /render/
+    has written those that exist to the directory it's called with, and
+    work out which notes that came from them can be removed.
+    Return None if the wiki hasn't been extracted with this cache yet.
+    """
+    wiki = Wiki(wiki_name, Path(wiki_path), Path(wiki_path), WikiType.FOLDER)
+    # Media of the tiddlers that haven't changed isn't looked up, so the media
+    # cache is only read here: saving it would drop their entries.
+    media_cache = MediaCache(cache_path(Path(cache_dir), 'media', wiki_name, 'json'))
+    parse_cache = ParseCache(cache_path(Path(cache_dir), 'parse', wiki_name, 'sqlite'),
+                             str(wiki.source_path))
+    with _wiki_lock(wiki_name), closing(parse_cache), sharing_tags():
+        if parse_cache.empty:
+            return None
+        previous = parse_cache.notes_in(titles)
+
+        with TemporaryDirectory() as tmpdir:
+            render_location = os.path.join(tmpdir, 'render')
+            render(render_location)
+            paths = list(Path(render_location).glob(f"*.{RENDERED_FILE_EXTENSION}"))
+            notes = _notes_from_paths(paths, wiki, None, warnings, media_cache, parse_cache)
+
+        parse_cache.forget(set(titles).difference(_rendered_title(p) for p in paths))
+        parse_cache.save(prune=False)
+        gone = previous.difference(n.id_ for n in notes)
+        removable = gone.difference(parse_cache.still_found(gone))
+    return TiddlerChanges(notes, removable)
@@ -5,31 +5,70 @@ TiddlyWiki note instances extract and store the data from the rendered HTML
 representation of a TiddlyWiki (see twimport.py).
 """
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import date
 import hashlib
-import mimetypes
+import json
 from pathlib import Path
 import re
-from typing import Any, List, Optional, Set, Tuple, Type
+import sys
+import threading
+from typing import (AbstractSet, Any, Dict, FrozenSet, Iterable, Iterator, List,
+                    NamedTuple, Optional, Set, Tuple, Type, Union)
+import unicodedata
 from urllib.error import HTTPError, URLError
-from urllib.request import urlopen
 from urllib.parse import quote as urlquote
 
-from anki.collection import Collection
+# anki.collection must be imported before anki.notes to avoid a circular import.
+import anki.collection  # pylint: disable=unused-import
 from anki.notes import Note
 from bs4 import BeautifulSoup
 
 from .clozeparse import ankify_clozes
+from .media import MediaCache, TwMedia
 from .oops import ConfigurationError, ExtractError, ScheduleParsingError
+from .snapshot import NoteRow
 from .trmodels import (TiddlyRememberQuestionAnswer, TiddlyRememberCloze,
-                       TiddlyRememberPair, ID_FIELD_NAME)
+                       TiddlyRememberPair, ID_FIELD_NAME, WIKI_FIELD_NAME)
 from .util import (
     COMPATIBLE_TW_VERSIONS, PLUGIN_VERSION, Twid,
-    pushd, split_tiddler_list, tw_quote
+    split_tiddler_list, tw_quote
 )
 from .wiki import Wiki, WikiType
 
+#: An Anki note, or a row loaded from the collection standing in for one
+#: when it's only being compared against.
+AnkiNoteLike = Union[Note, NoteRow]
+
+#: One copy of each distinct set of tags, shared by all the notes that use it,
+#: kept only while notes are being extracted (see sharing_tags()).
+_TAG_SETS: Dict[FrozenSet[str], FrozenSet[str]] = {}
+_tag_set_users = 0
+_tag_sets_lock = threading.Lock()
+
+#: Media of notes that don't use any.
+_NO_MEDIA: FrozenSet[TwMedia] = frozenset()
+
+#: Things in a tiddler's HTML that _index_metadata() has to account for: the
+#: start of a note's metadata block, the class of a note's container, or any
+#: other mention of one of the classes of the metadata block.
+_METADATA_TOKEN = re.compile(
+    r'(?P<block><div class="rid">)'
+    r'|(?P<note>\bremember(?:q|p|cz)\b)'
+    r'|(?P<stray>\btr-(?:reference|sched|deck|tags)\b|=\s*["\']?[^"\'<>=]*\brid\b)')
+
+#: The metadata block rendered by the twRememberMetadata macro.
+_METADATA_BLOCK = re.compile(
+    r'<div class="rid">([^<]*)</div>\s*'
+    r'<div class="tr-reference">([^<]*)</div>\s*'
+    r'<div class="tr-sched">([^<]*)</div>\s*'
+    r'<div class="tr-deck">([^<]*)</div>\s*'
+    r'<div class="tr-tags">([^<]*)</div>')
+
+#: Control characters Anki removes from the content of fields when saving a note.
+_ANKI_STRIPPED_CHARS = re.compile('[\x00-\x08\x0b-\x1f\x7f]')
+
 
 @dataclass
 class SchedulingInfo():
@@ -42,47 +81,34 @@ class SchedulingInfo():
     lapses: int
 
 
-class TwMedia:
+class NoteMetadata(NamedTuple):
     """
-    One media file being imported into Anki from TiddlyWiki.
+    The text of the metadata block the twRememberMetadata macro renders at the
+    end of every note, as read by index_metadata().
     """
-    def __init__(self, data: bytes, url: str, warnings: List[str]) -> None:
-        self.data = data
-        self.url = url
-        self.hash = hashlib.sha256(data).hexdigest()
+    id_: Twid
+    reference: str
+    sched: str
+    deck: str
+    tags: str
 
-        mime_type, _ = mimetypes.guess_type(url)
-        self.extension = mimetypes.guess_extension(mime_type or "")
-        if self.extension is None:
-            warnings.append(f"Unknown media type for URL '{url}': using extension "
-                            f"'xxx'. The media may not render correctly in Anki.")
-            self.extension = ".xxx"
-        self.filename = "tr-" + self.hash + self.extension
 
-    def __eq__(self, other) -> bool:
-        return self.hash == other.hash
+#: The line and column at which an element starts in a tiddler's HTML,
+#: as given by the sourceline and sourcepos of its soup.
+SourcePosition = Tuple[int, int]
 
-    def __hash__(self) -> int:
-        return hash(self.hash)
 
-    def __repr__(self) -> str:
-        return f"TwMedia(extension={self.extension}, src={self.url}, hash={self.hash})"
-
-    def write_to_anki(self, col: Collection) -> None:
-        """
-        Save the file to Anki's media folder if it isn't already there.
+class _FieldRecorder:
+    """
+    Stand-in for an Anki note that records the field values and tags a TwNote
+    writes to it in update_fields(), without needing a collection.
+    """
+    def __init__(self) -> None:
+        self.fields: Dict[str, str] = {}
+        self.tags: List[str] = []
 
-        Since our filenames are based on a hash of their content, we can try to
-        add media as many times as we want while updating without risk of ending
-        up with duplicates.  (If the user added the media directly to Anki
-        themselves, then we might end up with one duplicate, but there's nothing
-        we can do about that unless we want to read through the entire media
-        directory and hash every file.)
-        """
-        assert self.extension is not None, \
-            "Unable to determine filename extension to use."
-        if not col.media.have(self.filename):
-            col.media.write_data(desired_fname=self.filename, data=self.data)
+    def __setitem__(self, field_name: str, value: str) -> None:
+        self.fields[field_name] = value
 
 
 class TwNote(metaclass=ABCMeta):
@@ -111,19 +137,30 @@ class TwNote(metaclass=ABCMeta):
     and updated from this TiddlyWiki note; see their docstrings for details.
     """
     model: Any = None  #: The ModelData class for the Anki note generated by this type
+    #: Attributes holding the content of the note, which are also the names of
+    #: the corresponding arguments to the subclass's constructor.
+    content_attrs: Tuple[str, ...] = ()
+
+    # A large wiki yields many thousands of notes, which are all kept in memory
+    # until the sync is done, so they're kept small: there's no __dict__, the
+    # strings many notes repeat are interned, and notes with the same tags
+    # share one frozen set of them. Subclasses list their content_attrs here.
+    __slots__ = ('id_', 'wiki', 'tidref', 'target_tags', 'target_deck',
+                 'permalink', 'schedule', 'media', '_digest')
 
     def __init__(self, id_: Twid, wiki: Wiki, tidref: str,
-                 target_tags: Set[str], target_deck: Optional[str],
-                 media: Optional[Set[TwMedia]],
+                 target_tags: AbstractSet[str], target_deck: Optional[str],
+                 media: Optional[AbstractSet[TwMedia]],
                  schedule: Optional[SchedulingInfo]) -> None:
         self.id_ = id_
         self.wiki = wiki
-        self.tidref = tidref
-        self.target_tags = target_tags
-        self.target_deck = target_deck
+        self.tidref = sys.intern(tidref)
+        self.target_tags = _shared_tags(target_tags)
+        self.target_deck = sys.intern(target_deck) if target_deck is not None else None
         self.permalink: Optional[str] = None
         self.schedule: Optional[SchedulingInfo] = schedule
-        self.media = media or set()
+        self.media: AbstractSet[TwMedia] = media or _NO_MEDIA
+        self._digest: Optional[str] = None
 
     def __eq__(self, other):
         return self.id_ == other.id_
@@ -135,23 +172,76 @@ class TwNote(metaclass=ABCMeta):
     def note_types(cls):
         return list(cls.__subclasses__())
 
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Return everything parsed from the wiki for this note as a dictionary
+        that can be serialized to JSON, so the note can be recreated with
+        from_dict() without parsing the tiddler again (see parsecache.py).
+        The wiki and the permalink aren't included, since they come from the
+        configuration rather than the tiddler.
+        """
+        return {
+            'type': type(self).__name__,
+            'id': self.id_,
+            'tidref': self.tidref,
+            'content': {attr: getattr(self, attr) for attr in self.content_attrs},
+            'tags': sorted(self.target_tags),
+            'deck': self.target_deck,
+            'media': [[m.url, m.source, m.hash, m.extension]
+                      for m in sorted(self.media, key=lambda m: m.hash)],
+            'schedule': None if self.schedule is None else [
+                self.schedule.ivl, self.schedule.due.isoformat(),
+                self.schedule.ease, self.schedule.lapses],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], wiki: Wiki) -> 'TwNote':
+        """
+        Recreate a note from the wiki /wiki/ saved with to_dict().
+
+        Raises KeyError if /data/ doesn't describe a note of a known type.
+        """
+        subclass = {c.__name__: c for c in cls.note_types()}[data['type']]
+        sched = data['schedule']
+        return subclass(  # type: ignore
+            Twid(data['id']),
+            wiki,
+            data['tidref'],
+            target_tags=set(data['tags']),
+            target_deck=data['deck'],
+            media={TwMedia(*m) for m in data['media']},
+            schedule=None if sched is None else SchedulingInfo(
+                sched[0], date.fromisoformat(sched[1]), sched[2], sched[3]),
+            **data['content'])
+
     @classmethod
     def notes_from_soup(cls, soup: BeautifulSoup,
                         wiki: Wiki, tiddler_name: str,
-                        warnings: List[str]) -> Set['TwNote']:
+                        warnings: List[str],
+                        media_cache: Optional[MediaCache] = None,
+                        seen: Optional[Set[Twid]] = None,
+                        source: Optional[str] = None) -> Set['TwNote']:
         """
         Given soup for a tiddler and the tiddler's name, create notes by calling
         the wants_soup and parse_html methods of each candidate subclass.
+
+        If /seen/ is provided, notes with IDs in it are skipped, and the IDs
+        of the notes found are added to it. If /source/, the HTML the soup
+        was parsed from, is provided, the notes' metadata is read from it
+        directly where possible (see index_metadata()).
         """
+        if seen is None:
+            seen = set()
+        metadata = index_metadata(source) if source is not None else {}
         notes: Set[TwNote] = set()
         for subclass in cls.__subclasses__():
             wanted_soup = subclass.wants_soup(soup)  # type: ignore
             if wanted_soup:
-                notes.update(subclass.parse_html(
-                    soup, wiki, tiddler_name, warnings))  # type: ignore
+                notes.update(subclass.parse_html(  # type: ignore
+                    soup, wiki, tiddler_name, warnings, media_cache, seen, metadata))
         return notes
 
-    def _assert_correct_model(self, anki_note: Note) -> None:
+    def _assert_correct_model(self, anki_note: AnkiNoteLike) -> None:
         """
         Raise an assertion error if the :attr:`anki_note` doesn't match
         the current class's model.
@@ -170,10 +260,17 @@ class TwNote(metaclass=ABCMeta):
         A quick test shows most if not all special characters are valid in tags;
         I cannot find further documentation on any issues these may cause.
         Spaces aren't, though, since tags are separated by spaces.
+
+        Like Anki, we treat tags differing only in case as the same tag, and
+        return the tags sorted, so the result doesn't depend on set ordering.
         """
-        return [t.replace(' ', '_') for t in self.target_tags]
+        tags: Dict[str, str] = {}
+        for tag in sorted(self.target_tags):
+            tag = tag.replace(' ', '_')
+            tags.setdefault(tag.casefold(), tag)
+        return sorted(tags.values(), key=str.casefold)
 
-    def fields_equal(self, anki_note: Note) -> bool:
+    def fields_equal(self, anki_note: AnkiNoteLike) -> bool:
         """
         Compare the fields on this TwNote to an Anki note. Return True if all
         are equal.
@@ -181,7 +278,7 @@ class TwNote(metaclass=ABCMeta):
         self._assert_correct_model(anki_note)
         return self._fields_equal(anki_note)
 
-    def model_equal(self, anki_note: Note) -> bool:
+    def model_equal(self, anki_note: AnkiNoteLike) -> bool:
         """
         Compare the model (note type) defined for this TwNote to that of
         an Anki note. Return True if it is the same model.
@@ -198,6 +295,18 @@ class TwNote(metaclass=ABCMeta):
         the wiki. May be used to replace an existing permalink.
         """
         self.permalink = base_url + "#" + urlquote(self.tidref)
+        self._digest = None
+
+    def set_content(self, **content: str) -> None:
+        """
+        Replace some of the content of this note, given by the names in
+        /content_attrs/, once it has been extracted.
+        """
+        for attr, value in content.items():
+            if attr not in self.content_attrs:
+                raise AttributeError(f"{type(self).__name__} has no content '{attr}'")
+            setattr(self, attr, value)
+        self._digest = None
 
     def update_fields(self, anki_note: Note) -> None:
         """
@@ -206,17 +315,38 @@ class TwNote(metaclass=ABCMeta):
         self._assert_correct_model(anki_note)
         self._update_fields(anki_note)
 
-    def _base_equal(self, anki_note: Note) -> bool:
+    @property
+    def digest(self) -> str:
+        """
+        A fingerprint of everything update_fields() writes to an Anki note:
+        the note type, the value of each field, and the tags. Two TwNotes with
+        the same digest produce identical Anki notes (apart from their deck,
+        which is a property of the cards rather than the note).
+
+        A sync needs it several times, so it's kept until the note is changed
+        with set_permalink() or set_content().
+        """
+        if self._digest is None:
+            recorder = _FieldRecorder()
+            self._update_fields(recorder)  # type: ignore
+            payload = [self.model.name,
+                       sorted(recorder.fields.items()),
+                       sorted(recorder.tags)]
+            self._digest = hashlib.sha256(
+                json.dumps(payload, ensure_ascii=False).encode('utf-8')).hexdigest()
+        return self._digest
+
+    def _base_equal(self, anki_note: AnkiNoteLike) -> bool:
         """
         Built-in base equality check for fields that should be the same on all types.
         Subclass must explicitly call this method if it wishes to use it.
         """
         return (
             self.id_ == anki_note[ID_FIELD_NAME]
-            and self.wiki.name == anki_note['Wiki']
-            and self.tidref == anki_note['Reference']
-            and (self.permalink or "") == anki_note['Permalink']
-            and self.anki_tags == anki_note.tags
+            and fields_match(self.wiki.name, anki_note[WIKI_FIELD_NAME])
+            and fields_match(self.tidref, anki_note['Reference'])
+            and fields_match(self.permalink or "", anki_note['Permalink'])
+            and tags_match(self.anki_tags, anki_note.tags)
         )
 
     def _base_update(self, anki_note: Note) -> None:
@@ -224,7 +354,7 @@ class TwNote(metaclass=ABCMeta):
         Built-in update functionality for fields that should be the same on all types.
         Subclass must explicitly call this method if it wishes to use it.
         """
-        anki_note['Wiki'] = self.wiki.name
+        anki_note[WIKI_FIELD_NAME] = self.wiki.name
         anki_note['Reference'] = self.tidref
         anki_note['Permalink'] = self.permalink if self.permalink is not None else ""
         anki_note[ID_FIELD_NAME] = self.id_
@@ -246,12 +376,20 @@ class TwNote(metaclass=ABCMeta):
     @classmethod
     @abstractmethod
     def parse_html(cls, soup: BeautifulSoup, wiki: Wiki, tiddler_name: str,
-                   warnings: List[str]):  # pragma: no cover
+                   warnings: List[str],
+                   media_cache: Optional[MediaCache] = None,
+                   seen: Optional[Set[Twid]] = None,
+                   metadata: Optional[Dict[SourcePosition, NoteMetadata]] = None
+                   ):  # pragma: no cover
         """
         Given soup and the name of the wiki and its tiddler, construct and return
         any TwNotes of this subclass's type that can be extracted from it.
 
         Add a message for any non-critical issues that arise to the list of warnings.
+        Media is looked up through `media_cache`, if provided (see extract_media()).
+        Notes whose IDs are in `seen` are skipped, and the IDs of the notes
+        returned are added to it (see _unseen_notes()). The metadata of notes
+        found in `metadata` is taken from there rather than the soup.
         """
         raise NotImplementedError
 
@@ -266,7 +404,7 @@ class TwNote(metaclass=ABCMeta):
         raise NotImplementedError
 
     @abstractmethod
-    def _fields_equal(self, anki_note: Note) -> bool:  # pragma: no cover
+    def _fields_equal(self, anki_note: AnkiNoteLike) -> bool:  # pragma: no cover
         "Check whether this TwNote's fields match those of the provided Anki note."
         raise NotImplementedError
 
@@ -284,11 +422,13 @@ class TwNote(metaclass=ABCMeta):
 class QuestionNote(TwNote):
     "A question-and-answer pair, much like Anki's Basic note type."
     model = TiddlyRememberQuestionAnswer
+    content_attrs = ('question', 'answer')
+    __slots__ = content_attrs
 
     def __init__(self, id_: Twid, wiki: Wiki, tidref: str,
                  question: str, answer: str,
-                 target_tags: Set[str], target_deck: Optional[str],
-                 media: Optional[Set[TwMedia]] = None,
+                 target_tags: AbstractSet[str], target_deck: Optional[str],
+                 media: Optional[AbstractSet[TwMedia]] = None,
                  schedule: Optional[SchedulingInfo] = None) -> None:
         super().__init__(id_, wiki, tidref, target_tags, target_deck, media,
                          schedule)
@@ -314,22 +454,23 @@ class QuestionNote(TwNote):
 
     @classmethod
     def parse_html(cls, soup: BeautifulSoup, wiki: Wiki,
-                   tiddler_name: str, warnings: List[str]) -> Set['QuestionNote']:
+                   tiddler_name: str, warnings: List[str],
+                   media_cache: Optional[MediaCache] = None,
+                   seen: Optional[Set[Twid]] = None,
+                   metadata: Optional[Dict[SourcePosition, NoteMetadata]] = None
+                   ) -> Set['QuestionNote']:
         notes = set()
         deck, tags = _get_tiddler_deck_and_tags(soup)
 
-        media: Set[TwMedia] = set()
         pairs = soup.find_all("div", class_="rememberq")
-        for pair in pairs:
-            pair = extract_media(media, pair, wiki, tiddler_name, warnings)
+        for id_, pair, meta in _unseen_notes(pairs, seen, metadata):
+            media: Set[TwMedia] = set()
+            pair = extract_media(media, pair, wiki, tiddler_name, warnings,
+                                 media_cache)
             question = clean_field_html(pair.find("div", class_="rquestion").p)
             answer = clean_field_html(pair.find("div", class_="ranswer").p)
-            id_raw = pair.find("div", class_="rid").get_text()
-            id_ = id_raw.strip().lstrip('[').rstrip(']')
-            tidref = select_tidref(pair.find("div", class_="tr-reference"),
-                                   tiddler_name)
-            sched = build_scheduling_info(pair, tiddler_name)
-            deck_override, tags_override = _get_note_deck_and_tags(pair)
+            tidref, sched, deck_override, tags_override = _note_metadata(
+                pair, meta, tiddler_name)
             notes.add(cls(
                 id_,
                 wiki,
@@ -348,10 +489,10 @@ class QuestionNote(TwNote):
     def wants_soup(cls, soup: BeautifulSoup) -> bool:
         return bool(soup.find("div", class_="rememberq"))
 
-    def _fields_equal(self, anki_note: Note) -> bool:
+    def _fields_equal(self, anki_note: AnkiNoteLike) -> bool:
         return (
-            self.question == anki_note['Question']
-            and self.answer == anki_note['Answer']
+            fields_match(self.question, anki_note['Question'])
+            and fields_match(self.answer, anki_note['Answer'])
             and self._base_equal(anki_note)
         )
 
@@ -367,11 +508,13 @@ class QuestionNote(TwNote):
 class PairNote(TwNote):
     "A two-sided note, much like Anki's Basic (and reversed) note type."
     model = TiddlyRememberPair
+    content_attrs = ('first', 'second')
+    __slots__ = content_attrs
 
     def __init__(self, id_: Twid, wiki: Wiki, tidref: str,
                  first: str, second: str,
-                 target_tags: Set[str], target_deck: Optional[str],
-                 media: Optional[Set[TwMedia]] = None,
+                 target_tags: AbstractSet[str], target_deck: Optional[str],
+                 media: Optional[AbstractSet[TwMedia]] = None,
                  schedule: Optional[SchedulingInfo] = None) -> None:
         super().__init__(id_, wiki, tidref, target_tags, target_deck, media,
                          schedule)
@@ -397,22 +540,23 @@ class PairNote(TwNote):
 
     @classmethod
     def parse_html(cls, soup: BeautifulSoup, wiki: Wiki,
-                   tiddler_name: str, warnings: List[str]) -> Set['PairNote']:
+                   tiddler_name: str, warnings: List[str],
+                   media_cache: Optional[MediaCache] = None,
+                   seen: Optional[Set[Twid]] = None,
+                   metadata: Optional[Dict[SourcePosition, NoteMetadata]] = None
+                   ) -> Set['PairNote']:
         notes = set()
         deck, tags = _get_tiddler_deck_and_tags(soup)
 
-        media: Set[TwMedia] = set()
         pairs = soup.find_all("div", class_="rememberp")
-        for pair in pairs:
-            pair = extract_media(media, pair, wiki, tiddler_name, warnings)
+        for id_, pair, meta in _unseen_notes(pairs, seen, metadata):
+            media: Set[TwMedia] = set()
+            pair = extract_media(media, pair, wiki, tiddler_name, warnings,
+                                 media_cache)
             question = clean_field_html(pair.find("div", class_="rfirst").p)
             answer = clean_field_html(pair.find("div", class_="rsecond").p)
-            id_raw = pair.find("div", class_="rid").get_text()
-            id_ = id_raw.strip().lstrip('[').rstrip(']')
-            tidref = select_tidref(pair.find("div", class_="tr-reference"),
-                                   tiddler_name)
-            sched = build_scheduling_info(pair, tiddler_name)
-            deck_override, tags_override = _get_note_deck_and_tags(pair)
+            tidref, sched, deck_override, tags_override = _note_metadata(
+                pair, meta, tiddler_name)
             notes.add(cls(
                 id_,
                 wiki,
@@ -431,10 +575,10 @@ class PairNote(TwNote):
     def wants_soup(cls, soup: BeautifulSoup) -> bool:
         return bool(soup.find("div", class_="rememberp"))
 
-    def _fields_equal(self, anki_note: Note) -> bool:
+    def _fields_equal(self, anki_note: AnkiNoteLike) -> bool:
         return (
-            self.first == anki_note['First']
-            and self.second == anki_note['Second']
+            fields_match(self.first, anki_note['First'])
+            and fields_match(self.second, anki_note['Second'])
             and self._base_equal(anki_note)
         )
 
@@ -450,10 +594,12 @@ class PairNote(TwNote):
 class ClozeNote(TwNote):
     "A cloze deletion-based note, much like Anki's built-in Cloze note type."
     model = TiddlyRememberCloze
+    content_attrs = ('text',)
+    __slots__ = content_attrs
 
     def __init__(self, id_: Twid, wiki: Wiki, tidref: str, text: str,
-                 target_tags: Set[str], target_deck: Optional[str],
-                 media: Optional[Set[TwMedia]] = None,
+                 target_tags: AbstractSet[str], target_deck: Optional[str],
+                 media: Optional[AbstractSet[TwMedia]] = None,
                  schedule: Optional[SchedulingInfo] = None) -> None:
         super().__init__(id_, wiki, tidref, target_tags, target_deck, media,
                          schedule)
@@ -484,22 +630,23 @@ class ClozeNote(TwNote):
 
     @classmethod
     def parse_html(cls, soup: BeautifulSoup, wiki: Wiki,
-                   tiddler_name: str, warnings: List[str]) -> Set['ClozeNote']:
+                   tiddler_name: str, warnings: List[str],
+                   media_cache: Optional[MediaCache] = None,
+                   seen: Optional[Set[Twid]] = None,
+                   metadata: Optional[Dict[SourcePosition, NoteMetadata]] = None
+                   ) -> Set['ClozeNote']:
         notes = set()
         deck, tags = _get_tiddler_deck_and_tags(soup)
 
-        media: Set[TwMedia] = set()
         pairs = soup.find_all(class_="remembercz")
-        for pair in pairs:
-            pair = extract_media(media, pair, wiki, tiddler_name, warnings)
+        for id_, pair, meta in _unseen_notes(pairs, seen, metadata):
+            media: Set[TwMedia] = set()
+            pair = extract_media(media, pair, wiki, tiddler_name, warnings,
+                                 media_cache)
             text = clean_field_html(pair.find("span", class_="cloze-text"))
-            id_raw = pair.find("div", class_="rid").get_text()
-            id_ = id_raw.strip().lstrip('[').rstrip(']')
-            tidref = select_tidref(pair.find("div", class_="tr-reference"),
-                                   tiddler_name)
+            tidref, sched, deck_override, tags_override = _note_metadata(
+                pair, meta, tiddler_name)
             parsed_text = ankify_clozes(text)
-            sched = build_scheduling_info(pair, tiddler_name)
-            deck_override, tags_override = _get_note_deck_and_tags(pair)
             notes.add(cls(
                 id_,
                 wiki,
@@ -517,14 +664,145 @@ class ClozeNote(TwNote):
     def wants_soup(cls, soup: BeautifulSoup) -> bool:
         return bool(soup.find(class_="remembercz"))
 
-    def _fields_equal(self, anki_note: Note) -> bool:
-        return self.text == anki_note['Text'] and self._base_equal(anki_note)
+    def _fields_equal(self, anki_note: AnkiNoteLike) -> bool:
+        return fields_match(self.text, anki_note['Text']) and self._base_equal(anki_note)
 
     def _update_fields(self, anki_note: Note) -> None:
         anki_note['Text'] = self.text
         self._base_update(anki_note)
 
 
+@contextmanager
+def sharing_tags() -> Iterator[None]:
+    """
+    Share one copy of each set of tags between the notes created within this
+    block, and within any others under way at the same time. Once the last
+    of them ends, the table of sets is dropped, so that it doesn't keep
+    every set of tags ever extracted for the rest of the session.
+    """
+    global _tag_set_users  # pylint: disable=global-statement
+    with _tag_sets_lock:
+        _tag_set_users += 1
+    try:
+        yield
+    finally:
+        with _tag_sets_lock:
+            _tag_set_users -= 1
+            if not _tag_set_users:
+                _TAG_SETS.clear()
+
+
+def _shared_tags(tags: Iterable[str]) -> FrozenSet[str]:
+    """
+    Return the set of tags /tags/ as a frozen set of interned strings,
+    shared with every other note with the same tags if within sharing_tags().
+    """
+    frozen = frozenset(sys.intern(tag) for tag in tags)
+    if not _tag_set_users:
+        return frozen
+    return _TAG_SETS.setdefault(frozen, frozen)
+
+
+def _unseen_notes(
+        elems: Iterable[BeautifulSoup], seen: Optional[Set[Twid]],
+        metadata: Optional[Dict[SourcePosition, NoteMetadata]] = None
+        ) -> Iterator[Tuple[Twid, BeautifulSoup, Optional[NoteMetadata]]]:
+    """
+    Given the elements of notes of one type, yield the ID, element and
+    metadata from /metadata/ (or None if it's not there) of each note whose ID
+    is not in /seen/, adding the ID to /seen/.
+
+    Transclusion can make the same note appear in many tiddlers, or many times
+    in one tiddler. Only the first copy becomes a TwNote, so reading just the
+    ID of the others first saves processing their fields and media for nothing.
+    """
+    if seen is None:
+        seen = set()
+    if metadata is None:
+        metadata = {}
+    for elem in elems:
+        meta = metadata.get((elem.sourceline, elem.sourcepos)) if metadata else None
+        if meta is not None:
+            id_ = meta.id_
+        else:
+            id_ = read_note_id(elem.find("div", class_="rid"))
+        if id_ not in seen:
+            seen.add(id_)
+            yield id_, elem, meta
+
+
+def read_note_id(rid: BeautifulSoup) -> Twid:
+    "Return the ID of a note given the element holding it."
+    return _note_id(rid.get_text())
+
+
+def _note_id(text: str) -> Twid:
+    "Return the ID of a note given the text of the element holding it."
+    return Twid(text.strip().lstrip('[').rstrip(']'))
+
+
+def index_metadata(source: str) -> Dict[SourcePosition, NoteMetadata]:
+    """
+    Read the metadata blocks of the notes in a tiddler straight from its HTML,
+    without searching the soup of each note for each value.
+
+    The blocks are always rendered by the same macro, so they can be matched
+    with a single pattern. The values are only taken from the HTML where they
+    are certain to be exactly what the soup would give: if anything about the
+    tiddler is unusual, such as a note nested within another note's fields or
+    a value containing an HTML entity, its notes are left out of the result
+    and their metadata is read from the soup as before.
+
+    :return: The metadata of each note, by the position of its container.
+
+    >>> html = (
+    ...     '<div class="rememberq">\\n<div class="rid">[1]</div>'
+    ...     '<div class="tr-reference">Ref</div><div class="tr-sched"></div>'
+    ...     '<div class="tr-deck">Deck</div><div class="tr-tags">a [[b c]]</div>\\n</div>')
+    >>> index_metadata(html)
+    {(1, 0): NoteMetadata(id_='1', reference='Ref', sched='', deck='Deck', tags='a [[b c]]')}
+    >>> index_metadata(html.replace('Ref', 'R&amp;D'))
+    {}
+    >>> index_metadata(html.replace('Ref', '<div class="rememberq">'))
+    {}
+    """
+    index: Dict[SourcePosition, NoteMetadata] = {}
+    container: Optional[SourcePosition] = None
+    line, line_start, counted = 1, 0, 0
+    pos = 0
+    while True:
+        match = _METADATA_TOKEN.search(source, pos)
+        if match is None:
+            break
+        if match.lastgroup == 'note':
+            if container is not None:
+                # Nested notes, or a note without a metadata block.
+                return {}
+            start = source.rfind('<', 0, match.start())
+            if start >= counted:
+                line += source.count('\n', counted, start)
+            else:
+                line -= source.count('\n', start, counted)
+            counted = start
+            line_start = source.rfind('\n', 0, start) + 1
+            container = (line, start - line_start)
+            pos = match.end()
+        elif match.lastgroup == 'block':
+            block = _METADATA_BLOCK.match(source, match.start())
+            if container is None or block is None:
+                return {}
+            if '&' not in block.group(0):
+                rid, reference, sched, deck, tags = block.groups()
+                index[container] = NoteMetadata(_note_id(rid), reference, sched,
+                                                deck, tags)
+            container = None
+            pos = block.end()
+        else:
+            # Something the soup might take for part of a metadata block.
+            return {}
+    return index if container is None else {}
+
+
 def _get_tiddler_deck_and_tags(
         tiddler_soup: BeautifulSoup) -> Tuple[Optional[str], Set[str]]:
     """
@@ -555,24 +833,49 @@ def _get_note_deck_and_tags(
     precedence over those in _get_tiddler_deck_and_tags() if non-empty.
     """
     deck_element = pair_soup.find("div", class_="tr-deck")
-    if deck_element:
-        deck_override = deck_element.get_text().strip()
-    else:
-        deck_override = None
-
     tags_element = pair_soup.find("div", class_="tr-tags")
-    if tags_element:
-        tags_override = set(
-            i
-            for i in split_tiddler_list(tags_element.get_text().strip())
-            if i
-        )
+    return _deck_and_tags_overrides(
+        deck_element.get_text() if deck_element else None,
+        tags_element.get_text() if tags_element else None)
+
+
+def _deck_and_tags_overrides(
+        deck_text: Optional[str],
+        tags_text: Optional[str]) -> Tuple[Optional[str], Set[str]]:
+    """
+    Given the text of the tr-deck and tr-tags elements of a remember* call,
+    or None where there is no such element, return the deck and set of tags
+    they override the tiddler's with.
+    """
+    deck_override = deck_text.strip() if deck_text is not None else None
+    if tags_text is not None:
+        tags_override = set(i for i in split_tiddler_list(tags_text.strip()) if i)
     else:
         tags_override = set()
-
     return deck_override, tags_override
 
 
+def _note_metadata(
+        pair_soup: BeautifulSoup, meta: Optional[NoteMetadata], tiddler_name: str
+        ) -> Tuple[str, Optional[SchedulingInfo], Optional[str], Set[str]]:
+    """
+    Return the tiddler reference, scheduling information, and deck and tags
+    overrides of a remember* call, from /meta/ if index_metadata() could read
+    them from the HTML, or else from the call's soup.
+    """
+    if meta is None:
+        deck_override, tags_override = _get_note_deck_and_tags(pair_soup)
+        return (select_tidref(pair_soup.find("div", class_="tr-reference"),
+                              tiddler_name),
+                build_scheduling_info(pair_soup, tiddler_name),
+                deck_override, tags_override)
+
+    deck_override, tags_override = _deck_and_tags_overrides(meta.deck, meta.tags)
+    return (meta.reference.strip() or tiddler_name,
+            parse_scheduling_info(meta.sched, tiddler_name),
+            deck_override, tags_override)
+
+
 def by_name(model_name: str) -> Optional[Type[TwNote]]:
     """
     Return the TwNote class which uses the model named `model_name`.
@@ -599,6 +902,15 @@ def build_scheduling_info(soup: BeautifulSoup,
     except AttributeError:
         # backwards compatibility: no tr-sched block will be present in older versions
         return None
+    return parse_scheduling_info(sched_str, tiddler_name)
+
+
+def parse_scheduling_info(sched_str: str,
+                          tiddler_name: str) -> Optional[SchedulingInfo]:
+    """
+    Given the text of the tr-sched element of a remember* call, return the
+    scheduling information it describes, or None if it's empty.
+    """
     if not sched_str.strip():
         return None
 
@@ -621,6 +933,37 @@ def build_scheduling_info(soup: BeautifulSoup,
         ) from e
 
 
+def canonical_field(text: str) -> str:
+    r"""
+    Normalize the content of a field the way Anki does when it saves a note:
+    Unicode text is NFC-normalized, and carriage returns and other control
+    characters apart from tabs and newlines are removed.
+
+    >>> canonical_field("cafe\u0301\r\nau lait")
+    'café\nau lait'
+    """
+    return _ANKI_STRIPPED_CHARS.sub('', unicodedata.normalize('NFC', text))
+
+
+def fields_match(ours: str, theirs: str) -> bool:
+    """
+    Return True if Anki would store the field content /ours/ as /theirs/,
+    so that the field doesn't need to be written again.
+    """
+    return ours == theirs or canonical_field(ours) == canonical_field(theirs)
+
+
+def tags_match(ours: Iterable[str], theirs: Iterable[str]) -> bool:
+    """
+    Return True if two lists of tags are the same as far as Anki is concerned,
+    that is, apart from their order and case.
+
+    >>> tags_match(["b", "A"], ["a", "b"])
+    True
+    """
+    return {t.casefold() for t in ours} == {t.casefold() for t in theirs}
+
+
 def clean_field_html(soup: BeautifulSoup) -> str:
     """
     Given the raw HTML for a field, such as "question" or "answer", neaten it
@@ -690,13 +1033,20 @@ def ensure_version(soup: BeautifulSoup) -> None:
 
 # pylint: disable=too-many-branches
 def extract_media(media: Set[TwMedia], soup: BeautifulSoup, wiki: Wiki,
-                  tiddler_name: str, warnings: List[str]) -> BeautifulSoup:
+                  tiddler_name: str, warnings: List[str],
+                  media_cache: Optional[MediaCache] = None) -> BeautifulSoup:
     """
-    Extract media references from the //fields//, retrieve the associated media,
+    Extract media references from the //fields//, identify the associated media,
     and update the media references.
 
+    Media is only retrieved if `media_cache` doesn't already know its content
+    hash; otherwise retrieval is deferred until the media is written to Anki.
+
     `soup` is returned possibly modified. The `media` set is updated in-place.
     """
+    if media_cache is None:
+        media_cache = MediaCache()
+
     for elem in soup.find_all(("img", "audio")):
         src = elem.attrs.get('src', None)
         if src is not None:
@@ -705,7 +1055,9 @@ def extract_media(media: Set[TwMedia], soup: BeautifulSoup, wiki: Wiki,
                 # Try reading as a relative path if this is a file or URL wiki,
                 # as this is a common way to work with _canonical_uri.
                 # The resulting path is not guaranteed to exist; we'll warn the
-                # user if it isn't.
+                # user if it isn't. Paths are resolved without changing the
+                # working directory, which is shared by all threads, so that
+                # several wikis can be extracted at once.
                 if wiki.type == WikiType.URL:
                     assert isinstance(wiki.source_path, str)  # URLs use str union type
                     open_src = (wiki.source_path
@@ -713,22 +1065,19 @@ def extract_media(media: Set[TwMedia], soup: BeautifulSoup, wiki: Wiki,
                                 + src)
                 elif wiki.type == WikiType.FILE:
                     assert isinstance(wiki.source_path, Path)  # Paths use Path type
-                    with pushd(wiki.source_path.parent):
-                        open_src = Path(src).absolute().as_uri()
+                    open_src = (wiki.source_path.parent.absolute() / src).as_uri()
                 elif wiki.type == WikiType.FOLDER:
                     assert isinstance(wiki.source_path, Path)  # Paths use Path type
-                    with pushd(wiki.source_path):
-                        open_src = Path(src).absolute().as_uri()
+                    open_src = (wiki.source_path.absolute() / src).as_uri()
 
             try:
-                with urlopen(open_src) as response:
-                    medium = TwMedia(response.read(), src, warnings)
-                    media.add(medium)
-
-                    if elem.name == 'img':
-                        elem.attrs['src'] = medium.filename
-                    elif elem.name == 'audio':
-                        elem.replace_with(f"[sound:{medium.filename}]")
+                medium = media_cache.get(src, open_src, warnings)
+                media.add(medium)
+
+                if elem.name == 'img':
+                    elem.attrs['src'] = medium.filename
+                elif elem.name == 'audio':
+                    elem.replace_with(f"[sound:{medium.filename}]")
             except ValueError:
                 warnings.append(
                     f"Media file '{src}' in tiddler '{tiddler_name}' isn't a valid "
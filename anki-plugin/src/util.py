@@ -1,11 +1,12 @@
 """
 util.py - general-purpose functions and definitions used by multiple modules
 """
-from contextlib import contextmanager
+import hashlib
 import os
 from pathlib import Path
+import re
 import subprocess
-from typing import Iterator, List, NewType, Optional, Sequence
+from typing import List, NewType, Optional, Sequence
 
 
 Twid = NewType('Twid', str)
@@ -17,6 +18,12 @@ COMPATIBLE_TW_VERSIONS = [
     "1.4.0",
 ]
 
+#: One name in a well-formed tiddler list: a [[bracketed]] name not
+#: containing [[, or a plain one without any brackets, followed by a space
+#: or the end of the list.
+_TIDDLER_LIST_ITEM = re.compile(
+    r' *(?:\[\[((?:(?!\]\]|\[\[).)*)\]\]|([^ \[\]]+))(?= |\Z)', re.DOTALL)
+
 
 def pluralize(sg: str, n: int, pl: str = None) -> str:
     """
@@ -45,15 +52,28 @@ def pluralize(sg: str, n: int, pl: str = None) -> str:
         return pl
 
 
-@contextmanager
-def pushd(path: Path) -> Iterator[None]:
-    "Change directory into a given path for the duration of the context."
-    old_cwd = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(old_cwd)
+def cache_path(cache_dir: Path, kind: str, name: str, extension: str) -> Path:
+    """
+    Return the path of the file holding the cache of type /kind/ for /name/
+    (a wiki name or the path of a collection) within /cache_dir/. Names are
+    arbitrary user input, so they are hashed rather than used directly in
+    the filename.
+
+    >>> cache_path(Path("cache"), "media", "My Wiki", "json").as_posix()
+    'cache/media-c5d0c8f55dfc8b8b.json'
+    """
+    key = hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+    return Path(cache_dir) / f"{kind}-{key}.{extension}"
+
+
+def user_files_dir() -> Path:
+    """
+    Return the add-on's user_files directory, creating it if necessary.
+    Anki preserves the contents of this directory when the add-on is updated.
+    """
+    path = Path(__file__).parent / "user_files"
+    path.mkdir(exist_ok=True)
+    return path
 
 
 def nowin_startupinfo() -> Optional['subprocess.STARTUPINFO']:  # type: ignore
@@ -73,6 +93,27 @@ def nowin_startupinfo() -> Optional['subprocess.STARTUPINFO']:  # type: ignore
         return None
 
 
+def low_priority_creationflags() -> int:
+    """
+    If running on Windows, return the flags to pass to a subprocess call to
+    run the process at idle priority. Otherwise, return 0; see lower_priority().
+    """
+    return getattr(subprocess, 'IDLE_PRIORITY_CLASS', 0)
+
+
+def lower_priority(pid: int) -> None:
+    """
+    Lower the scheduling priority of a process we've started as far as it
+    goes, on systems other than Windows (see low_priority_creationflags()).
+    Failing to do so isn't an error.
+    """
+    if hasattr(os, 'setpriority'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, 19)  # type: ignore
+        except OSError:
+            pass
+
+
 def split_tiddler_list(s: str) -> List[str]:
     """
     Split a tiddler list string into a Python list of undecorated tiddler names.
@@ -94,8 +135,29 @@ def split_tiddler_list(s: str) -> List[str]:
 
     >>> split_tiddler_list("foo bar [[baz qux]]")
     ['foo', 'bar', 'baz qux']
+
+    Lists that aren't as neatly formed are split the same way TiddlyRemember
+    always has, one character at a time:
+
+    >>> split_tiddler_list("foo[[bar]] [[baz")
+    ['foobar', 'baz']
     """
     result = []
+    pos = 0
+    end = len(s.rstrip(' '))
+    while pos < end:
+        match = _TIDDLER_LIST_ITEM.match(s, pos)
+        if match is None:
+            return _split_tiddler_list_slowly(s)
+        bracketed, plain = match.groups()
+        result.append((bracketed if bracketed is not None else plain).strip())
+        pos = match.end()
+    return result
+
+
+def _split_tiddler_list_slowly(s: str) -> List[str]:
+    "Split a tiddler list of any form; see split_tiddler_list()."
+    result = []
     current_tiddler = []
     in_brackets = False
     i = 0
@@ -0,0 +1,404 @@
+"""
+watcher.py - sync folder wikis automatically as their tiddlers change
+
+If the 'watchFolderWikis' option is on, the tiddlers folder of each folder
+wiki is watched while a profile is open, with inotify where it's available
+and by checking the folder every few seconds otherwise (see folderwatch.py).
+Once a wiki has gone 'watchDebounceSeconds' without further changes, notes
+are extracted from just the tiddlers that changed (see
+twimport.find_changed_notes()) and synced in the background, adding and
+updating their notes and removing only notes that came from them alone.
+
+If we can't tell which tiddlers changed, or the wiki hasn't been synced
+with the cache yet, the whole wiki is extracted instead, still in the
+background. Anything that would need the user's attention in a regular
+sync -- warnings, an error, changes of note type, or a wiki with no notes at
+all -- stops the automatic sync and is reported in a tooltip, to be dealt
+with by syncing from the Tools menu.
+
+If the 'pushPort' option is set, tiddlers can also be pushed to us, already
+rendered, by a wiki being edited in the browser (see pushserver.py). Their
+notes are synced in the same way, and the outcome is reported back to the
+wiki as well as in a tooltip. The server's URL holds a token chosen afresh
+each time Anki starts, so the user copies it from the settings dialog (see
+push_url()) into the wiki.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+import secrets
+import threading
+from typing import AbstractSet, Any, Callable, Dict, Iterable, List, Optional, Set
+
+from anki.collection import OpChanges
+from aqt.errors import show_exception
+from aqt.operations import CollectionOp, QueryOp
+from aqt.utils import tooltip
+# pylint: disable=import-error, no-name-in-module
+from aqt.qt import QObject, QSocketNotifier, QTimer
+
+from . import ankisync
+from .folderwatch import FolderSnapshot, Inotify, changed_titles, scan, tiddlers_folder
+from .journal import SyncJournal
+from .oops import ExtractError, PushError
+from .pushserver import Push, PushServer, server_url
+from . import twimport
+from .twnote import TwNote
+from .util import cache_path, Twid, user_files_dir
+
+#: How often to check a wiki for changes where inotify isn't available.
+POLL_SECONDS = 5
+
+#: Tiddlers that change whenever the user navigates in a wiki served by
+#: Node, and never hold notes, so that doesn't start a sync.
+IGNORED_TITLES = {"$:/StoryList", "$:/HistoryList"}
+
+#: How long a push waits for its notes to be synced before giving up.
+PUSH_TIMEOUT_SECONDS = 60
+
+#: Held while an automatic sync plans and makes its changes, so that two of
+#: them never plan against the same state of the collection.
+_sync_lock = threading.Lock()
+
+#: Held while a push is synced, so that pushes are synced in the order they arrive.
+_push_lock = threading.Lock()
+
+#: Token the push server's URL holds, kept while Anki is running so that the
+#: URL stays the same when the server is restarted.
+_push_token = secrets.token_urlsafe(16)
+
+
+@dataclass
+class _Extraction:
+    "Notes extracted from a wiki that has changed, to be synced automatically."
+    notes: Set[TwNote]
+    removable: Optional[AbstractSet[Twid]]
+    warnings: List[str]
+
+
+class _NeedsAttention(Exception):
+    "A sync that should be left to the user, for the reason given."
+
+
+def _set_permalinks(notes: Iterable[TwNote], wiki_conf: Dict[str, str]) -> None:
+    wiki_url = wiki_conf.get('permalink', '')
+    if wiki_url:
+        for n in notes:
+            n.set_permalink(wiki_url)
+
+
+def _apply(col: Any, conf: Dict[str, Any], wiki_name: str,
+           extraction: _Extraction) -> ankisync.SyncResult:
+    """
+    Plan and make the changes to sync an extraction, unless they need the
+    user's attention. Runs in the background.
+    """
+    if extraction.warnings:
+        raise _NeedsAttention("there were warnings")
+    if extraction.removable is None and not extraction.notes:
+        raise _NeedsAttention("no notes were found")
+    # Syncs made here are small, so they aren't journaled; but they mustn't
+    # change the collection while a sync from the Tools menu is waiting to
+    # be resumed, as that sync would then have to start over.
+    if SyncJournal(cache_path(user_files_dir(), 'journal', col.path, 'sqlite')) \
+            .interrupted(col.mod):
+        raise _NeedsAttention("a sync from the Tools menu was interrupted")
+    paths = {
+        'fingerprint_path': cache_path(user_files_dir(), 'fingerprints', col.path, 'sqlite'),
+    }
+    with _sync_lock:
+        plan = ankisync.make_plan(extraction.notes, col, conf['defaultDeck'],
+                                  wikis={wiki_name}, removable=extraction.removable,
+                                  **paths)
+        if plan.type_changes:
+            raise _NeedsAttention("note types need to be changed")
+        if not (plan.adds or plan.edits or plan.removes or plan.deck_moves):
+            return ankisync.SyncResult(OpChanges(), "")
+        return ankisync.sync_op(plan, extraction.notes, col, conf['defaultDeck'],
+                                batch_size=conf['syncBatchSize'],
+                                wikis={wiki_name}, removable=extraction.removable,
+                                **paths)
+
+
+def sync_automatically(mw, conf: Dict[str, Any], wiki_name: str,
+                       extract: Callable[[], _Extraction],
+                       done: Callable[[str, bool], None]) -> None:
+    """
+    Extract notes from a wiki with /extract/ and sync them, in the background.
+    Then /done/ is called with a message describing the outcome, which is
+    empty if nothing needed changing, and whether the notes were synced.
+    """
+    def failed(exc: Exception) -> None:
+        if isinstance(exc, _NeedsAttention):
+            done(f"TiddlyRemember didn't sync changes to {wiki_name} "
+                 f"automatically because {exc}. Please sync from the Tools menu.", False)
+        elif isinstance(exc, ExtractError):
+            done(f"TiddlyRemember couldn't sync changes to {wiki_name} "
+                 f"automatically: {exc}", False)
+        else:
+            done(f"TiddlyRemember couldn't sync changes to {wiki_name} "
+                 f"automatically because of an unexpected error.", False)
+            show_exception(parent=mw, exception=exc)
+
+    def synced(result: ankisync.SyncResult) -> None:
+        done(f"Synced changes to {wiki_name}:\n{result.log}" if result.log else "", True)
+
+    def extracted(extraction: _Extraction) -> None:
+        CollectionOp(
+            parent=mw,
+            op=lambda col: _apply(col, conf, wiki_name, extraction),
+        ).success(synced).failure(failed).run_in_background()
+
+    QueryOp(
+        parent=mw,
+        op=lambda _col: extract(),
+        success=extracted,
+    ).failure(failed).run_in_background()
+
+
+class WikiWatcher(QObject):
+    """
+    Watch the tiddlers of one folder wiki, syncing those that change.
+    """
+    def __init__(self, mw, conf: Dict[str, Any], wiki_name: str,
+                 wiki_conf: Dict[str, str]) -> None:
+        super().__init__(mw)
+        self.mw = mw
+        self.conf = conf
+        self.wiki_name = wiki_name
+        self.wiki_conf = wiki_conf
+        self.folder = tiddlers_folder(wiki_conf['path'])
+        self.snapshot: FolderSnapshot = scan(self.folder)
+        self.polled = self.snapshot
+
+        #: Titles of the tiddlers waiting to be synced, or None if the
+        #: whole wiki needs to be.
+        self.pending: Optional[Set[str]] = set()
+        self.busy = False
+
+        self.debounce = QTimer(self)
+        self.debounce.setSingleShot(True)
+        self.debounce.setInterval(int(float(conf.get('watchDebounceSeconds', 2)) * 1000))
+        self.debounce.timeout.connect(self.check)  # type: ignore
+
+        self.inotify: Optional[Inotify] = None
+        self.poll_timer: Optional[QTimer] = None
+        try:
+            self.inotify = Inotify(self.folder)
+        except OSError:
+            self.poll_timer = QTimer(self)
+            self.poll_timer.timeout.connect(self.poll)  # type: ignore
+            self.poll_timer.start(POLL_SECONDS * 1000)
+        else:
+            self.notifier = QSocketNotifier(self.inotify.fileno(),
+                                            QSocketNotifier.Type.Read, self)
+            self.notifier.activated.connect(self.on_inotify)  # type: ignore
+
+    def close(self) -> None:
+        "Stop watching the wiki. A sync already under way still finishes."
+        self.debounce.stop()
+        if self.poll_timer is not None:
+            self.poll_timer.stop()
+        if self.inotify is not None:
+            self.notifier.setEnabled(False)
+            self.inotify.close()
+        self.pending = set()
+        self.deleteLater()
+
+    def on_inotify(self, *_args: Any) -> None:
+        "Wait for the wiki to settle down after inotify reports changes."
+        assert self.inotify is not None
+        if self.inotify.read():
+            self.debounce.start()
+
+    def poll(self) -> None:
+        "Check the wiki for changes, and wait for it to settle down if there are any."
+        snapshot = scan(self.folder, self.polled)
+        if snapshot != self.polled:
+            self.polled = snapshot
+            self.debounce.start()
+
+    def check(self) -> None:
+        "Work out which tiddlers have changed since the last check and sync them."
+        snapshot = scan(self.folder, self.snapshot)
+        titles = changed_titles(self.snapshot, snapshot)
+        self.snapshot = self.polled = snapshot
+        if titles is not None:
+            titles.difference_update(IGNORED_TITLES)
+            if not titles:
+                return
+        if titles is None or self.pending is None:
+            self.pending = None
+        else:
+            self.pending.update(titles)
+        self.sync_pending()
+
+    def sync_pending(self) -> None:
+        "Sync the tiddlers waiting to be, unless a sync is already under way."
+        if self.busy or self.pending == set() or self.mw.col is None:
+            return
+        titles, self.pending = self.pending, set()
+        self.busy = True
+        sync_automatically(self.mw, self.conf, self.wiki_name,
+                           lambda: self.extract(titles), self.done)
+
+    def extract(self, titles: Optional[Set[str]]) -> _Extraction:
+        """
+        Extract notes from the tiddlers /titles/, or the whole wiki if None
+        or if that's needed anyway. Runs in the background.
+        """
+        warnings: List[str] = []
+        changes = None
+        if titles is not None:
+            changes = twimport.find_changed_notes(
+                tw_binary=self.conf['tiddlywikiBinary'],
+                wiki_path=self.wiki_conf['path'],
+                wiki_name=self.wiki_name,
+                filter_=self.wiki_conf['contentFilter'],
+                titles=titles,
+                cache_dir=str(user_files_dir()),
+                warnings=warnings)
+        if changes is not None:
+            notes, removable = changes.notes, changes.removable
+        else:
+            notes = twimport.find_notes(
+                tw_binary=self.conf['tiddlywikiBinary'],
+                wiki_path=self.wiki_conf['path'],
+                wiki_type='folder',
+                wiki_name=self.wiki_name,
+                filter_=self.wiki_conf['contentFilter'],
+                warnings=warnings,
+                cache_dir=str(user_files_dir()))
+            removable = None
+        _set_permalinks(notes, self.wiki_conf)
+        return _Extraction(notes, removable, warnings)
+
+    def done(self, message: str, _synced: bool) -> None:
+        "Finish a sync, reporting /message/ if any, and start the next if changes came in."
+        self.busy = False
+        if message:
+            tooltip(message, period=5000)
+        self.sync_pending()
+
+
+#: Watchers for the wikis of the open profile.
+_watchers: List[WikiWatcher] = []
+
+
+def start_watching(mw) -> None:
+    """
+    Watch each configured folder wiki, if the user has asked for that,
+    replacing any watchers already running.
+    """
+    stop_watching()
+    conf = mw.addonManager.getConfig(__name__)
+    if not conf.get('watchFolderWikis'):
+        return
+    for wiki_name, wiki_conf in conf['wikis'].items():
+        if wiki_conf['type'] == 'folder' and wiki_conf['path'].strip() \
+                and tiddlers_folder(wiki_conf['path']).is_dir():
+            _watchers.append(WikiWatcher(mw, conf, wiki_name, wiki_conf))
+
+
+def stop_watching() -> None:
+    "Stop watching all wikis."
+    for watcher in _watchers:
+        watcher.close()
+    _watchers.clear()
+
+
+def _push_target(conf: dict, wiki_name: str) -> Dict[str, str]:
+    """
+    Return the configuration of the wiki /wiki_name/, raising PushError
+    if tiddlers can't be pushed to it.
+    """
+    wiki_conf = conf['wikis'].get(wiki_name)
+    if wiki_conf is None:
+        raise PushError(f"There's no wiki called '{wiki_name}' "
+                        f"in the TiddlyRemember configuration.", 404)
+    if wiki_conf['type'] != 'folder':
+        raise PushError(f"Tiddlers can only be pushed to folder wikis, "
+                        f"and '{wiki_name}' is a {wiki_conf['type']} wiki.")
+    return wiki_conf
+
+
+def _push_filter(mw, wiki_name: str) -> str:
+    "Return the filter selecting the tiddlers that may be pushed to a wiki."
+    return _push_target(mw.addonManager.getConfig(__name__), wiki_name)['contentFilter']
+
+
+def _receive_push(mw, push: Push) -> str:
+    """
+    Sync the notes in tiddlers pushed by a running wiki, and return a
+    description of the changes. Runs on the push server's thread, and
+    raises PushError if the tiddlers can't be synced.
+    """
+    if mw.col is None:
+        raise PushError("Anki has no profile open.", 503)
+    conf = mw.addonManager.getConfig(__name__)
+    wiki_conf = _push_target(conf, push.wiki)
+
+    def extract() -> _Extraction:
+        warnings: List[str] = []
+        changes = twimport.find_pushed_notes(
+            wiki_path=wiki_conf['path'],
+            wiki_name=push.wiki,
+            tiddlers=push.tiddlers,
+            deleted=push.deleted,
+            cache_dir=str(user_files_dir()),
+            warnings=warnings)
+        if changes is None:
+            raise _NeedsAttention("it hasn't been synced from the Tools menu yet")
+        _set_permalinks(changes.notes, wiki_conf)
+        return _Extraction(changes.notes, changes.removable, warnings)
+
+    outcome: List[Any] = []
+    finished = threading.Event()
+    def done(message: str, synced: bool) -> None:
+        if message:
+            tooltip(message, period=5000)
+        outcome.extend((message, synced))
+        finished.set()
+
+    with _push_lock:
+        mw.taskman.run_on_main(lambda: sync_automatically(mw, conf, push.wiki, extract, done))
+        if not finished.wait(PUSH_TIMEOUT_SECONDS):
+            raise PushError("Anki took too long to sync the tiddlers.", 504)
+    message, synced = outcome
+    if not synced:
+        raise PushError(message, 409)
+    return message or "Nothing needed changing."
+
+
+_push_server: Optional[PushServer] = None
+
+
+def start_push_server(mw) -> None:
+    """
+    Listen for tiddlers pushed by running wikis, if the user has asked for
+    that, replacing any server already listening.
+    """
+    global _push_server  # pylint: disable=global-statement
+    stop_push_server()
+    port = int(mw.addonManager.getConfig(__name__).get('pushPort', 0))
+    if port:
+        try:
+            _push_server = PushServer(lambda push: _receive_push(mw, push),
+                                      lambda wiki_name: _push_filter(mw, wiki_name), port,
+                                      _push_token)
+        except OSError as e:
+            tooltip(f"TiddlyRemember couldn't listen for tiddlers on port {port}: {e}",
+                    period=5000)
+
+
+def push_url(port: int) -> str:
+    "Return the URL wikis must push tiddlers to while we listen on /port/."
+    return server_url(port, _push_token)
+
+
+def stop_push_server() -> None:
+    "Stop listening for tiddlers pushed by running wikis."
+    global _push_server  # pylint: disable=global-statement
+    if _push_server is not None:
+        _push_server.close()
+        _push_server = None
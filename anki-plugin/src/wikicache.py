@@ -0,0 +1,113 @@
+"""
+wikicache.py - remember everything extracted from a wiki, to skip unchanged wikis
+
+Most syncs happen when only a few wikis, or none, have changed since the last
+one, yet every wiki is normally folderified, rendered and parsed each time.
+After each extraction we therefore store the notes found (see
+TwNote.to_dict()) and the warnings that came up, together with a fingerprint
+of the wiki's content: a hash of the file for single-file wikis, a manifest
+of the names, sizes and modification times of its files for folder wikis,
+and a hash of the download for URL wikis, which are only downloaded again if
+the server says they have changed. If the fingerprint is the same next time,
+the stored notes are used without running TiddlyWiki at all.
+
+The fingerprint is stored alongside a key covering everything else the
+extraction depends on, such as the filter, the TiddlyWiki executable and the
+version of the add-on, so that changing any of them also leads to a fresh
+extraction. Like the other caches, it's only ever a cache: if it's missing,
+out of date, or unreadable, the wiki is simply extracted as usual.
+"""
+import gzip
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+
+class CachedExtraction(NamedTuple):
+    "What was extracted from a wiki the last time its content was the same."
+    notes: List[Dict[str, Any]]  #: TwNote.to_dict() of each note found.
+    warnings: List[str]          #: Warnings that came up during the extraction.
+    tiddlers: int                #: Number of tiddlers that were rendered.
+
+
+class WikiCache:
+    """
+    The last extraction of one wiki.
+
+    :param path: Compressed JSON file to load the last extraction from and
+                 save the next one to. If None, nothing is cached.
+    :param key:  Identifies everything apart from the content of the wiki that
+                 the extraction depends on.
+    """
+    VERSION = 1
+
+    def __init__(self, path: Optional[Path], key: str) -> None:
+        self.path = path
+        self.key = key
+        self._stored: Dict[str, Any] = {}
+        if path is not None:
+            self._load()
+
+    def _load(self) -> None:
+        assert self.path is not None
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                stored: Dict[str, Any] = json.load(f)
+        except (OSError, EOFError, ValueError):
+            return
+        if stored.get('version') == self.VERSION and stored.get('key') == self.key:
+            self._stored = stored
+
+    @property
+    def enabled(self) -> bool:
+        "Whether extractions are cached at all."
+        return self.path is not None
+
+    @property
+    def content(self) -> Optional[str]:
+        "The fingerprint of the content of the wiki at the last extraction."
+        return self._stored.get('content')
+
+    @property
+    def validators(self) -> Dict[str, str]:
+        """
+        The HTTP ETag and Last-Modified headers the wiki was last downloaded
+        with, if it's a URL wiki, to check whether it has changed since.
+        """
+        return self._stored.get('validators') or {}
+
+    def get(self, content: Optional[str]) -> Optional[CachedExtraction]:
+        """
+        Return the last extraction, if the content of the wiki had the
+        fingerprint /content/ then, or None.
+        """
+        if content is None or self.content != content:
+            return None
+        try:
+            return CachedExtraction(self._stored['notes'], self._stored['warnings'],
+                                    self._stored['tiddlers'])
+        except KeyError:
+            return None
+
+    def put(self, content: Optional[str], extraction: CachedExtraction,
+            validators: Optional[Dict[str, str]] = None) -> None:
+        """
+        Save an extraction of the wiki when the fingerprint of its content was
+        /content/, replacing the last one. Nothing is saved if /content/ is None.
+        """
+        if self.path is None or content is None:
+            return
+        self._stored = {
+            'version': self.VERSION,
+            'key': self.key,
+            'content': content,
+            'validators': validators or {},
+            'notes': extraction.notes,
+            'warnings': extraction.warnings,
+            'tiddlers': extraction.tiddlers,
+        }
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(self._stored, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
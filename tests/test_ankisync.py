@@ -10,13 +10,18 @@ sys.path.append("anki-plugin")
 import datetime
 import os
 from pathlib import Path
-from typing import Callable
+import time
+from typing import Callable, Iterable, Optional, Set
 
 import pytest
 
-from src.ankisync import sync
-from src.oops import ScheduleParsingError
-from src.twnote import SchedulingInfo, QuestionNote
+from src import ankisync
+from src.ankisync import make_plan, sync, sync_op
+from src.fingerprints import FingerprintStore
+from src.journal import SyncJournal
+from src.media import TwMedia
+from src.oops import ExtractError, ScheduleParsingError
+from src.twnote import SchedulingInfo, ClozeNote, QuestionNote, TwNote
 from src.trmodels import ID_FIELD_NAME
 from src.twimport import find_notes
 from src.wiki import Wiki, WikiType
@@ -45,6 +50,34 @@ def _get_only_note(col_tuple):
     return col_tuple.col.get_note(col_tuple.col.find_notes("")[0])
 
 
+_WIKI = Wiki("MyTestWiki", Path("."), Path("."), WikiType.FOLDER)
+
+
+def _qa(i: int, answer: str = "Answer", *, prefix: str = "2020010112000",
+        wiki: Wiki = _WIKI, question: Optional[str] = None,
+        tags: Optional[Set[str]] = None, deck: Optional[str] = None) -> QuestionNote:
+    """
+    Build the i'th Q&A note of a test. Tests that need notes of their own
+    pass a different ID prefix.
+    """
+    return QuestionNote(id_=f"{prefix}{i}000", wiki=wiki, tidref="TestTiddler",
+                        question=question or f"Question {i}", answer=answer,
+                        target_tags=tags or set(), target_deck=deck)
+
+
+def _qa_notes(answers: Iterable[str], **kwargs) -> Set[QuestionNote]:
+    "Build one Q&A note per answer, numbered in order, as _qa() would."
+    return {_qa(i, answer, **kwargs) for i, answer in enumerate(answers)}
+
+
+def _cloze(i: int, text: Optional[str] = None, *, prefix: str = "2020010112000",
+           deck: Optional[str] = None) -> ClozeNote:
+    "Build the i'th cloze note of a test, with the same IDs as _qa() uses."
+    return ClozeNote(id_=f"{prefix}{i}000", wiki=_WIKI, tidref="TestTiddler",
+                     text=text or f"Cloze {{{{c1::{i}}}}}", target_tags=set(),
+                     target_deck=deck)
+
+
 def test_import_qa(fn_params, col_tuple):
     "Test that we can import a simple question and answer into Anki."
 
@@ -83,7 +116,7 @@ def test_add_with_scheduling(col_tuple):
     }
     n = QuestionNote(
         id_="20200101120000000",
-        wiki=Wiki("MyTestWiki", Path("."), Path("."), WikiType.FOLDER),
+        wiki=_WIKI,
         tidref="TestTiddler",
         question="Does this question get correctly scheduled?",
         answer="I hope so",
@@ -106,6 +139,252 @@ def test_add_with_scheduling(col_tuple):
     assert card.due == days_until_due
 
 
+def test_add_in_batches(col_tuple):
+    "Notes added across several batches all arrive with the right deck and scheduling."
+    due = datetime.datetime.now().date() + datetime.timedelta(days=3)
+    notes = [
+        QuestionNote(
+            id_=f"2020010112000{i}000",
+            wiki=_WIKI,
+            tidref="TestTiddler",
+            question=f"Question {i}",
+            answer=f"Answer {i}",
+            target_tags={"batch"},
+            target_deck="Batch" if i % 2 else None,
+            schedule=(SchedulingInfo(ivl=3, due=due, ease=2500, lapses=0)
+                      if i % 2 else None),
+        )
+        for i in range(5)
+    ]
+
+    progress = []
+    userlog = sync(set(notes), col_tuple.col, 'Default', batch_size=2,
+                   callback=lambda done, total: progress.append((done, total)))
+    assert 'Added 5 notes' in userlog
+    assert progress == [(2, 5), (4, 5), (5, 5)]
+
+    col = col_tuple.col
+    assert len(col.find_notes("tag:batch")) == 5
+    scheduled = col.find_cards('deck:Batch')
+    assert len(scheduled) == 2
+    assert all(col.get_card(cid).due == 3 for cid in scheduled)
+    assert all(col.get_card(cid).type == 0 for cid in col.find_cards('deck:Default'))
+
+
+def test_update_in_batches(col_tuple):
+    "Changed notes are written back in batches, and unchanged notes are left alone."
+    col = col_tuple.col
+    sync(_qa_notes(["Answer"] * 5), col, 'Default')
+    unchanged_mod = col.get_note(col.find_notes('"Question 0"')[0]).mod
+
+    progress = []
+    userlog = sync(_qa_notes(["Answer", "New", "New", "New", "Answer"]), col,
+                   'Default', batch_size=2,
+                   callback=lambda done, total: progress.append((done, total)))
+    assert 'Updated 3 notes' in userlog
+    assert progress == [(2, 3), (3, 3)]
+    assert len(col.find_notes('Answer:New')) == 3
+    assert col.get_note(col.find_notes('"Question 0"')[0]).mod == unchanged_mod
+
+
+def _interrupt_second_update(col, monkeypatch):
+    "Make the second call to col.update_notes() fail, as if Anki had crashed."
+    original_update = col.update_notes
+    calls = []
+    def update(notes):
+        calls.append(notes)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        return original_update(notes)
+    monkeypatch.setattr(col, 'update_notes', update)
+
+
+def test_sync_one_wiki(col_tuple, tmp_path, monkeypatch):
+    "Syncing one wiki leaves notes from other wikis, and their fingerprints, alone."
+    wikis = [Wiki(name, Path("."), Path("."), WikiType.FOLDER)
+             for name in ("Languages", "Research")]
+    def make_notes(wiki, count, answer="Answer"):
+        return _qa_notes([answer] * count, wiki=wiki,
+                         prefix=f"202001011205{wikis.index(wiki)}")
+
+    col = col_tuple.col
+    fingerprint_path = tmp_path / "fingerprints.sqlite"
+    all_notes = make_notes(wikis[0], 3) | make_notes(wikis[1], 3)
+    sync(all_notes, col, 'Default')
+    # Notes modified in the last second aren't fingerprinted.
+    with monkeypatch.context() as m:
+        _finish_sync_later(m)
+        sync(all_notes, col, 'Default', fingerprint_path=fingerprint_path)
+    assert len(FingerprintStore(fingerprint_path).load()) == 6
+
+    userlog = sync(make_notes(wikis[0], 2, "New"), col, 'Default',
+                   fingerprint_path=fingerprint_path, wikis={"Languages"})
+    assert userlog == "Added 0 notes.\nUpdated 2 notes.\nRemoved 1 note."
+    assert len(col.find_notes('Wiki:Languages')) == 2
+    assert len(col.find_notes('Wiki:Research')) == 3
+    fingerprints = FingerprintStore(fingerprint_path).load()
+    assert sum(fp.wiki == "Research" for fp in fingerprints.values()) == 3
+
+
+def test_resume_interrupted_sync(col_tuple, tmp_path, monkeypatch):
+    "An interrupted sync carries on from the last complete chunk."
+    make_notes = lambda answers: _qa_notes(answers, prefix="2020010112010")
+
+    col = col_tuple.col
+    journal_path = tmp_path / "journal.sqlite"
+    sync(make_notes(["Answer"] * 5), col, 'Default')
+
+    new_notes = make_notes(["New"] * 6)
+    with monkeypatch.context() as m:
+        _interrupt_second_update(col, m)
+        with pytest.raises(KeyboardInterrupt):
+            sync(new_notes, col, 'Default', batch_size=2, journal_path=journal_path)
+    assert len(col.find_notes('Answer:New')) == 3
+    assert journal_path.exists()
+    assert SyncJournal(journal_path).interrupted(col.mod)
+
+    # Nothing is compared or added again; only the remaining notes are updated.
+    monkeypatch.setattr(ankisync, 'plan_sync', None)
+    monkeypatch.setattr(col, 'add_notes', None)
+    progress = []
+    userlog = sync(new_notes, col, 'Default', batch_size=2, journal_path=journal_path,
+                   callback=lambda done, total: progress.append((done, total)))
+    assert userlog == "Added 1 note.\nUpdated 5 notes.\nRemoved 0 notes."
+    assert progress == [(3, 6), (5, 6), (6, 6)]
+    assert len(col.find_notes('Answer:New')) == 6
+    assert not journal_path.exists()
+    assert not SyncJournal(journal_path).interrupted(col.mod)
+
+
+def test_stale_journal_ignored(col_tuple, tmp_path, monkeypatch):
+    "An interrupted sync is planned again if the collection has changed since."
+    make_notes = lambda answers: _qa_notes(answers, prefix="2020010112020")
+
+    col = col_tuple.col
+    journal_path = tmp_path / "journal.sqlite"
+    sync(make_notes(["Answer"] * 4), col, 'Default')
+
+    new_notes = make_notes(["New"] * 4)
+    with monkeypatch.context() as m:
+        _interrupt_second_update(col, m)
+        with pytest.raises(KeyboardInterrupt):
+            sync(new_notes, col, 'Default', batch_size=2, journal_path=journal_path)
+
+    edited = col.get_note(col.find_notes('Answer:New')[0])
+    edited['Answer'] = "Edited in Anki"
+    col.update_note(edited)
+    assert not SyncJournal(journal_path).interrupted(col.mod)
+
+    userlog = sync(new_notes, col, 'Default', batch_size=2, journal_path=journal_path)
+    assert 'Updated 3 notes' in userlog
+    assert len(col.find_notes('Answer:New')) == 4
+
+
+def _finish_sync_later(monkeypatch) -> None:
+    """
+    Make syncs believe they finish a couple of seconds from now, so the notes
+    they touch count as settled and are fingerprinted without waiting.
+    """
+    later = time.time() + 2
+    monkeypatch.setattr(ankisync.time, 'time', lambda: later)
+
+
+def test_fingerprints(col_tuple, tmp_path, monkeypatch):
+    "Notes unchanged since the last sync are recognized without comparing their fields."
+    make_notes = lambda answers: _qa_notes(answers, tags={"fp"})
+    col = col_tuple.col
+    fingerprint_path = tmp_path / "fingerprints.sqlite"
+    sync(make_notes(["Answer"] * 3), col, 'Default', fingerprint_path=fingerprint_path)
+
+    # Notes modified in the same second as the end of the sync can't be
+    # fingerprinted yet; they will be on the next sync.
+    assert not FingerprintStore(fingerprint_path).load()
+    with monkeypatch.context() as m:
+        _finish_sync_later(m)
+        assert 'Updated 0 notes' in sync(make_notes(["Answer"] * 3), col, 'Default',
+                                         fingerprint_path=fingerprint_path)
+    assert len(FingerprintStore(fingerprint_path).load()) == 3
+
+    def fail(self, anki_note):
+        raise AssertionError(f"Compared fields of {self!r}")
+    with monkeypatch.context() as m:
+        m.setattr(TwNote, 'fields_equal', fail)
+        userlog = sync(make_notes(["Answer", "New", "Answer"]), col, 'Default',
+                       fingerprint_path=fingerprint_path)
+    assert 'Updated 1 note.' in userlog
+    assert len(col.find_notes('Answer:New')) == 1
+
+    # A note edited in Anki no longer matches its fingerprint, so it's
+    # compared in full and restored.
+    anki_note = col.get_note(col.find_notes('"Question 0"')[0])
+    anki_note['Answer'] = "Edited in Anki"
+    col.update_note(anki_note)
+    userlog = sync(make_notes(["Answer", "New", "Answer"]), col, 'Default',
+                   fingerprint_path=fingerprint_path)
+    assert 'Updated 1 note.' in userlog
+    assert col.get_note(anki_note.id)['Answer'] == "Answer"
+
+
+def test_resync_writes_nothing(col_tuple, monkeypatch):
+    "Syncing the same notes twice doesn't touch the collection the second time."
+    medium = TwMedia.from_data(b"picture", "pic.png", "file:///pic.png", [])
+    def make_notes():
+        return {
+            QuestionNote(id_="20200101120500000", wiki=_WIKI, tidref="TestTiddler",
+                         question="Cafe\u0301 in Paris?\r\nYes.",
+                         answer=f'<img src="{medium.filename}">',
+                         target_tags={"zeta", "Alpha", "alpha", "mid word"},
+                         target_deck="Elsewhere", media={medium}),
+            ClozeNote(id_="20200101120500001", wiki=_WIKI, tidref="TestTiddler",
+                      text="{{c1::One}} and {{c2::two}}", target_tags={"b", "A"},
+                      target_deck=None,
+                      schedule=SchedulingInfo(ivl=3, due=datetime.date.today(),
+                                              ease=2500, lapses=0)),
+        }
+
+    col = col_tuple.col
+    sync(make_notes(), col, 'Default')
+    state = lambda: (col.db.all("select id, mod, usn, tags, flds from notes order by id"),
+                     col.db.all("select id, mod, usn, did from cards order by id"))
+    before = state()
+
+    writes = []
+    for obj, method in ((col, 'update_notes'), (col, 'update_note'), (col, 'add_notes'),
+                        (col, 'update_cards'), (col, 'set_deck'), (col, 'remove_notes'),
+                        (col.models, 'change_notetype_of_notes'), (col.media, 'write_data')):
+        monkeypatch.setattr(obj, method,
+                            lambda *args, _method=method, **kwargs: writes.append(_method))
+
+    userlog = sync(make_notes(), col, 'Default')
+    assert 'Added 0 notes.\nUpdated 0 notes.\nRemoved 0 notes.' == userlog
+    assert not writes
+    assert state() == before
+
+
+def test_move_decks(col_tuple, monkeypatch):
+    "All cards of notes whose deck changed are moved, with one call per deck."
+    def make_notes(decks):
+        return {_cloze(i, f"Note {{{{c1::{i}}}}} has {{{{c2::two}}}} cards.", deck=deck)
+                for i, deck in enumerate(decks)}
+
+    col = col_tuple.col
+    sync(make_notes([None, None, None, "Two"]), col, 'Default')
+    assert len(col.find_cards('deck:Default')) == 6
+
+    set_deck_calls = []
+    original_set_deck = col.set_deck
+    def set_deck(cids, did):
+        set_deck_calls.append(did)
+        return original_set_deck(cids, did)
+    monkeypatch.setattr(col, 'set_deck', set_deck)
+
+    sync(make_notes(["One", None, "One", None]), col, 'Default')
+    assert len(col.find_cards('deck:One')) == 4
+    assert len(col.find_cards('deck:Default')) == 4
+    assert not col.find_cards('deck:Two')
+    assert len(set_deck_calls) == 2
+
+
 def test_import_qa_with_scheduling(fn_params, col_tuple):
     "Test that we can import a question and answer into Anki with scheduling info."
 
@@ -145,7 +424,7 @@ def test_import_qa_with_negative_due_date(col_tuple):
     }
     n = QuestionNote(
         id_="20200101120100000",
-        wiki=Wiki("MyTestWiki", Path("."), Path("."), WikiType.FOLDER),
+        wiki=_WIKI,
         tidref="TestTiddler",
         question="Does this question get correctly scheduled?",
         answer="I hope so",
@@ -183,7 +462,7 @@ def test_update_qa(fn_params, col_tuple):
 
     # update
     def update(note):
-        note.question = "How much wood could a woodchuck chuck?"
+        note.set_content(question="How much wood could a woodchuck chuck?")
     userlog = _sync_note_with_edits(fn_params, col_tuple, "BasicQuestionAndAnswer",
                                     update)
 
@@ -284,10 +563,131 @@ def test_image_resync(fn_params, col_tuple):
     assert col_tuple.col.media.have(expected_initial_filename)
 
     # Resync; we have to change a field before it will try to resync the image.
-    note.question = "A new question"
+    note.set_content(question="A new question")
     sync((note,), col_tuple.col, "Default")
     assert col_tuple.col.media.have(expected_initial_filename)
 
     r = col_tuple.col.media.check()
     assert not r.missing
     assert not r.unused
+
+
+def test_media_not_read_when_already_in_anki(col_tuple):
+    """
+    Media whose hash we already know shouldn't be retrieved at all if Anki
+    already has the file, even when the note using it is updated.
+    """
+    data = b"not really a png"
+    medium = TwMedia.from_data(data, "picture.png", "file:///picture.png", [])
+    n = QuestionNote(
+        id_="20200101120200000",
+        wiki=_WIKI,
+        tidref="TestTiddler",
+        question=f'<img src="{medium.filename}">',
+        answer="A picture",
+        target_tags=set(),
+        target_deck="Default",
+        media={medium},
+    )
+    sync((n,), col_tuple.col, 'Default')
+    assert col_tuple.col.media.have(medium.filename)
+
+    # The source no longer exists, so reading from it would fail.
+    unread = TwMedia("picture.png", "file:///nonexistent/picture.png",
+                     medium.hash, medium.extension)
+    n.media = {unread}
+    n.set_content(answer="Still a picture")
+    userlog = sync((n,), col_tuple.col, 'Default')
+    assert 'Updated 1 note' in userlog
+
+
+def test_missing_media_stops_sync(col_tuple):
+    """
+    Media that was known when the notes were extracted but can't be read when
+    it's needed stops the sync with an error, before anything has changed.
+    """
+    gone = TwMedia("picture.png", "file:///nonexistent/picture.png",
+                   "0" * 64, ".png")
+    n = QuestionNote(
+        id_="20200101120250000",
+        wiki=_WIKI,
+        tidref="TestTiddler",
+        question=f'<img src="{gone.filename}">',
+        answer="A picture",
+        target_tags=set(),
+        target_deck="Default",
+        media={gone},
+    )
+    with pytest.raises(ExtractError, match="picture.png"):
+        sync((n,), col_tuple.col, 'Default')
+    assert not col_tuple.col.find_notes("")
+
+
+def test_change_note_type_to_cloze(col_tuple):
+    "A Q&A note can be turned into a cloze note by reusing its ID."
+    qa = _qa(0, "Paris", prefix="2020010112030", deck="Default",
+             question="What is the capital of France?")
+    sync((qa,), col_tuple.col, 'Default')
+    nid = _get_only_note(col_tuple).id
+
+    cloze = _cloze(0, "The capital of France is {{c1::Paris}}.", prefix="2020010112030",
+                   deck="Default")
+    userlog = sync((cloze,), col_tuple.col, 'Default')
+
+    assert 'Updated 1 note' in userlog
+    anki_note = _get_only_note(col_tuple)
+    assert anki_note.id == nid
+    assert anki_note.note_type()['name'] == ClozeNote.model.name
+    assert anki_note['Text'] == "The capital of France is {{c1::Paris}}."
+
+
+def test_change_note_types_grouped(col_tuple, monkeypatch):
+    "Notes changing between the same pair of note types are converted together."
+    qa = lambda i: _qa(i, f"Answer {i}", prefix="2020010112040", deck="Default")
+    cloze = lambda i: _cloze(i, prefix="2020010112040", deck="Default")
+
+    col = col_tuple.col
+    sync({qa(0), qa(1), qa(2), cloze(3)}, col, 'Default')
+
+    change_calls = []
+    original_change = col.models.change_notetype_of_notes
+    def change(request):
+        change_calls.append(list(request.note_ids))
+        return original_change(request)
+    monkeypatch.setattr(col.models, 'change_notetype_of_notes', change)
+
+    userlog = sync({cloze(0), cloze(1), cloze(2), qa(3)}, col, 'Default')
+    assert 'Updated 4 notes' in userlog
+    assert len(change_calls) == 2
+    assert sorted(len(nids) for nids in change_calls) == [1, 3]
+    assert len(col.find_notes(f'"note:{ClozeNote.model.name}"')) == 3
+    assert len(col.find_notes(f'"note:{QuestionNote.model.name}"')) == 1
+    assert len(col.find_notes('Text:Cloze*')) == 3
+
+
+def test_sync_op_undo(col_tuple):
+    "Everything a sync does can be undone in one step."
+    qa = lambda i, answer="Answer", deck=None: _qa(i, answer, prefix="2020010112060",
+                                                   deck=deck)
+    col = col_tuple.col
+    sync({qa(0), qa(1), qa(2)}, col, 'Default')
+    state = lambda: (col.db.all("select id, mid, flds from notes order by id"),
+                     col.db.all("select id, nid, did from cards order by id"))
+    before = state()
+
+    new_notes = {
+        qa(0, "Changed"),
+        qa(1, deck="Moved"),
+        _cloze(2, "{{c1::Retyped}}", prefix="2020010112060"),
+        qa(3),
+    }
+    plan = make_plan(new_notes, col, 'Default')
+    assert len(plan.type_changes) == 1
+    result = sync_op(plan, new_notes, col, 'Default')
+    assert 'Added 1 note.\nUpdated 2 notes.' in result.log
+    assert result.changes.note_text
+    assert state() != before
+
+    assert col.undo_status().undo == ankisync.UNDO_NAME
+    col.undo()
+    assert state() == before
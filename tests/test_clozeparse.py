@@ -0,0 +1,68 @@
+"""
+test_clozeparse - test the conversion of TiddlyRemember clozes to Anki's format
+"""
+
+# pylint: disable=import-error
+# pylint: disable=wrong-import-position
+
+# Must run from the project root.
+import sys
+sys.path.append("anki-plugin")
+
+from collections import Counter
+import itertools
+import random
+import re
+
+from src.clozeparse import ankify_clozes
+
+
+def _reference_ankify_clozes(text: str) -> str:
+    """
+    The original implementation of ankify_clozes(), which substituted
+    placeholders for the occlusions and then filled them back in.
+    """
+    occlusions = []
+    def mark_occlusion(match):
+        m = re.match(r'^c(?P<index>[1-9][0-9]*)::(?P<text>.*)', match.group(1))
+        if m:
+            occlusions.append([int(m.group('index')), m.group('text')])
+        else:
+            occlusions.append([None, match.group(1)])
+        return "©<%i>©" % (len(occlusions) - 1)  # pylint: disable=consider-using-f-string
+    placeholder_text = re.sub(r'(?<!\\){(.*?)(?<!\\)}', mark_occlusion, text)
+
+    used = [o[0] for o in occlusions if o[0] is not None]
+    if not used:
+        numbers = itertools.count(1, 1)
+    else:
+        c = Counter(used)
+        numbers = itertools.chain((i for i in range(1, max(used)) if c[i] == 0),
+                                  itertools.count(max(used) + 1, 1))
+    for index, occlusion in zip(numbers, [o for o in occlusions if o[0] is None]):
+        occlusion[0] = index
+
+    def replace_placeholder(match):
+        index, occluded = occlusions[int(match.group(1))]
+        return "{{c%i::%s}}" % (index, occluded)  # pylint: disable=consider-using-f-string
+    cloze_text = re.sub(r'©<([0-9]+)>©', replace_placeholder, placeholder_text)
+    return re.sub(r'\\([{}])', r'\1', cloze_text)
+
+
+def test_same_as_reference():
+    "Random cloze texts convert exactly as they did with the original implementation."
+    rng = random.Random(45)
+    pieces = ["{", "}", "\\", "c1::", "c3::", "c12::", "c0::", "::", "c", "word",
+              " ", "\n", "`"]
+    for _ in range(50000):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 16)))
+        assert ankify_clozes(text) == _reference_ankify_clozes(text), text
+
+
+def test_results_cached():
+    "Converting the same text again reuses the earlier result."
+    ankify_clozes.cache_clear()
+    text = "A {transcluded} {c2::cloze}."
+    first = ankify_clozes(text)
+    assert ankify_clozes(text) is first
+    assert ankify_clozes.cache_info().hits == 1
@@ -0,0 +1,63 @@
+"""
+test_folderwatch - test noticing changes to the tiddlers of a folder wiki
+"""
+
+# pylint: disable=import-error
+# pylint: disable=wrong-import-position
+
+# Must run from the project root.
+import sys
+sys.path.append("anki-plugin")
+
+import os
+
+import pytest
+
+from src.folderwatch import Inotify, changed_titles, scan
+
+
+def test_changed_tiddlers_found(tmp_path):
+    """
+    Comparing snapshots of a tiddlers folder gives the titles of the tiddlers
+    added, edited, or deleted, or None if a file we can't read changed.
+    """
+    (tmp_path / "Alpha.tid").write_text("title: Alpha\n\nText")
+    (tmp_path / "beta.tid").write_text("created: 20200101\ntitle: Beta Tiddler\n\nText")
+    (tmp_path / "image.png").write_bytes(b"\x89PNG")
+    (tmp_path / "image.png.meta").write_text("title: A Picture\ntype: image/png\n")
+    (tmp_path / ".Alpha.tid.swp").write_text("ignored")
+    first = scan(tmp_path)
+    assert sorted(title for entry in first.values() for title in entry.titles) \
+        == ["A Picture", "A Picture", "Alpha", "Beta Tiddler"]
+    assert changed_titles(first, scan(tmp_path, first)) == set()
+
+    (tmp_path / "beta.tid").write_text("title: Renamed\n\nText")
+    (tmp_path / "Alpha.tid").unlink()
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "Gamma.tid").write_text("title: Gamma\n\nText")
+    (tmp_path / ".Alpha.tid.swp").write_text("still ignored")
+    second = scan(tmp_path, first)
+    assert changed_titles(first, second) == {"Alpha", "Beta Tiddler", "Renamed", "Gamma"}
+
+    (tmp_path / "more.json").write_text('[{"title": "Delta"}]')
+    assert changed_titles(second, scan(tmp_path, second)) is None
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="inotify is Linux-only")
+def test_inotify_reports_changes(tmp_path):
+    "Inotify notices changes to files, including those in new folders."
+    (tmp_path / "Alpha.tid").write_text("title: Alpha\n\nText")
+    inotify = Inotify(tmp_path)
+    try:
+        assert not inotify.read()
+        (tmp_path / "Alpha.tid").write_text("title: Alpha\n\nEdited")
+        assert inotify.read()
+        (tmp_path / "sub").mkdir()
+        assert inotify.read()
+        (tmp_path / "sub" / "Beta.tid").write_text("title: Beta\n\nText")
+        assert inotify.read()
+        assert not inotify.read()
+        os.unlink(tmp_path / "sub" / "Beta.tid")
+        assert inotify.read()
+    finally:
+        inotify.close()
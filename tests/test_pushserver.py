@@ -0,0 +1,176 @@
+"""
+test_pushserver - test accepting tiddlers pushed by a running TiddlyWiki
+"""
+
+# pylint: disable=import-error
+# pylint: disable=wrong-import-position
+# pylint: disable=redefined-outer-name
+
+# Must run from the project root.
+import sys
+sys.path.append("anki-plugin")
+
+from http.client import HTTPConnection
+import json
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+from src.oops import PushError
+from src.pushserver import Push, PushServer
+
+WIKI_FILTER = "[type[text/vnd.tiddlywiki]] [type[]] +[!is[system]]"
+TOKEN = "s3cr3t-t0ken"
+
+
+@pytest.fixture
+def server():
+    "A push server on a free port, recording the pushes it's handed."
+    pushes: List[Push] = []
+    def handler(push: Push) -> str:
+        if push.wiki == "Busy":
+            raise PushError("Anki is busy.", status=503)
+        pushes.append(push)
+        return f"Synced {len(push.tiddlers)} tiddler(s)."
+    def filter_for(wiki: str) -> str:
+        if wiki not in ("MyWiki", "Busy"):
+            raise PushError("No such wiki.", status=404)
+        return WIKI_FILTER
+    push_server = PushServer(handler, filter_for, 0, TOKEN)
+    push_server.pushes = pushes
+    yield push_server
+    push_server.close()
+
+
+def request(server: PushServer, method: str, body: Optional[bytes] = None,
+            headers: Optional[Dict[str, str]] = None,
+            path: str = f'/{TOKEN}/') -> Tuple[int, dict, Optional[dict]]:
+    """
+    Send a request to the server as the TiddlyWiki plugin would, returning
+    the status, headers, and JSON body of the response.
+    """
+    conn = HTTPConnection('127.0.0.1', server.port, timeout=10)
+    try:
+        conn.request(method, path, body=body, headers={
+            'Content-Type': 'application/json', **(headers or {})})
+        response = conn.getresponse()
+        data = response.read()
+        return (response.status, dict(response.getheaders()),
+                json.loads(data) if data else None)
+    finally:
+        conn.close()
+
+
+def test_push_synced(server):
+    "A push is parsed and handed on, and the handler's result sent back."
+    body = json.dumps({
+        'wiki': "MyWiki",
+        'filter': WIKI_FILTER,
+        'tiddlers': [{'title': "Alpha", 'html': "<p>Alpha</p>"}],
+        'deleted': ["Beta"],
+    }).encode('utf-8')
+    status, headers, result = request(server, 'POST', body,
+                                      {'Origin': "http://localhost:8080"})
+    assert status == 200
+    assert result == {'result': "Synced 1 tiddler(s)."}
+    assert headers['Access-Control-Allow-Origin'] == "http://localhost:8080"
+    assert server.pushes == [Push("MyWiki", WIKI_FILTER, {"Alpha": "<p>Alpha</p>"}, ["Beta"])]
+
+
+def test_push_limited_to_wiki_filter(server):
+    """
+    The wiki is told its content filter, and a push of tiddlers chosen with
+    any other filter, which might take in tiddlers a full sync wouldn't
+    render, is refused.
+    """
+    status, _, result = request(server, 'GET', path=f'/{TOKEN}/?wiki=MyWiki')
+    assert status == 200 and result == {'filter': WIKI_FILTER}
+    status, _, _ = request(server, 'GET', path=f'/{TOKEN}/?wiki=Unknown')
+    assert status == 404
+
+    # A JavaScript tiddler matches the plugin's PushFilter, but not the
+    # wiki's filter, so it may only be pushed as no longer selected.
+    script = {'title': "Script", 'html': "<p>Not wikitext</p>"}
+    body = json.dumps({'wiki': "MyWiki", 'filter': "[!is[system]!has[draft.of]]",
+                       'tiddlers': [script]}).encode('utf-8')
+    status, _, result = request(server, 'POST', body)
+    assert status == 409 and 'filter' in result['error']
+    assert not server.pushes
+
+    body = json.dumps({'wiki': "MyWiki", 'filter': WIKI_FILTER,
+                       'tiddlers': [], 'deleted': ["Script"]}).encode('utf-8')
+    status, _, _ = request(server, 'POST', body)
+    assert status == 200
+    assert server.pushes == [Push("MyWiki", WIKI_FILTER, {}, ["Script"])]
+
+
+def test_push_errors_reported(server):
+    "Bad pushes and pushes the handler refuses are answered with an error."
+    status, _, result = request(server, 'POST', b'{"wiki": "MyWiki"')
+    assert status == 400 and 'error' in result
+
+    body = json.dumps({'wiki': "Unknown", 'filter': WIKI_FILTER,
+                       'tiddlers': []}).encode('utf-8')
+    status, _, result = request(server, 'POST', body)
+    assert status == 404 and result == {'error': "No such wiki."}
+
+    body = json.dumps({'wiki': "Busy", 'filter': WIKI_FILTER, 'tiddlers': []}).encode('utf-8')
+    status, _, result = request(server, 'POST', body)
+    assert status == 503 and result == {'error': "Anki is busy."}
+
+    # A negative length would otherwise leave the server reading until the
+    # client hangs up.
+    conn = HTTPConnection('127.0.0.1', server.port, timeout=10)
+    try:
+        conn.putrequest('POST', f'/{TOKEN}/')
+        conn.putheader('Content-Length', '-1')
+        conn.endheaders()
+        response = conn.getresponse()
+        assert response.status == 400 and 'error' in json.loads(response.read())
+    finally:
+        conn.close()
+    assert not server.pushes
+
+
+def test_foreign_pages_refused(server):
+    """
+    Only pages served from this computer may push, and only to a server
+    they reach by a local name.
+    """
+    status, headers, _ = request(server, 'OPTIONS',
+                                 headers={'Origin': "http://127.0.0.1:8080"})
+    assert status == 204
+    assert headers['Access-Control-Allow-Origin'] == "http://127.0.0.1:8080"
+
+    body = json.dumps({'wiki': "MyWiki", 'filter': WIKI_FILTER,
+                       'tiddlers': []}).encode('utf-8')
+    status, headers, _ = request(server, 'OPTIONS', headers={'Origin': "https://example.com"})
+    assert status == 403 and 'Access-Control-Allow-Origin' not in headers
+    status, _, _ = request(server, 'POST', body, {'Origin': "https://example.com"})
+    assert status == 403
+    status, _, _ = request(server, 'POST', body, {'Host': "attacker.example:8739"})
+    assert status == 403
+    status, _, _ = request(server, 'GET', headers={'Origin': "https://example.com"},
+                           path=f'/{TOKEN}/?wiki=MyWiki')
+    assert status == 403
+    assert not server.pushes
+
+
+def test_token_required(server):
+    "Only requests to the server's URL, which holds its token, are answered."
+    assert server.url == f"http://127.0.0.1:{server.port}/{TOKEN}/"
+    body = json.dumps({'wiki': "MyWiki", 'filter': WIKI_FILTER,
+                       'tiddlers': []}).encode('utf-8')
+    for path in ('/', '/wrong-token/', f'/{TOKEN}extra/'):
+        status, _, _ = request(server, 'POST', body, {'Origin': "http://localhost:8080"},
+                               path=path)
+        assert status == 403
+        status, _, _ = request(server, 'GET', path=f'{path}?wiki=MyWiki')
+        assert status == 403
+        status, _, _ = request(server, 'OPTIONS', headers={'Origin': "http://localhost:8080"},
+                               path=path)
+        assert status == 403
+    assert not server.pushes
+
+    status, _, _ = request(server, 'POST', body, path=f'/{TOKEN}')
+    assert status == 200
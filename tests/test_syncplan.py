@@ -0,0 +1,117 @@
+# pylint: disable=import-error
+# pylint: disable=wrong-import-position
+
+# Must run from the project root.
+import sys
+sys.path.append("anki-plugin")
+
+from pathlib import Path
+import time
+
+from src.snapshot import CollectionSnapshot, NoteRow
+from src.syncplan import DeckMove, NoteRef, SyncPlan, TypeChange, plan_sync
+from src.twnote import ClozeNote, QuestionNote
+from src.wiki import Wiki, WikiType
+
+
+WIKI = Wiki("MyTestWiki", Path("."), Path("."), WikiType.FOLDER)
+
+
+def _qa(i, answer="Answer", deck=None):
+    return QuestionNote(id_=f"2020010112{i:07d}", wiki=WIKI, tidref="TestTiddler",
+                        question=f"Question {i}", answer=answer,
+                        target_tags={"tag"}, target_deck=deck)
+
+
+def _cloze(i):
+    return ClozeNote(id_=f"2020010112{i:07d}", wiki=WIKI, tidref="TestTiddler",
+                     text=f"Cloze {{{{c1::{i}}}}}", target_tags={"tag"},
+                     target_deck=None)
+
+
+def _row(nid, tw_note):
+    "A snapshot row for an Anki note last synced from /tw_note/."
+    return NoteRow(nid, 1, tw_note.model, 0, None, None, tw_note.id_, tw_note.digest,
+                   tw_note.wiki.name)
+
+
+def test_plan_without_collection():
+    "Plans are made from a snapshot alone and cover every kind of change."
+    in_anki = [_qa(0), _qa(1), _qa(2), _qa(3), _qa(4)]
+    snapshot = CollectionSnapshot(
+        [_row(100 + i, note) for i, note in enumerate(in_anki)],
+        {100 + i: {"Default"} for i in range(len(in_anki))})
+    snapshot.card_decks[104] = {"Default", "Elsewhere"}
+
+    wiki_notes = {_qa(0), _qa(1, "Changed"), _cloze(2), _qa(4), _qa(5)}
+    plan = plan_sync(wiki_notes, snapshot, 'Default')
+
+    assert plan.adds == (_qa(5).id_,)
+    assert plan.edits == (NoteRef(_qa(1).id_, 101), NoteRef(_qa(2).id_, 102))
+    assert plan.type_changes == (
+        TypeChange(QuestionNote.model.name, ClozeNote.model.name, (102,)),)
+    assert plan.deck_moves == (DeckMove('Default', (104,)),)
+    assert plan.removes == (103,)
+    assert plan.unchanged == (NoteRef(_qa(0).id_, 100), NoteRef(_qa(4).id_, 104))
+    assert plan.summary() == "Added 1 note.\nUpdated 2 notes.\nRemoved 1 note."
+
+
+def test_plan_deck_names_case_insensitive():
+    "Cards in a deck whose name differs only in case are not moved."
+    snapshot = CollectionSnapshot([_row(100, _qa(0))], {100: {"my deck"}})
+    assert not plan_sync({_qa(0, deck="My Deck")}, snapshot, 'Default').deck_moves
+
+
+def test_plan_scoped_to_wikis():
+    "A sync limited to some wikis only removes notes that came from them."
+    other_wiki = Wiki("OtherWiki", Path("."), Path("."), WikiType.FOLDER)
+    other = QuestionNote(id_="20200101130000000", wiki=other_wiki, tidref="TestTiddler",
+                         question="Elsewhere?", answer="Yes",
+                         target_tags=set(), target_deck=None)
+    snapshot = CollectionSnapshot([_row(100, _qa(0)), _row(101, _qa(1)), _row(102, other)],
+                                  {100: {"Default"}, 101: {"Default"}, 102: {"Default"}})
+
+    assert plan_sync({_qa(0)}, snapshot, 'Default').removes == (101, 102)
+    plan = plan_sync({_qa(0)}, snapshot, 'Default', wikis={WIKI.name})
+    assert plan.removes == (101,)
+    assert plan.unchanged == (NoteRef(_qa(0).id_, 100),)
+
+
+def test_plan_scoped_to_removable_notes():
+    "A sync of just some tiddlers only removes the notes that came from them."
+    snapshot = CollectionSnapshot([_row(100 + i, _qa(i)) for i in range(4)],
+                                  {100 + i: {"Default"} for i in range(4)})
+    plan = plan_sync({_qa(0, answer="Edited")}, snapshot, 'Default',
+                     wikis={WIKI.name}, removable={_qa(2).id_})
+    assert plan.edits == (NoteRef(_qa(0).id_, 100),)
+    assert plan.removes == (102,)
+
+
+def test_plan_json_round_trip():
+    "Plans can be serialized and read back unchanged."
+    snapshot = CollectionSnapshot([_row(100, _qa(0)), _row(101, _qa(1))],
+                                  {100: {"Default"}, 101: {"Default"}})
+    plan = plan_sync({_cloze(0), _qa(2, deck="Other")}, snapshot, 'Default')
+    assert SyncPlan.from_json(plan.to_json()) == plan
+
+
+def test_plan_large_input():
+    "Planning a large sync is deterministic and doesn't take long."
+    count = 20000
+    notes = [_qa(i) for i in range(count)]
+    snapshot = CollectionSnapshot([_row(i, note) for i, note in enumerate(notes)
+                                   if i % 10],
+                                  {i: {"Default"} for i in range(count)})
+    # The last 1000 notes are removed from the wiki and the first 500 changed.
+    wiki_notes = [_qa(i, "Changed") if i < 500 else notes[i] for i in range(count - 1000)]
+
+    start = time.perf_counter()
+    plan = plan_sync(wiki_notes, snapshot, 'Default')
+    elapsed = time.perf_counter() - start
+
+    assert len(plan.adds) == 1900
+    assert len(plan.edits) == 450
+    assert len(plan.removes) == 900
+    assert len(plan.unchanged) == 19000 - 1900 - 450
+    assert plan_sync(reversed(wiki_notes), snapshot, 'Default') == plan
+    assert elapsed < 10
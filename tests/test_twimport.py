@@ -10,15 +10,29 @@ test_twimport - test the creation of TwNote objects from a TiddlyWiki
 import sys
 sys.path.append("anki-plugin")
 
+import base64
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import os
 from pathlib import Path
+import random
 import re
+import threading
+import time
+import tracemalloc
+from typing import List, Set
 
+from bs4 import BeautifulSoup
 import pytest
 
-from src.oops import RenderingError
-from src.twimport import find_notes
-from src.twnote import TwNote, QuestionNote, ClozeNote, PairNote
+from src.media import MediaCache, TwMedia
+from src.oops import ExtractError, RenderingError
+from src.parsecache import ParseCache
+from src import twimport, twnote
+from src.twimport import (_notes_from_paths, find_changed_notes, find_notes, find_pushed_notes,
+                         iter_notes)
+from src.twnote import TwNote, QuestionNote, ClozeNote, PairNote, extract_media
+from src.util import split_tiddler_list, _split_tiddler_list_slowly
+from src.wiki import Wiki, WikiType
 
 from testutils import fn_params, file_requests_session, mock_tiddler_deck_tags  # pylint: disable=unused-import
 
@@ -328,6 +342,550 @@ def test_image_file_path_import(fn_params):
     assert re.match(r'<img.*src="tr-', note.answer)
 
 
+def test_relative_media_path_without_chdir(tmp_path, monkeypatch):
+    """
+    Relative media paths are resolved against the wiki's location without
+    changing the working directory, so wikis can be extracted concurrently.
+    """
+    wiki_path = Path("tests/wiki").absolute()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(os, 'chdir', None)
+
+    wiki = Wiki("MyTestWiki", wiki_path, wiki_path, WikiType.FOLDER)
+    soup = BeautifulSoup('<img src="files/cat.jpg">', 'html.parser')
+    media: Set[TwMedia] = set()
+    warnings: List[str] = []
+    extract_media(media, soup, wiki, "CatTiddler", warnings)
+
+    assert not warnings
+    medium, = media
+    assert medium.source == (wiki_path / "files" / "cat.jpg").as_uri()
+    assert soup.img['src'] == medium.filename
+
+
+def test_embedded_media_decoded_to_file(tmp_path):
+    """
+    Embedded media is decoded into a file beside the media cache, so that
+    notes don't carry the data: URI, and the file is dropped once unused.
+    """
+    content = bytes(range(256)) * 1000
+    uri = "data:image/png;base64," + base64.b64encode(content).decode('ascii')
+    cache = MediaCache(tmp_path / "media.json")
+    medium = cache.get(uri, uri, [])
+    assert medium.data == content
+    assert medium.filename.endswith(".png")
+    assert len(medium.url) < 100 and not medium.source.startswith("data:")
+    cache.save()
+    assert len(list(cache.inline_dir.iterdir())) == 1
+
+    # Recreated from a cache, the medium is found without the URI.
+    again = MediaCache(tmp_path / "media.json")
+    assert again.get(medium.url, medium.source, []).hash == medium.hash
+    again.save()
+    assert len(list(cache.inline_dir.iterdir())) == 1
+
+    MediaCache(tmp_path / "media.json").save()
+    assert not list(cache.inline_dir.iterdir())
+
+
+def test_remote_media_revalidated(tmp_path):
+    """
+    A cached hash of remote media is only reused if the server says the
+    media hasn't changed since; otherwise the new content is retrieved.
+    """
+    image = {'data': b"first picture", 'etag': '"1"'}
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            requests_seen.append(self.headers.get('If-None-Match'))
+            if self.headers.get('If-None-Match') == image['etag']:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', image['etag'])
+            self.send_header('Content-Length', str(len(image['data'])))
+            self.end_headers()
+            self.wfile.write(image['data'])
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/picture.png"
+    cache_file = tmp_path / "media.json"
+    def get():
+        cache = MediaCache(cache_file)
+        medium = cache.get(url, url, [])
+        cache.save()
+        return medium
+    try:
+        first = get()
+        assert get().hash == first.hash
+        image.update(data=b"second picture", etag='"2"')
+        assert get().hash != first.hash
+        assert requests_seen == [None, '"1"', '"1"']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _rendered_question(id_: str, question: str, reference: str = "",
+                       sched: str = "", deck: str = "", tags: str = "") -> str:
+    "The HTML TiddlyWiki renders for a <<rememberq>> call."
+    return f"""
+        <div class="rememberq remembertwo">
+            <div class="rquestion tr-ritem"><div>Q:</div><p>{question}</p></div>
+            <div class="ranswer tr-ritem"><div>A:</div><p>Answer</p></div>
+            <div class="rid">[{id_}]</div>
+            <div class="tr-reference">{reference}</div>
+            <div class="tr-sched">{sched}</div>
+            <div class="tr-deck">{deck}</div>
+            <div class="tr-tags">{tags}</div>
+        </div>"""
+
+
+def test_transcluded_notes_processed_once(tmp_path, monkeypatch):
+    """
+    A note transcluded into many tiddlers is only processed the first time
+    it's seen, and always gets its reference from the same tiddler.
+    """
+    shared = _rendered_question("20200101000000000", "Shared")
+    paths = []
+    for i in reversed(range(20)):
+        html = '<span id="tr-version">1.4.0</span>' + shared
+        html += _rendered_question(f"202001010000{i:02d}001", f"Own {i}")
+        path = tmp_path / f"Page{i:02d}.html"
+        path.write_text(html)
+        paths.append(path)
+
+    processed = []
+    original_extract_media = twnote.extract_media
+    def extract_media(media, soup, *args, **kwargs):
+        processed.append(soup.find("div", class_="rid").get_text())
+        return original_extract_media(media, soup, *args, **kwargs)
+    monkeypatch.setattr(twnote, 'extract_media', extract_media)
+
+    wiki = Wiki("MyTestWiki", tmp_path, tmp_path, WikiType.FOLDER)
+    notes = {n.id_: n for n in _notes_from_paths(paths, wiki, None, [])}
+    assert len(notes) == 21
+    assert processed.count("[20200101000000000]") == 1
+    assert notes["20200101000000000"].tidref == "Page00"
+
+
+def test_unchanged_tiddlers_not_reparsed(tmp_path, monkeypatch):
+    """
+    Tiddlers that render the same as last time get their notes from the
+    parse cache, and give the same notes as parsing them again would.
+    """
+    render = tmp_path / "render"
+    render.mkdir()
+    shared = _rendered_question("20200101000000000", "Shared")
+    for i in range(3):
+        html = '<span id="tr-version">1.4.0</span>' + shared
+        html += _rendered_question(f"202001010000{i:02d}001", f"Own {i}")
+        (render / f"Page{i:02d}.html").write_text(html)
+
+    parsed = []
+    original_soup = twimport.BeautifulSoup
+    def soup(text, *args, **kwargs):
+        parsed.append(text)
+        return original_soup(text, *args, **kwargs)
+    monkeypatch.setattr(twimport, 'BeautifulSoup', soup)
+
+    wiki = Wiki("MyTestWiki", tmp_path, tmp_path, WikiType.FOLDER)
+    def extract(paths):
+        parsed.clear()
+        cache = ParseCache(tmp_path / "parse.sqlite", str(tmp_path))
+        notes = _notes_from_paths(paths, wiki, None, [], parse_cache=cache)
+        cache.save()
+        cache.close()
+        return {n.id_: n.to_dict() for n in notes}
+
+    paths = sorted(render.glob("*.html"))
+    first = extract(paths)
+    assert len(parsed) == 3
+    assert extract(paths) == first
+    assert not parsed
+
+    # Only the edited tiddler is parsed, and the one that's no longer rendered
+    # is forgotten, so it has to be parsed if it's rendered again.
+    paths[1].write_text(paths[1].read_text().replace("Own 1", "Edited"))
+    edited = extract(paths[:2])
+    assert len(parsed) == 1
+    assert edited["20200101000001001"]["content"]["question"] == "Edited"
+    assert edited == {n.id_: n.to_dict() for n in _notes_from_paths(paths[:2], wiki, None, [])}
+    extract(paths)
+    assert len(parsed) == 1
+
+    # Once the tiddler holding the first copy of a transcluded note is gone,
+    # the next one is parsed again to pick the note up.
+    paths[0].unlink()
+    assert extract(paths[1:])["20200101000000000"]["tidref"] == "Page01"
+    assert len(parsed) == 1
+
+
+def test_note_dict_round_trip():
+    "A note recreated from its to_dict() has everything parsed for it."
+    wiki = Wiki("MyTestWiki", Path("wiki"), Path("wiki"), WikiType.FOLDER)
+    medium = TwMedia("cat.jpg", "file:///wiki/cat.jpg", "ab" * 32, ".jpg")
+    note = ClozeNote("20200101000000000", wiki, "Cats", "{{c1::Cats}} purr",
+                     {"animals", "pets"}, "Zoology", {medium},
+                     twnote.SchedulingInfo(3, twnote.date(2020, 1, 2), 2500, 1))
+    copy = TwNote.from_dict(note.to_dict(), wiki)
+    assert isinstance(copy, ClozeNote)
+    assert copy.to_dict() == note.to_dict()
+    assert copy.schedule == note.schedule
+    assert [m.filename for m in copy.media] == [medium.filename]
+    assert copy.digest == note.digest
+
+
+def test_note_digest_kept_until_changed(monkeypatch):
+    "A note's digest is only worked out again once the note has changed."
+    wiki = Wiki("MyTestWiki", Path("wiki"), Path("wiki"), WikiType.FOLDER)
+    note = QuestionNote("20200101000000000", wiki, "Cats", "Do cats purr?", "Yes",
+                        set(), None)
+    recorded = []
+    original = twnote._FieldRecorder
+    def recorder():
+        recorded.append(True)
+        return original()
+    monkeypatch.setattr(twnote, '_FieldRecorder', recorder)
+
+    first = note.digest
+    assert note.digest == first and len(recorded) == 1
+    note.set_content(answer="Loudly")
+    assert note.digest != first and len(recorded) == 2
+    note.set_permalink("https://example.com/")
+    note.digest  # pylint: disable=pointless-statement
+    assert len(recorded) == 3
+    with pytest.raises(AttributeError):
+        note.set_content(text="Not a cloze")
+
+
+def test_note_memory():
+    """
+    Apart from its field text, each note takes a small fixed amount of memory,
+    with tags, decks and references shared between notes that repeat them.
+    """
+    wiki = Wiki("MyTestWiki", Path("wiki"), Path("wiki"), WikiType.FOLDER)
+    count = 10000
+    ids = [f"2020{i:013d}" for i in range(count)]
+    fields = [f"Question {i}" for i in range(count)]
+
+    tracemalloc.start()
+    try:
+        with twnote.sharing_tags():
+            before = tracemalloc.get_traced_memory()[0]
+            # Build the strings for each note, as parsing a tiddler would.
+            notes = [QuestionNote(ids[i], wiki, "".join(("Page ", str(i % 50))),
+                                  fields[i], fields[i],
+                                  {"".join(("tag", str(i % 3))), "common"},
+                                  "".join(("Deck ", "A")), set(), None)
+                     for i in range(count)]
+            per_note = (tracemalloc.get_traced_memory()[0] - before) / count
+            assert len(twnote._TAG_SETS) == 3
+    finally:
+        tracemalloc.stop()
+
+    assert per_note < 200, f"{per_note:.0f} bytes per note"
+    assert len({id(n.target_tags) for n in notes}) == 3
+    assert len({id(n.target_deck) for n in notes}) == 1
+    # The notes keep sharing their tags, but the table is dropped.
+    assert not twnote._TAG_SETS
+
+
+def test_metadata_read_from_html(monkeypatch):
+    """
+    Reading notes' metadata straight from the HTML gives exactly the same
+    notes as finding it in the soup, and is used whenever it's safe.
+    """
+    rng = random.Random(44)
+    values = ["", " ", "Some Deck", "[[a b]] c", "a]]b", "x &amp; y", "<b>bold</b>",
+              "Get rid of it"]
+    scheds = ["", " ", "ivl:3; due:20200102; ease:2500; lapses:1"]
+    wiki = Wiki("MyTestWiki", Path("wiki"), Path("wiki"), WikiType.FOLDER)
+
+    def notes(html, source):
+        soup = BeautifulSoup(html, 'html.parser')
+        return {n.id_: n.to_dict()
+                for n in TwNote.notes_from_soup(soup, wiki, "Tiddler", [], source=source)}
+
+    for i in range(200):
+        questions = [_rendered_question(f"2020{i:04d}{j:04d}", rng.choice(values),
+                                        rng.choice(values), rng.choice(scheds),
+                                        rng.choice(values), rng.choice(values))
+                     for j in range(rng.randint(1, 4))]
+        if rng.random() < 0.2:
+            questions[0] = questions[0].replace(
+                "<p>Answer</p>", "<p>" + _rendered_question(f"2021{i:04d}", "Q") + "</p>")
+        html = '<p><span id="tr-version">1.4.0</span></p>' + "\n".join(questions)
+        assert notes(html, html) == notes(html, None)
+
+    read_from_soup = []
+    original = twnote._get_note_deck_and_tags
+    def get_note_deck_and_tags(soup):
+        read_from_soup.append(soup)
+        return original(soup)
+    monkeypatch.setattr(twnote, '_get_note_deck_and_tags', get_note_deck_and_tags)
+    html = _rendered_question("20200101000000000", "Q", "Ref", "", "Deck", "a [[b c]]")
+    assert notes(html, html)["20200101000000000"]["tags"] == ["a", "b c"]
+    assert not read_from_soup
+
+
+def test_tiddler_list_tokenizer():
+    "Splitting a tiddler list always gives the same result as the original loop."
+    rng = random.Random(44)
+    pieces = [" ", "[", "]", "[[", "]]", "a", "b c", "\t", "\n"]
+    for _ in range(20000):
+        s = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 12)))
+        assert split_tiddler_list(s) == _split_tiddler_list_slowly(s)
+
+
+def test_unchanged_wiki_not_rendered(tmp_path, monkeypatch):
+    """
+    A wiki that hasn't changed since the last extraction gives the same notes
+    again without being rendered, while any change leads to a new rendering.
+    """
+    wiki_folder = tmp_path / "wiki"
+    (wiki_folder / "tiddlers").mkdir(parents=True)
+    tiddler = wiki_folder / "tiddlers" / "Page.tid"
+    tiddler.write_text("title: Page\n\nFirst question")
+
+    rendered = []
+    def render_wiki(tw_binary, wiki_path, output_directory, filter_, low_priority=False):
+        rendered.append(wiki_path)
+        os.makedirs(output_directory)
+        for tid in Path(wiki_path, "tiddlers").glob("*.tid"):
+            question = tid.read_text().split("\n\n", 1)[1]
+            Path(output_directory, f"{tid.stem}.html").write_text(
+                '<span id="tr-version">1.4.0</span>'
+                + _rendered_question("20200101000000000", question))
+    monkeypatch.setattr(twimport, '_render_wiki', render_wiki)
+
+    progress = []
+    def extract():
+        notes = find_notes("tiddlywiki", str(wiki_folder), "folder", "MyTestWiki",
+                           "[!is[system]]", callback=lambda *p: progress.append(p),
+                           cache_dir=str(tmp_path))
+        return {n.id_: n.to_dict() for n in notes}
+
+    first = extract()
+    assert first["20200101000000000"]["content"]["question"] == "First question"
+    assert extract() == first
+    assert len(rendered) == 1
+    assert progress[-1] == (1, 1)
+
+    tiddler.write_text("title: Page\n\nSecond question")
+    assert extract()["20200101000000000"]["content"]["question"] == "Second question"
+    assert len(rendered) == 2
+
+
+def test_extraction_ahead_of_time_shared(tmp_path, monkeypatch):
+    """
+    An extraction started while another of the same wiki is under way waits
+    for it, then uses its result rather than rendering the wiki again.
+    """
+    wiki_folder = tmp_path / "wiki"
+    (wiki_folder / "tiddlers").mkdir(parents=True)
+    (wiki_folder / "tiddlers" / "Page.tid").write_text("title: Page\n\nQuestion")
+
+    rendered = []
+    rendering = threading.Event()
+    def render_wiki(tw_binary, wiki_path, output_directory, filter_, low_priority=False):
+        rendered.append(low_priority)
+        rendering.set()
+        time.sleep(0.3)
+        os.makedirs(output_directory)
+        Path(output_directory, "Page.html").write_text(
+            '<span id="tr-version">1.4.0</span>'
+            + _rendered_question("20200101000000000", "Question"))
+    monkeypatch.setattr(twimport, '_render_wiki', render_wiki)
+
+    def extract(low_priority):
+        find_notes("tiddlywiki", str(wiki_folder), "folder", "MyTestWiki",
+                   "[!is[system]]", cache_dir=str(tmp_path), low_priority=low_priority)
+
+    ahead = threading.Thread(target=extract, args=(True,))
+    ahead.start()
+    assert rendering.wait(10)
+    extract(False)
+    ahead.join()
+    assert rendered == [True]
+
+
+def test_notes_streamed(tmp_path, monkeypatch):
+    """
+    iter_notes() yields each tiddler's notes once it has been parsed,
+    dropping its rendered file, and only caches the extraction when done.
+    """
+    wiki_folder = tmp_path / "wiki"
+    (wiki_folder / "tiddlers").mkdir(parents=True)
+
+    render_location = []
+    def render_wiki(tw_binary, wiki_path, output_directory, filter_, low_priority=False):
+        render_location.append(Path(output_directory))
+        os.makedirs(output_directory)
+        for i, id_ in enumerate(["20200101000000001", "20200101000000002",
+                                 "20200101000000001"]):
+            Path(output_directory, f"Tiddler{i}.html").write_text(
+                '<span id="tr-version">1.4.0</span>' + _rendered_question(id_, "Question"))
+    monkeypatch.setattr(twimport, '_render_wiki', render_wiki)
+
+    def extract():
+        return iter_notes("tiddlywiki", str(wiki_folder), "folder", "MyTestWiki",
+                          "[!is[system]]", cache_dir=str(tmp_path))
+
+    notes = extract()
+    assert next(notes).id_ == "20200101000000001"
+    assert sorted(p.name for p in render_location[0].iterdir()) \
+        == ["Tiddler1.html", "Tiddler2.html"]
+    assert not twimport._wiki_lock("MyTestWiki").acquire(blocking=False)
+    notes.close()
+    assert twimport._wiki_lock("MyTestWiki").acquire(blocking=False)
+    twimport._wiki_lock("MyTestWiki").release()
+
+    assert [n.id_ for n in extract()] == ["20200101000000001", "20200101000000002"]
+    assert len(render_location) == 2
+    assert {n.id_ for n in extract()} == {"20200101000000001", "20200101000000002"}
+    assert len(render_location) == 2
+    assert not twnote._TAG_SETS
+
+
+@pytest.mark.skipif(not hasattr(os, 'getpriority'), reason="needs POSIX priorities")
+def test_low_priority_command(tmp_path):
+    "TiddlyWiki can be run at idle priority, with errors reported as usual."
+    niceness = tmp_path / "niceness"
+    script = ("import os, sys, time; time.sleep(0.5); "
+              "open(sys.argv[1], 'w').write(str(os.nice(0)))")
+    twimport._invoke_tw_command([sys.executable, "-c", script, str(niceness)],
+                                str(tmp_path), "test", low_priority=True)
+    assert int(niceness.read_text()) > os.nice(0)
+
+    with pytest.raises(RenderingError):
+        twimport._invoke_tw_command([sys.executable, "-c", "raise SystemExit(1)"],
+                                    str(tmp_path), "test", low_priority=True)
+
+
+def test_changed_tiddlers_extracted_alone(tmp_path, monkeypatch):
+    """
+    Extracting just the tiddlers that changed renders only those, and offers
+    for removal only the notes that came from them and nowhere else.
+    """
+    wiki_folder = tmp_path / "wiki"
+    tiddlers = wiki_folder / "tiddlers"
+    tiddlers.mkdir(parents=True)
+    def write(title, *ids):
+        (tiddlers / f"{title}.tid").write_text(f"title: {title}\n\n" + " ".join(ids))
+    write("Alpha", "20200101000000001", "20200101000000002")
+    write("Beta", "20200101000000003", "20200101000000004")
+    write("Gamma", "20200101000000004", "20200101000000005")
+
+    rendered = []
+    def render_wiki(tw_binary, wiki_path, output_directory, filter_, titles=None,
+                    low_priority=False):
+        os.makedirs(output_directory)
+        for tid in Path(wiki_path, "tiddlers").glob("*.tid"):
+            if titles is not None and tid.stem not in titles:
+                continue
+            rendered.append(tid.stem)
+            html = '<span id="tr-version">1.4.0</span>'
+            for id_ in tid.read_text().split("\n\n", 1)[1].split():
+                html += _rendered_question(id_, f"Question {id_}")
+            Path(output_directory, f"{tid.stem}.html").write_text(html)
+    monkeypatch.setattr(twimport, '_render_wiki', render_wiki)
+
+    def extract_changed(*titles):
+        rendered.clear()
+        return find_changed_notes("tiddlywiki", str(wiki_folder), "MyTestWiki",
+                                  "[!is[system]]", titles, str(tmp_path))
+
+    assert extract_changed("Alpha") is None
+    find_notes("tiddlywiki", str(wiki_folder), "folder", "MyTestWiki",
+               "[!is[system]]", cache_dir=str(tmp_path))
+
+    # A note moved out of a tiddler is removable; one still in another isn't.
+    write("Beta", "20200101000000003")
+    (tiddlers / "Alpha.tid").unlink()
+    write("Delta", "20200101000000002")
+    changes = extract_changed("Alpha", "Beta", "Delta")
+    assert sorted(rendered) == ["Beta", "Delta"]
+    assert {n.id_ for n in changes.notes} == {"20200101000000002", "20200101000000003"}
+    assert changes.removable == {"20200101000000001"}
+
+    # The cache now knows where each note is, so deleting Gamma frees
+    # the note it shared with Beta before.
+    (tiddlers / "Gamma.tid").unlink()
+    changes = extract_changed("Gamma")
+    assert not rendered and not changes.notes
+    assert changes.removable == {"20200101000000004", "20200101000000005"}
+
+    assert extract_changed("Odd]]Title") is None
+
+
+def test_pushed_tiddlers_extracted_alone(tmp_path, monkeypatch):
+    """
+    Tiddlers pushed by a running wiki are parsed from the HTML pushed, and
+    notes that came from deleted tiddlers become removable.
+    """
+    wiki_folder = tmp_path / "wiki"
+    tiddlers = wiki_folder / "tiddlers"
+    tiddlers.mkdir(parents=True)
+    (tiddlers / "Alpha.tid").write_text("title: Alpha\n\nText")
+    (tiddlers / "Beta.tid").write_text("title: Beta\n\nText")
+
+    def html(*ids):
+        return '<span id="tr-version">1.4.0</span>' + "".join(
+            _rendered_question(id_, f"Question {id_}") for id_ in ids)
+    def render_wiki(tw_binary, wiki_path, output_directory, filter_, titles=None,
+                    low_priority=False):
+        os.makedirs(output_directory)
+        Path(output_directory, "Alpha.html").write_text(html("20200101000000001"))
+        Path(output_directory, "Beta.html").write_text(html("20200101000000002"))
+    monkeypatch.setattr(twimport, '_render_wiki', render_wiki)
+
+    def push(tiddlers, deleted=()):
+        return find_pushed_notes(str(wiki_folder), "MyTestWiki", tiddlers, set(deleted),
+                                 str(tmp_path))
+
+    assert push({"Alpha": html()}) is None
+    find_notes("tiddlywiki", str(wiki_folder), "folder", "MyTestWiki",
+               "[!is[system]]", cache_dir=str(tmp_path))
+
+    changes = push({"Alpha": html("20200101000000003"), "Odd/Title?": html("20200101000000004")},
+                   ["Beta"])
+    assert {n.id_ for n in changes.notes} == {"20200101000000003", "20200101000000004"}
+    assert changes.removable == {"20200101000000001", "20200101000000002"}
+
+    changes = push({}, ["Odd/Title?"])
+    assert not changes.notes and changes.removable == {"20200101000000004"}
+
+    # Whoever can push mustn't be able to copy other files on this computer
+    # into Anki.
+    for src in ("file:///etc/passwd", "FILE:///etc/passwd", "../secret.png", "/etc/passwd"):
+        with pytest.raises(ExtractError, match="outside the wiki folder"):
+            push({"Alpha": html("20200101000000003") + f'<img src="{src}">'})
+
+
+def test_per_note_media(fn_params):
+    "Each note in a tiddler should carry only the media used in its own fields."
+    fn_params['filter_'] = "PerNoteMediaTest"
+    notes = {n.id_: n for n in find_notes(**fn_params)}
+    assert len(notes) == 3
+
+    dog_note = notes['20261019120001000']
+    assert [m.filename for m in dog_note.media] == [
+        "tr-f53cec5dc23d10d91500c50d79ccb4e73df697f64fc2cd93a1b2fcf2698775c5.jpg"]
+
+    cat_note = notes['20261019120002000']
+    assert [m.filename for m in cat_note.media] == [
+        "tr-9a369d4f9f61553dc672ab317b6e52b555c8c00c12d7bbfd6b8b93062bff8957.jpg"]
+
+    assert not notes['20261019120003000'].media
+
+
 def test_audio(fn_params):
     "An HTML5 audio tag should come across into a TwNote."
     expected_filename = \
@@ -0,0 +1,117 @@
+/*\
+title: $:/plugins/sobjornstad/TiddlyRemember/startup/push.js
+type: application/javascript
+module-type: startup
+
+Push tiddlers to the TiddlyRemember Anki add-on as they're saved, so that
+their notes are synced straight away. This is off unless
+$:/config/TiddlyRemember/PushUrl gives the push URL shown in the add-on's
+settings (such as http://127.0.0.1:8739/<token>/, which changes each time
+Anki starts) and $:/config/TiddlyRemember/PushWiki the name of this wiki in
+the add-on's configuration. Only changes to tiddlers
+matching $:/config/TiddlyRemember/PushFilter are pushed, and of those, only
+tiddlers selected by the wiki's content filter in the add-on are sent.
+
+\*/
+(function(){
+
+/*jslint node: true, browser: true */
+/*global $tw: false */
+"use strict";
+
+exports.name = "tiddlyremember-push";
+exports.platforms = ["browser"];
+exports.after = ["startup"];
+exports.synchronous = true;
+
+var TEMPLATE = "$:/plugins/sobjornstad/TiddlyRemember/templates/TiddlyRememberParseable",
+	DEFAULT_FILTER = "[!is[system]!has[draft.of]]",
+	// Wait for this long after the last change before pushing, in milliseconds.
+	DELAY = 1000;
+
+exports.startup = function() {
+	var pending = Object.create(null),
+		timer = null;
+
+	function config(name, defaultText) {
+		return ($tw.wiki.getTiddlerText("$:/config/TiddlyRemember/" + name) || defaultText).trim();
+	}
+
+	function push() {
+		timer = null;
+		var url = config("PushUrl", ""),
+			wikiName = config("PushWiki", ""),
+			titles = Object.keys(pending);
+		pending = Object.create(null);
+		if(!url || !wikiName) {
+			return;
+		}
+		var accepted = $tw.wiki.filterTiddlers(config("PushFilter", DEFAULT_FILTER), null,
+				$tw.wiki.makeTiddlerIterator(titles));
+		if(accepted.length === 0) {
+			return;
+		}
+		// Only push the tiddlers the add-on's content filter for this wiki
+		// selects, as a full sync would render; the others are pushed as
+		// deleted, so that notes they used to hold are removed.
+		var filterUrl = new URL(url, window.location.href);
+		filterUrl.searchParams.set("wiki", wikiName);
+		$tw.utils.httpRequest({
+			url: filterUrl.href,
+			type: "GET",
+			callback: function(err, data) {
+				if(err) {
+					report(err, data);
+					return;
+				}
+				var filter = JSON.parse(data).filter,
+					selected = $tw.wiki.filterTiddlers(filter, null,
+						$tw.wiki.makeTiddlerIterator(accepted)),
+					tiddlers = [],
+					deleted = [];
+				$tw.utils.each(accepted, function(title) {
+					if(selected.indexOf(title) !== -1 && $tw.wiki.tiddlerExists(title)) {
+						tiddlers.push({
+							title: title,
+							html: $tw.wiki.renderTiddler("text/html", TEMPLATE,
+								{variables: {currentTiddler: title, storyTiddler: title}})
+						});
+					} else {
+						deleted.push(title);
+					}
+				});
+				$tw.utils.httpRequest({
+					url: url,
+					type: "POST",
+					headers: {"Content-Type": "application/json"},
+					data: JSON.stringify({wiki: wikiName, filter: filter,
+						tiddlers: tiddlers, deleted: deleted}),
+					callback: function(err, data) {
+						if(err) {
+							report(err, data);
+						}
+					}
+				});
+			}
+		});
+	}
+
+	function report(err, data) {
+		console.log("TiddlyRemember: couldn't push tiddlers to Anki: " + err + " " + (data || ""));
+	}
+
+	$tw.wiki.addEventListener("change", function(changes) {
+		if(!config("PushUrl", "")) {
+			return;
+		}
+		$tw.utils.each(changes, function(change, title) {
+			pending[title] = true;
+		});
+		if(timer) {
+			clearTimeout(timer);
+		}
+		timer = setTimeout(push, DELAY);
+	});
+};
+
+})();